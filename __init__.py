@@ -13,6 +13,16 @@ bl_info = {
 
 import sys
 import os
+import time
+import importlib.util
+
+_import_start = time.perf_counter()
+
+# 启动时间预算（毫秒）：导入和注册插件超过这个时间时打印警告 / Startup budget for import + register
+STARTUP_BUDGET_MS = 100.0
+
+# 必需的第三方依赖；启动时只用 find_spec 确认存在，第一次生成时才真正导入
+REQUIRED_MODULES = ("numpy", "scipy", "cv2")
 
 # 插件目录设置 / Addon directory setup
 addon_dir = os.path.dirname(__file__)
@@ -34,7 +44,10 @@ except ImportError as e:
 
 # 传统依赖安装方法（备用） / Legacy dependency installation (fallback)
 def legacy_dependency_install():
-    """传统依赖安装方法 / Legacy dependency installation method"""
+    """传统依赖安装方法 / Legacy dependency installation method
+
+    需要联网下载，只在注册后由后台线程调用，不在导入插件时运行。
+    """
     if os.path.exists(lib_dir):
         return  # already exists
 
@@ -56,20 +69,12 @@ def legacy_dependency_install():
 
 # 检查依赖是否可用 / Check if dependencies are available
 def check_dependencies():
-    """检查所需依赖是否可用 / Check if required dependencies are available"""
-    try:
-        import numpy
-        import scipy
-        import cv2
-        print("[Distool] All dependencies are available.")
-        return True
-    except ImportError as e:
-        print(f"[Distool] Missing dependencies: {e}")
+    """只用 find_spec 检查所需依赖是否存在，不导入 / Probe required dependencies with find_spec, without importing"""
+    missing = [name for name in REQUIRED_MODULES if importlib.util.find_spec(name) is None]
+    if missing:
+        print(f"[Distool] Missing dependencies: {', '.join(missing)}")
         return False
-
-# 尝试使用传统方法安装依赖 / Try to install dependencies using legacy method
-if not DEPENDENCY_MANAGEMENT_AVAILABLE:
-    legacy_dependency_install()
+    return True
 
 # 检查依赖状态 / Check dependency status
 dependencies_available = check_dependencies()
@@ -86,8 +91,25 @@ else:
     print("[Distool] Main module not imported due to missing dependencies.")
     MAIN_MODULE_AVAILABLE = False
 
+_import_ms = (time.perf_counter() - _import_start) * 1000.0
+
+def _report_startup(register_ms):
+    """打印导入和注册的耗时，超过预算时给出警告"""
+    total = _import_ms + register_ms
+    message = f"[Distool] Startup {total:.1f} ms (import {_import_ms:.1f} ms, register {register_ms:.1f} ms)"
+    if total > STARTUP_BUDGET_MS:
+        message += f" exceeds the {STARTUP_BUDGET_MS:.0f} ms budget"
+    print(message)
+
 def register():
     """注册插件 / Register addon"""
+    register_start = time.perf_counter()
+
+    # 依赖管理模块不可用时，用传统方法在后台下载依赖，不阻塞 Blender 启动
+    if not DEPENDENCY_MANAGEMENT_AVAILABLE and not os.path.exists(lib_dir):
+        import threading
+        threading.Thread(target=legacy_dependency_install, name="distool-legacy-install", daemon=True).start()
+
     # 注册依赖管理功能 / Register dependency management
     if DEPENDENCY_MANAGEMENT_AVAILABLE:
         try:
@@ -128,6 +150,8 @@ def register():
         import bpy
         bpy.app.timers.register(show_error_message, first_interval=1.0)
 
+    _report_startup((time.perf_counter() - register_start) * 1000.0)
+
 def unregister():
     """注销插件 / Unregister addon"""
     # 注销主模块 / Unregister main module
@@ -6,11 +6,9 @@ Automatic detection, installation and management of Python libraries required by
 
 import sys
 import os
-import subprocess
 import threading
-import urllib.request
-import zipfile
 import json
+import importlib.util
 import bpy
 from bpy.props import BoolProperty, StringProperty, EnumProperty
 from bpy.types import Operator, Panel
@@ -44,6 +42,7 @@ class DistoolDependencyManager:
             "opencv-python": {
                 "version": ">=4.5.0",
                 "import_name": "cv2",
+                "dist_names": ["opencv-python", "opencv-python-headless", "opencv-contrib-python", "opencv-contrib-python-headless"],
                 "wheel_url": "https://files.pythonhosted.org/packages/py3/o/opencv-python/opencv_python-4.8.1.78-cp310-cp310-win_amd64.whl",
                 "description": "计算机视觉库 / Computer Vision Library"
             }
@@ -52,30 +51,93 @@ class DistoolDependencyManager:
         # 添加lib目录到Python路径
         if self.lib_dir not in sys.path:
             sys.path.insert(0, self.lib_dir)
+        
+        # 缓存的环境探测结果，面板重绘时只读取它
+        self._environment = None
+        self._environment_lock = threading.Lock()
     
     def check_dependency(self, dep_name):
-        """检查单个依赖是否可用 / Check if single dependency is available"""
+        """检查单个依赖是否可用 / Check if single dependency is available
+
+        只用 find_spec 查找模块，不导入（导入 NumPy/SciPy/OpenCV 需要数百毫秒）。
+        """
         dep_config = self.dependencies.get(dep_name)
         if not dep_config:
             return False, f"Unknown dependency: {dep_name}"
         
-        try:
-            __import__(dep_config["import_name"])
+        import_name = dep_config["import_name"]
+        if import_name in sys.modules:
             return True, f"{dep_name} is available"
-        except ImportError as e:
+        try:
+            spec = importlib.util.find_spec(import_name)
+        except (ImportError, ValueError) as e:
             return False, f"{dep_name} not available: {str(e)}"
+        if spec is None:
+            return False, f"{dep_name} not available: No module named '{import_name}'"
+        return True, f"{dep_name} is available"
     
-    def check_all_dependencies(self):
-        """检查所有依赖状态 / Check all dependencies status"""
-        status = {}
-        for dep_name in self.dependencies.keys():
+    def installed_version(self, dep_name):
+        """已安装的版本号，无法确定时为 None / Installed version, or None when unknown"""
+        module = sys.modules.get(self.dependencies[dep_name]["import_name"])
+        version = getattr(module, "__version__", None)
+        if version:
+            return str(version)
+        from importlib import metadata
+        for dist_name in self.dependencies[dep_name].get("dist_names", [dep_name]):
+            try:
+                return metadata.version(dist_name)
+            except Exception:
+                continue
+        return None
+    
+    def probe_environment(self):
+        """完整探测一次运行环境 / Probe the environment once
+
+        返回依赖状态（含版本）、Python/平台信息和 libs/ 目录的修改时间。
+        """
+        # 安装后目录内容变了，清掉导入系统的目录缓存，find_spec 才能看到新模块
+        importlib.invalidate_caches()
+        dependencies = {}
+        for dep_name, dep_config in self.dependencies.items():
             available, message = self.check_dependency(dep_name)
-            status[dep_name] = {
+            dependencies[dep_name] = {
                 "available": available,
                 "message": message,
-                "config": self.dependencies[dep_name]
+                "version": self.installed_version(dep_name) if available else None,
+                "config": dep_config
             }
-        return status
+        return {
+            "dependencies": dependencies,
+            "all_available": all(status["available"] for status in dependencies.values()),
+            "python": self.get_blender_python_info(),
+            "libs_stamp": self._libs_stamp()
+        }
+    
+    def _libs_stamp(self):
+        try:
+            return os.stat(self.lib_dir).st_mtime_ns
+        except OSError:
+            return None
+    
+    def environment(self):
+        """缓存的环境探测结果 / Cached environment probe
+
+        第一次调用、invalidate_environment() 之后或 libs/ 目录内容变化时重新探测，
+        其余情况直接返回缓存，面板每次重绘只多一次 stat。
+        """
+        with self._environment_lock:
+            if self._environment is None or self._environment["libs_stamp"] != self._libs_stamp():
+                self._environment = self.probe_environment()
+            return self._environment
+    
+    def invalidate_environment(self):
+        """安装或删除依赖后调用，下次读取时重新探测 / Force a fresh probe on the next read"""
+        with self._environment_lock:
+            self._environment = None
+    
+    def check_all_dependencies(self):
+        """检查所有依赖状态（读取缓存的环境探测结果）/ Check all dependencies status"""
+        return self.environment()["dependencies"]
     
     def install_dependency(self, dep_name, progress_callback=None):
         """安装单个依赖 / Install single dependency"""
@@ -93,12 +155,14 @@ class DistoolDependencyManager:
             wheel_path = os.path.join(self.cache_dir, wheel_filename)
             
             if not os.path.exists(wheel_path):
+                import urllib.request   # 只在安装时导入，不放在插件启动路径上
                 urllib.request.urlretrieve(wheel_url, wheel_path)
             
             if progress_callback:
                 progress_callback(f"正在安装 {dep_name}...", 0.6)
             
             # 解压wheel文件
+            import zipfile
             with zipfile.ZipFile(wheel_path, 'r') as zip_ref:
                 zip_ref.extractall(self.lib_dir)
             
@@ -106,6 +170,8 @@ class DistoolDependencyManager:
                 progress_callback(f"正在配置 {dep_name}...", 0.9)
             
             # 验证安装
+            self.invalidate_environment()
+            importlib.invalidate_caches()
             available, message = self.check_dependency(dep_name)
             if available:
                 if progress_callback:
@@ -115,6 +181,7 @@ class DistoolDependencyManager:
                 return False, f"{dep_name} installation failed: {message}"
                 
         except Exception as e:
+            self.invalidate_environment()
             return False, f"Error installing {dep_name}: {str(e)}"
     
     def install_all_dependencies(self, progress_callback=None):
@@ -147,6 +214,8 @@ class DISTOOL_OT_CheckDependencies(Operator):
     bl_label = "检查依赖 / Check Dependencies"
     
     def execute(self, context):
+        # 显式检查时重新探测
+        dependency_manager.invalidate_environment()
         status = dependency_manager.check_all_dependencies()
         
         # 显示状态信息
@@ -241,11 +310,12 @@ class DISTOOL_PT_DependencyPanel(Panel):
         layout = self.layout
         scene = context.scene
         
-        # 检查依赖状态
-        status = dependency_manager.check_all_dependencies()
+        # 依赖状态只读取缓存，重绘时不重复探测
+        environment = dependency_manager.environment()
+        status = environment["dependencies"]
         
         # 总体状态
-        all_available = all(dep_status["available"] for dep_status in status.values())
+        all_available = environment["all_available"]
         
         if all_available:
             box = layout.box()
@@ -265,7 +335,8 @@ class DISTOOL_PT_DependencyPanel(Panel):
             # 状态图标
             if dep_status["available"]:
                 row.label(text="", icon='CHECKMARK')
-                row.label(text=f"{dep_name} (已安装 / Installed)")
+                version = f" {dep_status['version']}" if dep_status["version"] else ""
+                row.label(text=f"{dep_name}{version} (已安装 / Installed)")
             else:
                 row.label(text="", icon='ERROR')
                 row.label(text=f"{dep_name} (未安装 / Not Installed)")
@@ -301,7 +372,7 @@ class DISTOOL_PT_DependencyPanel(Panel):
         # 系统信息
         box = layout.box()
         box.label(text="系统信息 / System Info:", icon='SETTINGS')
-        py_info = dependency_manager.get_blender_python_info()
+        py_info = environment["python"]
         
         col = box.column(align=True)
         col.label(text=f"Python版本 / Python Version: {py_info['version'].split()[0]}")
@@ -0,0 +1,247 @@
+"""
+Distool 批处理流水线 / Distool Batch Pipeline
+读取、计算、写出三个阶段通过有界队列重叠执行
+Overlapped read -> compute -> write stages connected by bounded queues
+
+无界面运行 / Headless usage:
+    python distool_batch.py --out outputs --set distool_normal_strength=3.0 textures/*.png
+"""
+
+import os
+import sys
+import time
+import queue
+import threading
+import cv2
+
+try:
+    from . import distool_core
+    from . import distool_metrics
+    from . import distool_profile
+except ImportError:
+    import distool_core
+    import distool_metrics
+    import distool_profile
+
+# 队列结束标记
+_DONE = object()
+
+
+class StageStats:
+    """单个阶段的统计 / Statistics for one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0      # 实际工作时间
+        self.starved = 0.0   # 等待上游的时间
+        self.blocked = 0.0   # 下游队列已满、等待放入的时间（背压）
+
+    def as_dict(self, wall_time):
+        return {
+            "items": self.items,
+            "busy_s": round(self.busy, 4),
+            "starved_s": round(self.starved, 4),
+            "blocked_s": round(self.blocked, 4),
+            "utilization": round(self.busy / wall_time, 4) if wall_time > 0 else 0.0,
+        }
+
+
+class BatchReport:
+    """批处理结果与各阶段利用率 / Batch results and per-stage utilization"""
+
+    def __init__(self):
+        self.stages = {name: StageStats(name) for name in ("read", "compute", "write")}
+        self.results = {}   # 源路径 -> (法线路径, 位移路径)
+        self.outputs = {}   # 源路径 -> 写出的全部文件（含附加贴图和 mip 层级）
+        self.errors = {}    # 源路径 -> 错误信息
+        self.wall_time = 0.0
+
+    @property
+    def bottleneck(self):
+        """利用率最高的阶段即瓶颈"""
+        return max(self.stages.values(), key=lambda stage: stage.busy).name
+
+    def as_dict(self):
+        return {
+            "wall_time_s": round(self.wall_time, 4),
+            "images": len(self.results) + len(self.errors),
+            "failed": len(self.errors),
+            "bottleneck": self.bottleneck,
+            "stages": {name: stage.as_dict(self.wall_time) for name, stage in self.stages.items()},
+        }
+
+    def summary(self):
+        lines = [f"{len(self.results)} images in {self.wall_time:.2f}s, bottleneck: {self.bottleneck}"]
+        for name, stage in self.stages.items():
+            stats = stage.as_dict(self.wall_time)
+            lines.append(f"  {name:<8} {stats['utilization'] * 100:5.1f}% busy, "
+                         f"starved {stats['starved_s']:.2f}s, blocked {stats['blocked_s']:.2f}s")
+        for path, error in self.errors.items():
+            lines.append(f"  FAILED {path}: {error}")
+        return "\n".join(lines)
+
+
+def _get(q, stats):
+    start = time.perf_counter()
+    item = q.get()
+    stats.starved += time.perf_counter() - start
+    return item
+
+
+def _put(q, item, stats):
+    start = time.perf_counter()
+    q.put(item)
+    stats.blocked += time.perf_counter() - start
+
+
+def run_batch(image_paths, scene, output_dir=None, prefetch=2, write_queue=2, metrics=None):
+    """以三段流水线批量生成贴图 / Generate maps for many images with an overlapped pipeline
+
+    读取阶段预先解码后续图像，写出阶段负责PNG编码和落盘，计算阶段在调用线程中运行。
+    队列长度 prefetch / write_queue 限制了同时驻留内存的图像数量。
+    metrics 为 distool_metrics.MetricsLogger，默认取 DISTOOL_METRICS；每张图像写一条记录。
+    返回 BatchReport。
+    """
+    report = BatchReport()
+    metrics = metrics or distool_metrics.get_logger()
+    if not distool_core.outputs_requested(scene):
+        return report
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    read_stats = report.stages["read"]
+    compute_stats = report.stages["compute"]
+    write_stats = report.stages["write"]
+    decoded = queue.Queue(maxsize=max(1, prefetch))
+    encoded = queue.Queue(maxsize=max(1, write_queue))
+    stop = threading.Event()
+
+    def emit(path, outputs, timings, error, cache=None):
+        # 每张图像一条指标记录，耗时为读取+计算+写出
+        if metrics is not None:
+            distool_metrics.emit_job(metrics, "batch", path, scene, outputs, sum(timings.values()), timings, error, cache)
+
+    def reader():
+        for path in image_paths:
+            if stop.is_set():
+                break
+            start = time.perf_counter()
+            try:
+                img = cv2.imread(path, distool_core.decode_flags(scene))
+                error = None if img is not None else "could not decode image"
+            except Exception as e:
+                img, error = None, str(e)
+            elapsed = time.perf_counter() - start
+            read_stats.busy += elapsed
+            read_stats.items += 1
+            _put(decoded, (path, img, error, {"read": elapsed}), read_stats)
+        _put(decoded, _DONE, read_stats)
+
+    def writer():
+        while True:
+            item = _get(encoded, write_stats)
+            if item is _DONE:
+                break
+            path, outputs, timings = item
+            output_paths = [output_path for _, output_path, _ in outputs]
+            start = time.perf_counter()
+            error = None
+            try:
+                report.results[path] = distool_core.write_outputs(outputs)
+                report.outputs[path] = output_paths
+            except Exception as e:
+                report.errors[path] = error = str(e)
+            timings["write"] = time.perf_counter() - start
+            write_stats.busy += timings["write"]
+            write_stats.items += 1
+            # 批处理不经过缓存，每张图像都重新计算
+            emit(path, output_paths, timings, error, {"hits": 0, "misses": 1})
+
+    wall_start = time.perf_counter()
+    # 读写线程的阶段计入调用者的 profile_run / Count reader and writer stages in the caller's run
+    threads = [threading.Thread(target=distool_profile.bind(reader), daemon=True),
+               threading.Thread(target=distool_profile.bind(writer), daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = _get(decoded, compute_stats)
+            if item is _DONE:
+                break
+            path, img, error, timings = item
+            if error:
+                report.errors[path] = error
+                emit(path, [], timings, error)
+                continue
+            start = time.perf_counter()
+            try:
+                outputs = distool_core.compute_outputs(img, path, scene, output_dir)
+            except Exception as e:
+                report.errors[path] = error = str(e)
+                emit(path, [], timings, error)
+                continue
+            finally:
+                timings["compute"] = time.perf_counter() - start
+                compute_stats.busy += timings["compute"]
+                compute_stats.items += 1
+            del img
+            _put(encoded, (path, outputs, timings), compute_stats)
+    finally:
+        # 异常时让读取线程尽快退出，并清空队列避免其阻塞
+        stop.set()
+        while threads[0].is_alive():
+            try:
+                decoded.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        encoded.put(_DONE)
+        for thread in threads:
+            thread.join()
+        report.wall_time = time.perf_counter() - wall_start
+
+    return report
+
+
+def parse_settings(assignments):
+    """把 name=value 形式的参数解析为设置字典 / Parse name=value overrides"""
+    import ast
+
+    overrides = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition("=")
+        name = name.strip()
+        if not name.startswith("distool_"):
+            name = "distool_" + name
+        try:
+            overrides[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            overrides[name] = value
+    return overrides
+
+
+def main(argv=None):
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Distool batch generation")
+    parser.add_argument("images", nargs="+", help="source images")
+    parser.add_argument("--out", help="output directory (default: addon outputs/)")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a distool_* setting, e.g. --set normal_strength=3.0")
+    parser.add_argument("--prefetch", type=int, default=2, help="decoded images queued ahead of compute")
+    parser.add_argument("--write-queue", type=int, default=2, help="finished maps queued for writing")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--metrics", help="append per-image JSON-lines metrics to this file (default: $DISTOOL_METRICS)")
+    args = parser.parse_args(argv)
+
+    scene = distool_core.HeadlessSettings(**parse_settings(args.set))
+    metrics = distool_metrics.get_logger(args.metrics)
+    report = run_batch(args.images, scene, args.out, args.prefetch, args.write_queue, metrics)
+    print(json.dumps(report.as_dict(), indent=2) if args.json else report.summary())
+    return 1 if report.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
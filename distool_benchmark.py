@@ -0,0 +1,340 @@
+"""
+Distool 性能基准 / Distool Performance Benchmark
+在 Blender 之外用 HeadlessSettings 计时图像管线的每个阶段，结果保存为 JSON，并可与基线比较
+Times every stage of the image pipeline outside Blender with HeadlessSettings, saves the
+results as JSON and compares them against a stored baseline
+
+用法 / Usage:
+    python distool_benchmark.py run --sizes 1024 2048 4096 --out bench.json
+    python distool_benchmark.py run --sizes 8192 --inputs terrain --repeat 1 --out bench_8k.json
+    python distool_benchmark.py compare baseline.json bench.json --threshold 0.15
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import tracemalloc
+
+import cv2
+import numpy as np
+
+try:
+    from . import distool_core
+except ImportError:
+    import distool_core
+
+DEFAULT_SIZES = (1024, 2048, 4096)
+# 细节级别 <= 6 时 enhance_details 不做任何处理，7-10 分别对应 2-5 层金字塔
+DETAIL_LEVELS = (7.0, 8.0, 9.0, 10.0)
+
+
+# ---------------------------------------------------------------------------
+# 输入图像 / Inputs
+# ---------------------------------------------------------------------------
+
+def _value_noise(size, cells, rng):
+    grid = rng.random((cells + 1, cells + 1)).astype(np.float32)
+    return cv2.resize(grid, (size, size), interpolation=cv2.INTER_CUBIC)
+
+
+def make_noise(size, seed=0):
+    """白噪声：压缩和滤波的最坏情况 / White noise, worst case for compression"""
+    rng = np.random.default_rng(seed)
+    return (rng.random((size, size, 3)) * 255).astype(np.uint8)
+
+
+def make_gradient(size, seed=0):
+    """平滑渐变加圆形凸起：大面积平坦区域 / Smooth ramps and bumps"""
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+    height = 0.5 * x + 0.3 * np.exp(-((x - 0.5) ** 2 + (y - 0.5) ** 2) / 0.02)
+    gray = np.clip(height * 255, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+def make_terrain(size, seed=0):
+    """多倍频噪声，接近真实的岩石/地形纹理 / Multi-octave noise resembling rock or terrain"""
+    rng = np.random.default_rng(seed)
+    height = np.zeros((size, size), dtype=np.float32)
+    amplitude, cells = 1.0, 4
+    while cells < size // 2:
+        height += amplitude * _value_noise(size, cells, rng)
+        amplitude *= 0.5
+        cells *= 2
+    height = (height - height.min()) / (height.max() - height.min())
+    color = np.stack([height * 0.8, height * 0.9, height], axis=-1)
+    return np.clip(color * 255, 0, 255).astype(np.uint8)
+
+
+def make_bricks(size, seed=0):
+    """砖墙：锐利边缘加表面噪声，接近真实的建筑纹理 / Bricks with sharp mortar lines and surface noise"""
+    rng = np.random.default_rng(seed)
+    brick_h, brick_w, mortar = max(8, size // 16), max(16, size // 8), max(2, size // 256)
+    y, x = np.mgrid[0:size, 0:size]
+    row = y // brick_h
+    x_offset = (x + (row % 2) * (brick_w // 2)) % brick_w
+    is_mortar = ((y % brick_h) < mortar) | (x_offset < mortar)
+    surface = 0.7 + 0.2 * _value_noise(size, max(4, size // 32), rng)
+    height = np.where(is_mortar, 0.2, surface).astype(np.float32)
+    height += rng.normal(0, 0.02, height.shape).astype(np.float32)
+    gray = np.clip(height * 255, 0, 255).astype(np.uint8)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+
+
+INPUTS = {
+    "noise": make_noise,
+    "gradient": make_gradient,
+    "terrain": make_terrain,
+    "bricks": make_bricks,
+}
+
+
+# ---------------------------------------------------------------------------
+# 计时 / Timing
+# ---------------------------------------------------------------------------
+
+def peak_rss_mb():
+    """进程峰值常驻内存（MB），无法获取时为 None / Process peak RSS in MB"""
+    # Linux 的 ru_maxrss 会保留 exec 之前父进程的峰值，VmHWM 只统计当前地址空间
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 以 KB 为单位，macOS 以字节为单位
+        return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+    except (ImportError, AttributeError):
+        return None
+
+
+def case_peak_rss_mb(source_path, scene, workdir):
+    """在子进程中运行一次 process_image，返回该用例的峰值常驻内存（MB）
+
+    ru_maxrss 是整个进程生命周期的峰值，在同一进程中测量时会被之前更大的用例掩盖，
+    因此每个用例单独启动一个进程；结果包含解释器和依赖库本身的内存。失败时为 None。
+    """
+    import subprocess
+
+    settings = json.dumps(distool_core.HeadlessSettings.from_scene(scene).as_dict())
+    command = [sys.executable, os.path.abspath(__file__), "rss", source_path, workdir, settings]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, check=True, timeout=600)
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return None
+
+
+def _time(func, repeat):
+    """运行 repeat 次，返回 (最短耗时, 最后一次结果) / Best-of-N timing"""
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark_case(img, scene, repeat=3, workdir=None):
+    """对一张输入计时每个阶段 / Time every pipeline stage for one input
+
+    阶段按 compute_normal_map 的实际顺序依次调用 distool_core 中的函数，
+    上一阶段的输出作为下一阶段的输入。
+    """
+    stages = {}
+    workdir = workdir or tempfile.mkdtemp(prefix="distool_bench_")
+    source_path = os.path.join(workdir, "source.png")
+    cv2.imwrite(source_path, img)
+
+    stages["decode"], decoded = _time(lambda: cv2.imread(source_path, cv2.IMREAD_COLOR), repeat)
+    stages["grayscale"], gray = _time(lambda: distool_core.grayscale_from_bgr(decoded, scene), repeat)
+    stages["gamma"], gamma = _time(lambda: distool_core.apply_gamma(gray, scene), repeat)
+    stages["pre_blur"], base_height = _time(lambda: distool_core.prefilter_height(gamma, scene), repeat)
+
+    height = base_height
+    for level in DETAIL_LEVELS:
+        elapsed, enhanced = _time(lambda: distool_core.enhance_details(base_height, level, scene), repeat)
+        stages[f"enhance_details@{level:g}"] = elapsed
+        if level == scene.distool_normal_level:
+            height = enhanced
+
+    gradients = None
+    for name, operator in distool_core.GRADIENT_OPERATORS.items():
+        elapsed, result = _time(lambda: operator(height), repeat)
+        stages[f"gradient_{name.lower()}"] = elapsed
+        if name == scene.distool_gradient_type:
+            gradients = result
+
+    stages["normalize"], normal = _time(lambda: distool_core.normals_from_gradients(*gradients, scene), repeat)
+    stages["smooth"], _ = _time(lambda: distool_core.smooth_normals(normal.copy(), scene), repeat)
+    stages["encode"], encoded = _time(lambda: distool_core.encode_normal_map(normal, height, scene), repeat)
+    out_path = os.path.join(workdir, "normal.png")
+    stages["write"], _ = _time(lambda: cv2.imwrite(out_path, encoded), repeat)
+
+    # 端到端计时，以及 tracemalloc 统计的峰值分配（单独一遍，避免影响上面的计时）
+    total, _ = _time(lambda: distool_core.process_image(source_path, scene, output_dir=workdir), repeat)
+    tracemalloc.start()
+    try:
+        distool_core.process_image(source_path, scene, output_dir=workdir)
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "stages": {name: round(value, 6) for name, value in stages.items()},
+        "total": round(total, 6),
+        "peak_traced_mb": round(traced_peak / (1024 * 1024), 1),
+        "peak_rss_mb": case_peak_rss_mb(source_path, scene, workdir),
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, inputs=tuple(INPUTS), repeat=3, scene=None, log=print):
+    """运行全部用例并返回结果字典 / Run every case and return the result dict"""
+    scene = scene or distool_core.HeadlessSettings(distool_normal_smooth=1.0)
+    # 平滑强度为0时 smooth 阶段为空操作，基准默认打开以便计时
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "cpu_count": os.cpu_count(),
+            "repeat": repeat,
+            "settings": distool_core.HeadlessSettings.from_scene(scene).as_dict(),
+        },
+        "cases": {},
+    }
+    workdir = tempfile.mkdtemp(prefix="distool_bench_")
+    try:
+        for size in sizes:
+            for name in inputs:
+                case = f"{name}@{size}"
+                img = INPUTS[name](size)
+                results["cases"][case] = benchmark_case(img, scene, repeat, workdir)
+                log(f"{case:<16} total {results['cases'][case]['total'] * 1000:9.1f} ms, "
+                    f"peak traced {results['cases'][case]['peak_traced_mb']} MB, "
+                    f"peak RSS {results['cases'][case]['peak_rss_mb']} MB")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+# ---------------------------------------------------------------------------
+# 基线比较 / Baseline comparison
+# ---------------------------------------------------------------------------
+
+def compare_results(baseline, current, threshold=0.10, min_seconds=0.002, memory_threshold=0.10):
+    """与基线比较，返回 (回归列表, 改进列表)
+
+    耗时增长超过 threshold（比例）且绝对差值超过 min_seconds 的阶段记为回归，
+    避免毫秒级的测量噪声被误报；峰值分配或峰值常驻内存增长超过 memory_threshold 也记为回归。
+    """
+    regressions, improvements = [], []
+    for case, current_case in current["cases"].items():
+        base_case = baseline["cases"].get(case)
+        if base_case is None:
+            continue
+        timings = dict(current_case["stages"], total=current_case["total"])
+        base_timings = dict(base_case["stages"], total=base_case["total"])
+        for stage, value in timings.items():
+            base = base_timings.get(stage)
+            if not base:
+                continue
+            change = (value - base) / base
+            entry = (case, stage, base, value, change)
+            if change > threshold and value - base > min_seconds:
+                regressions.append(entry)
+            elif change < -threshold and base - value > min_seconds:
+                improvements.append(entry)
+        for key in ("peak_traced_mb", "peak_rss_mb"):
+            base_mem, mem = base_case.get(key), current_case.get(key)
+            if base_mem and mem and (mem - base_mem) / base_mem > memory_threshold:
+                regressions.append((case, key, base_mem, mem, (mem - base_mem) / base_mem))
+    return regressions, improvements
+
+
+def _format_entry(entry):
+    case, stage, base, value, change = entry
+    unit = " MB" if stage.endswith("_mb") else " ms"
+    scale = 1 if stage.endswith("_mb") else 1000
+    return f"  {case:<16} {stage:<24} {base * scale:10.2f} -> {value * scale:10.2f}{unit} ({change:+.1%})"
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Distool pipeline benchmark")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the benchmark suite")
+    run.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="edge lengths, e.g. 1024 2048 4096 8192")
+    run.add_argument("--inputs", nargs="+", choices=sorted(INPUTS), default=list(INPUTS))
+    run.add_argument("--repeat", type=int, default=3, help="runs per stage, best time is kept")
+    run.add_argument("--out", default="bench.json", help="result JSON path")
+    run.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                     help="override a distool_* setting, e.g. --set normal_level=9.0")
+
+    compare = commands.add_parser("compare", help="compare results against a baseline")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.10, help="relative slowdown reported as a regression")
+    compare.add_argument("--min-ms", type=float, default=2.0, help="ignore changes smaller than this")
+
+    # 内部使用：case_peak_rss_mb 在子进程中运行一个用例
+    rss = commands.add_parser("rss", help="run one case and print its peak RSS (used internally)")
+    rss.add_argument("source")
+    rss.add_argument("workdir")
+    rss.add_argument("settings", help="HeadlessSettings as JSON")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        try:
+            from . import distool_batch
+        except ImportError:
+            import distool_batch
+        overrides = dict({"distool_normal_smooth": 1.0}, **distool_batch.parse_settings(args.set))
+        scene = distool_core.HeadlessSettings(**overrides)
+        results = run_benchmarks(args.sizes, args.inputs, args.repeat, scene)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.out}")
+        return 0
+
+    if args.command == "rss":
+        scene = distool_core.HeadlessSettings(**json.loads(args.settings))
+        distool_core.process_image(args.source, scene, output_dir=args.workdir)
+        print(json.dumps(peak_rss_mb()))
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+    regressions, improvements = compare_results(baseline, current, args.threshold, args.min_ms / 1000.0)
+    if improvements:
+        print("Improvements:")
+        print("\n".join(_format_entry(entry) for entry in improvements))
+    if regressions:
+        print("REGRESSIONS:")
+        print("\n".join(_format_entry(entry) for entry in regressions))
+        return 1
+    print("No regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,954 @@
+"""
+Distool 图像处理管线 / Distool Image Processing Pipeline
+不依赖 bpy 的法线/位移贴图生成核心，可在 Blender 内外使用
+Normal/displacement generation core without bpy, usable inside and outside Blender
+"""
+
+import os
+import re
+import cv2
+import numpy as np
+from scipy import fft as scipy_fft
+from scipy.ndimage import gaussian_filter
+
+try:
+    from .distool_profile import stage, timed_stage, bind
+    from . import distool_threads
+except ImportError:
+    from distool_profile import stage, timed_stage, bind
+    import distool_threads
+
+# 插件注册时已设置线程预算，但那时管线依赖尚未导入
+distool_threads.libraries_imported()
+
+# 默认设置，与 distool_main 中注册的场景属性一致，供无界面运行使用
+DEFAULT_SETTINGS = {
+    "distool_generate_normal": True,
+    "distool_generate_displacement": True,
+    "distool_generate_curvature": False,
+    "distool_generate_cavity": False,
+    "distool_generate_ao": False,
+    "distool_generate_roughness": False,
+    "distool_generate_mips": False,
+    "distool_mip_min_size": 512,
+    "distool_stream_output": False,
+    "distool_strip_rows": 256,
+    "distool_normal_strength": 2.5,
+    "distool_normal_level": 7.0,
+    "distool_normal_blur": 0,
+    "distool_gradient_type": 'SOBEL',
+    "distool_normal_gamma_correct": True,
+    "distool_normal_gamma": 0.5,
+    "distool_normal_detail_strength": 0.5,
+    "distool_normal_smooth": 0.0,
+    "distool_invert_r": False,
+    "distool_invert_g": False,
+    "distool_invert_height": False,
+    "distool_zrange": True,
+    "distool_normal_format": 'RGB',
+    "distool_height_source": 'IMAGE',
+    "distool_source_flip_g": False,
+    "distool_disp_contrast": -0.5,
+    "distool_disp_auto_levels": False,
+    "distool_disp_levels_clip": 0.5,
+    "distool_disp_blur": 0,
+    "distool_invert_disp": False,
+}
+
+class HeadlessSettings:
+    """无界面运行时代替 bpy 场景的设置对象 / Stand-in for the Blender scene in headless runs"""
+
+    def __init__(self, **overrides):
+        unknown = set(overrides) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown Distool settings: {', '.join(sorted(unknown))}")
+        self.__dict__.update(DEFAULT_SETTINGS)
+        self.__dict__.update(overrides)
+
+    @classmethod
+    def from_scene(cls, scene):
+        """从 Blender 场景复制所有 distool_* 设置 / Copy distool_* settings from a Blender scene"""
+        return cls(**{name: getattr(scene, name) for name in DEFAULT_SETTINGS if hasattr(scene, name)})
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in DEFAULT_SETTINGS}
+
+def convert_image_to_grayscale(image_path, scene):
+    with stage("decode"):
+        img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    return grayscale_from_bgr(img, scene)
+
+@timed_stage("grayscale")
+def grayscale_from_bgr(img, scene, levels=None):
+    """从已解码的BGR图像生成位移灰度图"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    return adjust_height(gray, scene, levels).astype(np.uint8)
+
+@timed_stage("integrate")
+def height_from_normal_map(img, scene):
+    """把切线空间法线贴图积分回高度场（Frankot–Chellappa），返回 0-255 浮点高度
+
+    在频域求解泊松方程，O(N log N)，8K 也只需两次正向和一次逆向 FFT。
+    约定与 Distool 输出的法线相同（R 向右、G 向上）；DirectX 法线打开 distool_source_flip_g。
+    FFT 假设图像可平铺，整体倾斜（平均梯度）会被去掉，结果按实际范围拉伸到 0-255。
+    """
+    scale = 65535.0 if img.dtype == np.uint16 else 255.0
+    nz = np.maximum(img[..., 0].astype(np.float32) * (2.0 / scale) - 1.0, 0.05)
+    p = (img[..., 2].astype(np.float32) * (2.0 / scale) - 1.0) / nz    # dh/dx
+    q = (img[..., 1].astype(np.float32) * (2.0 / scale) - 1.0) / nz    # -dh/dy（行向下）
+    if not getattr(scene, 'distool_source_flip_g', False):
+        q = -q
+    del nz
+
+    height, width = p.shape
+    workers = distool_threads.library_threads()
+    u = (2 * np.pi * scipy_fft.rfftfreq(width)).astype(np.float32)[None, :]
+    v = (2 * np.pi * scipy_fft.fftfreq(height)).astype(np.float32)[:, None]
+    # Z = (-iu·P - iv·Q) / (u² + v²)，原地计算以控制峰值内存
+    spectrum = scipy_fft.rfft2(p, workers=workers)
+    del p
+    spectrum *= -1j * u
+    q_spectrum = scipy_fft.rfft2(q, workers=workers)
+    del q
+    q_spectrum *= -1j * v
+    spectrum += q_spectrum
+    del q_spectrum
+    denominator = u * u + v * v
+    denominator[0, 0] = 1.0
+    spectrum /= denominator
+    spectrum[0, 0] = 0.0
+    result = scipy_fft.irfft2(spectrum, s=(height, width), workers=workers)
+
+    sample = _strided_sample(result)
+    low, high = float(sample.min()), float(sample.max())
+    return np.clip((result - low) * (255.0 / max(high - low, 1e-6)), 0, 255)
+
+@timed_stage("disp_adjust")
+def adjust_height(gray, scene, levels=None):
+    """位移设置（对比度或自动色阶、模糊/锐化、反相），输入输出均为 0-255 浮点，不量化为8位
+
+    自动色阶把 levels=(低, 高) 线性拉伸到 0-255；未传入时从 gray 自身估计。
+    只处理图像的一部分（条带、区域、瓦片）时应传入整幅估计的 levels，各部分才能一致。
+    """
+    if getattr(scene, 'distool_disp_auto_levels', False):
+        if levels is None:
+            levels = estimate_levels(_strided_sample(gray), scene)
+        low, high = levels
+        gray = (gray - low) * (255.0 / max(high - low, 1e-6))
+    else:
+        contrast = scene.distool_disp_contrast
+        gray = (gray - 127.5) * (1 + contrast) + 127.5
+    gray = np.clip(gray, 0, 255)
+    
+    blur_strength = scene.distool_disp_blur
+    if blur_strength != 0:
+        sigma = abs(blur_strength)
+        if blur_strength > 0:
+            gray = gaussian_filter(gray, sigma=sigma)
+        else:
+            blurred = gaussian_filter(gray, sigma=sigma)
+            gray = np.clip(2 * gray - blurred, 0, 255)
+    
+    if scene.distool_invert_disp:
+        gray = 255 - gray
+        
+    return gray
+
+def sobel_operator(height_map):
+    """使用Sobel算子计算梯度 - 修复Y轴方向"""
+    kernel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=np.float32)
+    kernel_y = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]], dtype=np.float32)
+    
+    # 使用cv2.filter2D进行卷积
+    grad_x = cv2.filter2D(height_map, -1, kernel_x, borderType=cv2.BORDER_REPLICATE)
+    grad_y = cv2.filter2D(height_map, -1, kernel_y, borderType=cv2.BORDER_REPLICATE)
+    
+    # 修复：反转Y轴梯度以匹配OpenGL纹理坐标系
+    grad_y = -grad_y
+    
+    return grad_x, grad_y
+
+def prewitt_operator(height_map):
+    """使用Prewitt算子计算梯度 - 修复Y轴方向"""
+    kernel_x = np.array([[-1, 0, 1], [-1, 0, 1], [-1, 0, 1]], dtype=np.float32)
+    kernel_y = np.array([[-1, -1, -1], [0, 0, 0], [1, 1, 1]], dtype=np.float32)
+    
+    grad_x = cv2.filter2D(height_map, -1, kernel_x, borderType=cv2.BORDER_REPLICATE)
+    grad_y = cv2.filter2D(height_map, -1, kernel_y, borderType=cv2.BORDER_REPLICATE)
+    
+    # 修复：反转Y轴梯度以匹配OpenGL纹理坐标系
+    grad_y = -grad_y
+    
+    return grad_x, grad_y
+
+def scharr_operator(height_map):
+    """使用Scharr算子计算梯度（更好的旋转对称性）- 修复Y轴方向"""
+    kernel_x = np.array([[-3, 0, 3], [-10, 0, 10], [-3, 0, 3]], dtype=np.float32)
+    kernel_y = np.array([[-3, -10, -3], [0, 0, 0], [3, 10, 3]], dtype=np.float32)
+    
+    grad_x = cv2.filter2D(height_map, -1, kernel_x, borderType=cv2.BORDER_REPLICATE)
+    grad_y = cv2.filter2D(height_map, -1, kernel_y, borderType=cv2.BORDER_REPLICATE)
+    
+    # 修复：反转Y轴梯度以匹配OpenGL纹理坐标系
+    grad_y = -grad_y
+    
+    return grad_x, grad_y
+
+def _cached_blur(height_map, sigma, blur_cache):
+    """带缓存的高斯模糊，供细节增强和附加贴图共享"""
+    if blur_cache is None:
+        return gaussian_filter(height_map, sigma=sigma)
+    blurred = blur_cache.get(sigma)
+    if blurred is None:
+        blurred = gaussian_filter(height_map, sigma=sigma)
+        blur_cache[sigma] = blurred
+    return blurred
+
+@timed_stage("enhance_details")
+def enhance_details(height_map, detail_level, scene, blur_cache=None):
+    """多尺度细节增强"""
+    if detail_level <= 6.0:
+        return height_map
+    
+    # 创建多尺度金字塔
+    levels = int(detail_level - 5.0)
+    enhanced = height_map.copy()
+    
+    for i in range(levels):
+        # 计算当前尺度的细节
+        sigma = 2 ** i
+        blurred = _cached_blur(height_map, sigma, blur_cache)
+        detail = height_map - blurred
+        
+        # 增强细节
+        detail_strength = scene.distool_normal_detail_strength if hasattr(scene, 'distool_normal_detail_strength') else 0.5
+        enhanced += detail * detail_strength * (1.0 / (i + 1))
+    
+    return np.clip(enhanced, 0, 1)
+
+def generate_normal_map_from_texture(image_path, scene):
+    """改进的法线贴图生成算法"""
+    return compute_normal_map(convert_image_to_grayscale(image_path, scene), scene)
+
+# 各梯度算子 / Gradient operators by distool_gradient_type
+GRADIENT_OPERATORS = {
+    'SOBEL': sobel_operator,
+    'PREWITT': prewitt_operator,
+    'SCHARR': scharr_operator,
+}
+
+@timed_stage("gamma")
+def apply_gamma(gray, scene):
+    """归一化到0-1，并按设置做伽马预处理"""
+    # 归一化
+    gray = gray.astype(np.float32) / 255.0
+    
+    # 预处理：增强对比度
+    if hasattr(scene, 'distool_normal_gamma_correct') and scene.distool_normal_gamma_correct:
+        gamma = getattr(scene, 'distool_normal_gamma', 0.5)
+        gray = np.power(gray, gamma)
+    return gray
+
+@timed_stage("pre_blur")
+def prefilter_height(gray, scene):
+    """应用高斯模糊控制细节级别"""
+    blur_sigma = max(0.1, abs(scene.distool_normal_blur) * 0.5 if scene.distool_normal_blur != 0 else 0.1)
+    return gaussian_filter(gray, sigma=blur_sigma)
+
+@timed_stage("gradient")
+def compute_gradients(height, scene):
+    """选择梯度算子计算梯度"""
+    gradient_type = getattr(scene, 'distool_gradient_type', 'SOBEL')
+    operator = GRADIENT_OPERATORS.get(gradient_type, sobel_operator)  # 默认使用Sobel
+    return operator(height)
+
+@timed_stage("normalize")
+def normals_from_gradients(grad_x, grad_y, scene):
+    """由梯度构建单位法线向量"""
+    # 法线强度控制 - 修复：增加缩放因子
+    scale = scene.distool_normal_strength * 1.0  # 从0.1改为1.0
+    dx = grad_x * scale
+    dy = grad_y * scale
+    
+    # 构建法线向量 - 修复：正确的切线空间法线计算
+    # X轴：向右为正，Y轴：向下为正（OpenGL纹理坐标），Z轴：向外为正
+    dz = np.ones_like(dx)
+    
+    # 构建法线向量 - 修复Y轴方向（移除了错误的负号）
+    normal = np.stack((dx, dy, dz), axis=-1)
+    
+    # 归一化
+    length = np.linalg.norm(normal, axis=2, keepdims=True)
+    length = np.maximum(length, 1e-8)
+    return normal / length
+
+@timed_stage("smooth")
+def smooth_normals(normal, scene):
+    """可选的法线平滑"""
+    if hasattr(scene, 'distool_normal_smooth') and scene.distool_normal_smooth > 0:
+        smooth_sigma = scene.distool_normal_smooth * 0.1
+        for i in range(3):  # 对每个通道进行平滑
+            normal[..., i] = gaussian_filter(normal[..., i], sigma=smooth_sigma)
+        # 重新归一化
+        length = np.linalg.norm(normal, axis=2, keepdims=True)
+        length = np.maximum(length, 1e-8)
+        normal = normal / length
+    return normal
+
+def compute_normal_map(gray, scene, intermediates=None):
+    """从位移灰度图计算法线贴图
+
+    如果传入 intermediates 字典，会把中间结果（高度场、模糊金字塔、梯度、法线向量）
+    写入其中，供附加贴图复用。
+    """
+    gray = apply_gamma(gray, scene)
+    base_height = prefilter_height(gray, scene)
+    
+    # 多尺度细节增强
+    blur_cache = {}
+    height = enhance_details(base_height, scene.distool_normal_level, scene, blur_cache)
+    
+    grad_x, grad_y = compute_gradients(height, scene)
+    normal = normals_from_gradients(grad_x, grad_y, scene)
+    normal = smooth_normals(normal, scene)
+    
+    if intermediates is not None:
+        intermediates.update(
+            base_height=base_height,
+            blur_cache=blur_cache,
+            height=height,
+            grad_x=grad_x,
+            grad_y=grad_y,
+            normal=normal,
+        )
+    
+    return encode_normal_map(normal, height, scene)
+
+@timed_stage("encode")
+def encode_normal_map(normal, height, scene):
+    """把单位法线向量编码为8位BGR法线贴图"""
+    # 转换为RGB颜色空间 (切线空间标准)
+    normal_rgb = np.zeros_like(normal, dtype=np.float32)
+    normal_rgb[..., 0] = (normal[..., 0] * 0.5 + 0.5) * 255  # R: X轴
+    normal_rgb[..., 1] = (normal[..., 1] * 0.5 + 0.5) * 255  # G: Y轴  
+    normal_rgb[..., 2] = (normal[..., 2] * 0.5 + 0.5) * 255  # B: Z轴
+    
+    # 应用通道反转选项
+    if scene.distool_invert_r:
+        normal_rgb[..., 0] = 255 - normal_rgb[..., 0]
+    if scene.distool_invert_g:
+        normal_rgb[..., 1] = 255 - normal_rgb[..., 1]
+    if scene.distool_invert_height:
+        normal_rgb[..., 2] = 255 - normal_rgb[..., 2]
+    
+    # Z-Range选项 - 推荐：使用True获得标准法线贴图
+    if not scene.distool_zrange:
+        normal_rgb[..., 2] = height * 255
+    
+    # RG 压缩：只保存 X/Y，Z 在着色器中重建，B 通道的选项不适用
+    normal_format = getattr(scene, 'distool_normal_format', 'RGB')
+    if normal_format in PACKED_NORMAL_FORMATS:
+        return pack_normal_rg(normal_rgb, normal_format)
+
+    # 关键修复：OpenCV使用BGR格式，需要将RGB转换为BGR
+    normal_rgb = cv2.cvtColor(normal_rgb.astype(np.uint8), cv2.COLOR_RGB2BGR)
+    
+    return np.clip(normal_rgb, 0, 255).astype(np.uint8)
+
+
+# 双通道法线格式：写成 灰度+Alpha PNG，X 在灰度通道，Y 在 Alpha 通道
+PACKED_NORMAL_FORMATS = ('RG8', 'RG16')
+
+def pack_normal_rg(normal_rgb, normal_format):
+    """0-255 浮点 RGB 法线 -> 双通道 (X, Y) 数组；RG8 与 RGB 格式的 R/G 字节相同，RG16 为 16 位"""
+    if normal_format == 'RG16':
+        return np.clip(np.round(normal_rgb[..., :2] * 257.0), 0, 65535).astype(np.uint16)
+    return np.clip(normal_rgb[..., :2], 0, 255).astype(np.uint8)
+
+def unpack_rg_normal(packed):
+    """双通道法线（或 OpenCV 读回的 BGRA）-> 重建 Z 后的 8 位 BGR 法线贴图，用于预览"""
+    scale = 65535.0 if packed.dtype == np.uint16 else 255.0
+    x = packed[..., 0].astype(np.float32) / scale * 2.0 - 1.0
+    y = packed[..., -1].astype(np.float32) / scale * 2.0 - 1.0
+    z = np.sqrt(np.clip(1.0 - x * x - y * y, 0.0, 1.0))
+    bgr = np.stack((z, y, x), axis=-1) * 0.5 + 0.5
+    return (bgr * 255.0).astype(np.uint8)
+
+def normal_output_layout(scene):
+    """法线输出的 (通道数, 位深) / (channels, bit depth) of the normal output"""
+    normal_format = getattr(scene, 'distool_normal_format', 'RGB')
+    if normal_format in PACKED_NORMAL_FORMATS:
+        return 2, 16 if normal_format == 'RG16' else 8
+    return 3, 8
+
+def write_image(path, img):
+    """写出 PNG；OpenCV 不支持双通道 PNG，RG 压缩法线改用流式写出器"""
+    if img.ndim == 3 and img.shape[2] == 2:
+        try:
+            from .distool_tiled import StripedPNGWriter
+        except ImportError:
+            from distool_tiled import StripedPNGWriter
+        height, width = img.shape[:2]
+        with StripedPNGWriter(path, width, height, 2, 16 if img.dtype == np.uint16 else 8) as writer:
+            writer.write_rows(img)
+        return True
+    return cv2.imwrite(path, img)
+
+
+# 附加贴图：(类型, 开关属性, 文件后缀)
+EXTRA_MAP_TYPES = (
+    ('curvature', 'distool_generate_curvature', '_curvature'),
+    ('cavity', 'distool_generate_cavity', '_cavity'),
+    ('ao', 'distool_generate_ao', '_ao'),
+    ('roughness', 'distool_generate_roughness', '_roughness'),
+)
+
+# 附加贴图使用的模糊尺度，与 enhance_details 的金字塔（sigma = 2**i）重合部分直接复用
+EXTRA_MAP_SIGMAS = (1, 2, 4, 8)
+
+def sample_step(height, width, max_samples=65536):
+    """跨步子采样的步长，使样本数不超过 max_samples 左右"""
+    return max(1, int(np.sqrt(height * width / max_samples)))
+
+def _strided_sample(values, max_samples=65536):
+    """均匀跨步子采样，用于估计整幅统计量 / Strided subsample for whole-image statistics"""
+    step = sample_step(values.shape[0], values.shape[1], max_samples)
+    return values[::step, ::step]
+
+@timed_stage("levels")
+def estimate_levels(sample, scene):
+    """从高度样本估计自动色阶的 (低, 高) 百分位，两端各裁掉 distool_disp_levels_clip 百分比
+
+    np.percentile 基于部分选择，不对样本整体排序；样本最多约 65536 个像素。
+    """
+    clip = min(max(float(getattr(scene, 'distool_disp_levels_clip', 0.5)), 0.0), 49.0)
+    low, high = np.percentile(sample, (clip, 100.0 - clip))
+    return float(low), float(high)
+
+def height_sample(img):
+    """图像的跨步样本转换为灰度高度（与 grayscale_from_bgr 相同的换算）"""
+    sample = _strided_sample(img)
+    if sample.ndim == 3:
+        sample = cv2.cvtColor(np.ascontiguousarray(sample), cv2.COLOR_BGR2GRAY)
+    return sample.astype(np.float32)
+
+def uses_global_levels(scene):
+    """是否需要预先估计整幅图像的自动色阶（从法线积分高度时在积分结果上估计，不需要）"""
+    return getattr(scene, 'distool_disp_auto_levels', False) and not requires_whole_image(scene)
+
+def image_levels(img, scene):
+    """整幅图像的自动色阶 (低, 高)；不需要时为 None"""
+    if not uses_global_levels(scene):
+        return None
+    return estimate_levels(height_sample(img), scene)
+
+def _robust_scale(values, percentile=99.0, max_samples=65536):
+    """在跨步子采样上估计数值幅度，避免被少数极值支配"""
+    sample = np.abs(_strided_sample(values, max_samples))
+    return max(float(np.percentile(sample, percentile)), 1e-6)
+
+def _signed_to_u8(values):
+    """有符号数据映射到0-255，128为零点"""
+    values = values / _robust_scale(values)
+    return np.clip(values * 127.5 + 127.5, 0, 255).astype(np.uint8)
+
+def _unsigned_to_u8(values):
+    """非负数据映射到0-255"""
+    values = values / _robust_scale(values)
+    return np.clip(values * 255, 0, 255).astype(np.uint8)
+
+@timed_stage("extra_maps")
+def compute_extra_maps(intermediates, kinds):
+    """从法线管线的中间结果计算附加贴图（曲率、空腔、AO、粗糙度提示）"""
+    base_height = intermediates['base_height']
+    blur_cache = intermediates['blur_cache']
+    grad_x = intermediates['grad_x']
+    grad_y = intermediates['grad_y']
+    maps = {}
+
+    if 'curvature' in kinds:
+        # 梯度场的散度（即拉普拉斯），凸起为亮、凹陷为暗
+        deriv = np.array([[-0.5, 0, 0.5]], dtype=np.float32)
+        div = cv2.filter2D(grad_x, -1, deriv, borderType=cv2.BORDER_REPLICATE)
+        div -= cv2.filter2D(grad_y, -1, deriv.T, borderType=cv2.BORDER_REPLICATE)  # grad_y 已翻转
+        maps['curvature'] = _signed_to_u8(-div)
+
+    if 'cavity' in kinds or 'ao' in kinds:
+        # 每个尺度上低于邻域平均高度的部分
+        occlusion = [np.maximum(_cached_blur(base_height, sigma, blur_cache) - base_height, 0)
+                     for sigma in EXTRA_MAP_SIGMAS]
+        if 'cavity' in kinds:
+            # 只看小尺度缝隙，白色为平坦，暗色为缝隙
+            maps['cavity'] = 255 - _unsigned_to_u8(occlusion[0] + occlusion[1])
+        if 'ao' in kinds:
+            # 多尺度累积，尺度越大权重越低
+            ao = sum(occ / (i + 1) for i, occ in enumerate(occlusion))
+            maps['ao'] = 255 - _unsigned_to_u8(ao)
+
+    if 'roughness' in kinds:
+        # 局部坡度的邻域均值：细节越密集越粗糙
+        slope = np.sqrt(grad_x * grad_x + grad_y * grad_y)
+        maps['roughness'] = _unsigned_to_u8(gaussian_filter(slope, sigma=2))
+
+    return maps
+
+def requested_extra_maps(scene):
+    """返回场景中启用的附加贴图类型"""
+    return [kind for kind, prop, _ in EXTRA_MAP_TYPES if getattr(scene, prop, False)]
+
+def compute_maps(img, scene, extra_kinds=(), intermediates=None, levels=None):
+    """对已解码的BGR图像运行完整管线
+
+    返回 {类型: uint8图像}，类型包括 'normal'、'disp' 以及请求的附加贴图。
+    传入 intermediates 时总会运行法线管线并保留中间结果。
+    单通道浮点输入视为 0-255 的高精度高度场，此时 'disp' 保持浮点。
+    levels 为整幅图像的自动色阶（image_levels），只处理图像一部分时传入。
+    """
+    if img.ndim == 2 and img.dtype.kind == 'f':
+        gray = adjust_height(img.astype(np.float32, copy=False), scene, levels)
+    elif getattr(scene, 'distool_height_source', 'IMAGE') == 'NORMAL_MAP':
+        gray = adjust_height(height_from_normal_map(img, scene), scene).astype(np.uint8)
+    else:
+        gray = grayscale_from_bgr(img, scene, levels)
+    maps = {}
+    if scene.distool_generate_displacement:
+        maps['disp'] = gray
+
+    if scene.distool_generate_normal or extra_kinds or intermediates is not None:
+        if intermediates is None:
+            intermediates = {}
+        normal_img = compute_normal_map(gray, scene, intermediates)
+        intermediates['gray'] = gray
+        if scene.distool_generate_normal:
+            maps['normal'] = normal_img
+        maps.update(compute_extra_maps(intermediates, extra_kinds))
+
+    return maps
+
+@timed_stage("mips")
+def build_mip_chain(normal, height, gray, scene, min_size=512):
+    """从全分辨率中间结果生成多级 mip 链
+
+    法线按向量做 2x2 面积平均后重新归一化，而不是缩放编码后的RGB，
+    因此每一级都是单位法线且与全分辨率结果一致。
+    返回 [(级别, 法线BGR, 位移灰度)]，级别1为一半分辨率。
+    """
+    chain = []
+    normal = normal.astype(np.float32)
+    height = height.astype(np.float32)
+    gray = gray.astype(np.float32)
+    level = 0
+    while min(normal.shape[:2]) // 2 >= min_size:
+        level += 1
+        size = (normal.shape[1] // 2, normal.shape[0] // 2)
+        normal = cv2.resize(normal, size, interpolation=cv2.INTER_AREA)
+        length = np.linalg.norm(normal, axis=2, keepdims=True)
+        normal = normal / np.maximum(length, 1e-8)
+        height = cv2.resize(height, size, interpolation=cv2.INTER_AREA)
+        gray = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+        chain.append((level, encode_normal_map(normal, height, scene), np.clip(gray + 0.5, 0, 255).astype(np.uint8)))
+    return chain
+
+def get_output_dir():
+    """输出目录（插件目录下的 outputs）"""
+    addon_dir = os.path.dirname(os.path.abspath(__file__))
+    output_dir = os.path.join(addon_dir, "outputs")
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+def outputs_requested(scene):
+    """场景是否请求了任何输出"""
+    return bool(scene.distool_generate_normal or scene.distool_generate_displacement or requested_extra_maps(scene))
+
+def compute_outputs(img, image_path, scene, output_dir=None):
+    """对已解码图像运行管线，返回待写出的 [(键, 输出路径, 图像)]
+
+    键为 'normal'、'disp'、附加贴图类型或 'normal_mipN'/'disp_mipN'。
+    计算与写出分开，便于批处理时把编码写盘放到单独的阶段。
+    """
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    if output_dir is None:
+        output_dir = get_output_dir()
+
+    extra_kinds = requested_extra_maps(scene)
+    generate_mips = getattr(scene, 'distool_generate_mips', False)
+    intermediates = {} if generate_mips else None
+    maps = compute_maps(img, scene, extra_kinds, intermediates)
+
+    outputs = []
+    if 'normal' in maps:
+        outputs.append(('normal', os.path.join(output_dir, base_name + "_normal.png"), maps['normal']))
+    if 'disp' in maps:
+        outputs.append(('disp', os.path.join(output_dir, base_name + "_disp.png"), maps['disp']))
+    for kind, prop, suffix in EXTRA_MAP_TYPES:
+        if kind in maps:
+            outputs.append((kind, os.path.join(output_dir, base_name + suffix + ".png"), maps[kind]))
+
+    # Mip链：复用本次运行的法线向量和高度场，不重新跑整条管线
+    if generate_mips:
+        min_size = getattr(scene, 'distool_mip_min_size', 512)
+        for level, mip_normal, mip_disp in build_mip_chain(intermediates['normal'], intermediates['height'], intermediates['gray'], scene, min_size):
+            suffix = "_mip%d.png" % level
+            if scene.distool_generate_normal:
+                outputs.append(('normal_mip%d' % level, os.path.join(output_dir, base_name + "_normal" + suffix), mip_normal))
+            if scene.distool_generate_displacement:
+                outputs.append(('disp_mip%d' % level, os.path.join(output_dir, base_name + "_disp" + suffix), mip_disp))
+
+    return outputs
+
+@timed_stage("write")
+def write_outputs(outputs, extra_paths=None):
+    """写出 compute_outputs 的结果，返回 (法线路径, 位移路径)，其余输出路径写入 extra_paths"""
+    paths = {}
+    for key, path, img in outputs:
+        # cv2.imwrite 失败时只返回 False（目录不存在、磁盘已满、扩展名不支持等）
+        if not write_image(path, img):
+            raise OSError(f"Could not write image: {path}")
+        paths[key] = path
+    if extra_paths is not None:
+        extra_paths.update((key, path) for key, path in paths.items() if key not in ('normal', 'disp'))
+    return paths.get('normal', ""), paths.get('disp', "")
+
+def process_image(image_path, scene, extra_paths=None, output_dir=None):
+    if not outputs_requested(scene):
+        return "", ""
+
+    # 只解码一次，位移贴图与法线管线共享灰度图
+    with stage("decode"):
+        img = cv2.imread(image_path, decode_flags(scene))
+    if img is None:
+        raise ValueError(f"Could not decode image: {image_path}")
+    return write_outputs(compute_outputs(img, image_path, scene, output_dir), extra_paths)
+
+
+# ---------------------------------------------------------------------------
+# UDIM 瓦片集
+# ---------------------------------------------------------------------------
+
+UDIM_TOKEN = "<UDIM>"
+
+def udim_tile_path(pattern, number):
+    """把 <UDIM> 模式替换为具体瓦片编号"""
+    return pattern.replace(UDIM_TOKEN, str(number))
+
+def udim_pattern_from_tile_path(path):
+    """tex.1001.png -> tex.<UDIM>.png"""
+    return re.sub(r"(?<!\d)1\d{3}(?!.*\d{4})", UDIM_TOKEN, path)
+
+def udim_tiles_on_disk(pattern):
+    """列出磁盘上存在的瓦片编号"""
+    directory, filename = os.path.split(pattern)
+    prefix, _, suffix = filename.partition(UDIM_TOKEN)
+    numbers = []
+    for name in os.listdir(directory or "."):
+        if name.startswith(prefix) and name.endswith(suffix):
+            token = name[len(prefix):len(name) - len(suffix)]
+            if len(token) == 4 and token.isdigit():
+                numbers.append(int(token))
+    return sorted(numbers)
+
+def compute_halo_radius(scene):
+    """计算分块处理时需要的邻域宽度（像素）
+
+    逐级累加每个空间滤波的支撑半径：位移模糊、法线预模糊、细节金字塔、梯度、法线平滑。
+    scipy 的 gaussian_filter 默认截断在 4 sigma。
+    """
+    radius = 4 * abs(scene.distool_disp_blur)
+    radius += 4 * max(0.1, abs(scene.distool_normal_blur) * 0.5)
+    if scene.distool_normal_level > 6.0:
+        radius += 4 * 2 ** (int(scene.distool_normal_level - 5.0) - 1)
+    radius += 1  # 3x3 梯度算子
+    radius += 4 * getattr(scene, 'distool_normal_smooth', 0.0) * 0.1
+    return int(np.ceil(radius)) + 1
+
+def requires_whole_image(scene):
+    """管线是否需要整幅图像（从法线积分高度是全局运算，不能分条或按区域计算）"""
+    return getattr(scene, 'distool_height_source', 'IMAGE') == 'NORMAL_MAP'
+
+def decode_flags(scene):
+    """源图像的 OpenCV 解码标志；从法线积分时保留 16 位法线的精度"""
+    if getattr(scene, 'distool_height_source', 'IMAGE') == 'NORMAL_MAP':
+        return cv2.IMREAD_ANYDEPTH | cv2.IMREAD_COLOR
+    return cv2.IMREAD_COLOR
+
+def _udim_uv(number):
+    """UDIM编号 -> (u, v) 瓦片坐标"""
+    return (number - 1001) % 10, (number - 1001) // 10
+
+def _udim_neighbor(number, du, dv):
+    u, v = _udim_uv(number)
+    u, v = u + du, v + dv
+    if not 0 <= u < 10 or v < 0:
+        return None
+    return 1001 + u + 10 * v
+
+def _read_udim_borders(pattern, number, halo, sample=False):
+    """读取一个瓦片，只保留四条边界带供相邻瓦片借用；sample 为 True 时附带自动色阶用的高度样本"""
+    path = udim_tile_path(pattern, number)
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not decode image: {path}")
+    return {
+        'shape': img.shape[:2],
+        'top': img[:halo].copy(),
+        'bottom': img[-halo:].copy(),
+        'left': img[:, :halo].copy(),
+        'right': img[:, -halo:].copy(),
+        'sample': height_sample(img).ravel() if sample else None,
+    }
+
+def _pad_udim_tile(img, number, borders, halo):
+    """用相邻瓦片的边界带扩展瓦片，返回 (扩展后的图像, 裁剪范围)
+
+    UV 空间中 v 向上，所以 v+1 的瓦片贴在图像的顶部行。
+    没有相邻瓦片的一侧不扩展，保持与单张图处理相同的边界行为。
+    """
+    h, w = img.shape[:2]
+
+    def neighbor(du, dv):
+        other = _udim_neighbor(number, du, dv)
+        return borders.get(other) if other is not None else None
+
+    above, below = neighbor(0, 1), neighbor(0, -1)
+    left, right = neighbor(-1, 0), neighbor(1, 0)
+    # 只借用尺寸匹配且边界带足够宽的相邻瓦片
+    above = above if above is not None and above['shape'][1] == w and above['bottom'].shape[0] >= halo else None
+    below = below if below is not None and below['shape'][1] == w and below['top'].shape[0] >= halo else None
+    left = left if left is not None and left['shape'][0] == h and left['right'].shape[1] >= halo else None
+    right = right if right is not None and right['shape'][0] == h and right['left'].shape[1] >= halo else None
+
+    top = halo if above is not None else 0
+    bottom = halo if below is not None else 0
+    lpad = halo if left is not None else 0
+    rpad = halo if right is not None else 0
+
+    canvas = np.empty((top + h + bottom, lpad + w + rpad) + img.shape[2:], dtype=img.dtype)
+    canvas[top:top + h, lpad:lpad + w] = img
+    if above is not None:
+        canvas[:top, lpad:lpad + w] = above['bottom'][-halo:]
+    if below is not None:
+        canvas[top + h:, lpad:lpad + w] = below['top'][:halo]
+    if left is not None:
+        canvas[top:top + h, :lpad] = left['right'][:, -halo:]
+    if right is not None:
+        canvas[top:top + h, lpad + w:] = right['left'][:, :halo]
+
+    # 四个角：优先取对角瓦片，否则复制相邻的边
+    corners = (
+        (top and lpad, slice(0, top), slice(0, lpad), neighbor(-1, 1), 'bottom', slice(-halo, None), slice(-halo, None)),
+        (top and rpad, slice(0, top), slice(lpad + w, None), neighbor(1, 1), 'bottom', slice(-halo, None), slice(0, halo)),
+        (bottom and lpad, slice(top + h, None), slice(0, lpad), neighbor(-1, -1), 'top', slice(0, halo), slice(-halo, None)),
+        (bottom and rpad, slice(top + h, None), slice(lpad + w, None), neighbor(1, -1), 'top', slice(0, halo), slice(0, halo)),
+    )
+    for needed, rows, cols, diagonal, edge, edge_rows, edge_cols in corners:
+        if not needed:
+            continue
+        if diagonal is not None and min(diagonal[edge].shape[:2]) >= halo:
+            canvas[rows, cols] = diagonal[edge][edge_rows, edge_cols]
+        else:
+            column = lpad if cols.start == 0 else lpad + w - 1
+            canvas[rows, cols] = canvas[rows, column:column + 1]
+
+    return canvas, (top, top + h, lpad, lpad + w)
+
+def udim_output_pattern(pattern, suffix, output_dir=None):
+    """tex.<UDIM>.png -> outputs/tex_normal.<UDIM>.png"""
+    base_name = os.path.splitext(os.path.basename(pattern))[0]
+    base_name = base_name.replace(UDIM_TOKEN, "").strip("._-") or "udim"
+    return os.path.join(output_dir or get_output_dir(), base_name + suffix + "." + UDIM_TOKEN + ".png")
+
+def process_udim_image(pattern, tile_numbers, scene, max_workers=None, output_dir=None):
+    """并行处理 UDIM 瓦片集，输出匹配的 UDIM 法线/位移瓦片
+
+    模糊和梯度所需的邻域从相邻瓦片借用，瓦片接缝处不会出现断层。
+    返回 (法线模式路径, 位移模式路径)，未生成的为空字符串。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    outputs = {}
+    if scene.distool_generate_normal:
+        outputs['normal'] = udim_output_pattern(pattern, "_normal", output_dir)
+    if scene.distool_generate_displacement:
+        outputs['disp'] = udim_output_pattern(pattern, "_disp", output_dir)
+    if not outputs or not tile_numbers:
+        return outputs.get('normal', ""), outputs.get('disp', "")
+    if requires_whole_image(scene):
+        # 逐瓦片积分会在接缝处产生高度断层
+        raise ValueError("Height from a normal map integrates the whole image and cannot run per UDIM tile")
+    for out_pattern in outputs.values():
+        os.makedirs(os.path.dirname(out_pattern), exist_ok=True)
+
+    halo = compute_halo_radius(scene)
+    max_workers = distool_threads.pool_size(max_workers, len(tile_numbers))
+
+    def process_tile(number):
+        path = udim_tile_path(pattern, number)
+        with stage("decode"):
+            img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError(f"Could not decode image: {path}")
+        padded, (y0, y1, x0, x1) = _pad_udim_tile(img, number, borders, min(halo, *img.shape[:2]))
+        maps = compute_maps(padded, scene, levels=levels)
+        with stage("write"):
+            for kind, out_pattern in outputs.items():
+                out_path = udim_tile_path(out_pattern, number)
+                if not write_image(out_path, maps[kind][y0:y1, x0:x1]):
+                    raise OSError(f"Could not write image: {out_path}")
+
+    # 自动色阶在所有瓦片的样本上统一估计，相邻瓦片的高度才能在接缝处衔接
+    pooled = uses_global_levels(scene)
+    with distool_threads.parallel_section(max_workers), ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # 第一遍只保留边界带，内存占用与瓦片数量无关
+        borders = dict(zip(tile_numbers, pool.map(bind(lambda n: _read_udim_borders(pattern, n, halo, pooled)), tile_numbers)))
+        levels = estimate_levels(np.concatenate([borders[n]['sample'] for n in tile_numbers]), scene) if pooled else None
+        list(pool.map(bind(process_tile), tile_numbers))
+
+    return outputs.get('normal', ""), outputs.get('disp', "")
+
+
+# ---------------------------------------------------------------------------
+# 图像序列 / 影片纹理
+# ---------------------------------------------------------------------------
+
+_FRAME_NUMBER_RE = re.compile(r"(\d+)(?!.*\d)")
+_FRAME_HASHES_RE = re.compile(r"#+")
+
+def sequence_pattern(path):
+    """tex.0001.png -> tex.####.png（以文件名中最后一段数字作为帧号）"""
+    directory, filename = os.path.split(path)
+    match = _FRAME_NUMBER_RE.search(filename)
+    if not match:
+        return None
+    return os.path.join(directory, filename[:match.start()] + "#" * len(match.group(1)) + filename[match.end():])
+
+def is_sequence_pattern(path):
+    """路径是否为 #### 帧序列模式"""
+    return _FRAME_HASHES_RE.search(os.path.basename(path)) is not None
+
+def sequence_frame_path(pattern, frame):
+    """把 #### 模式替换为补零后的帧号"""
+    directory, filename = os.path.split(pattern)
+    filename = _FRAME_HASHES_RE.sub(lambda m: str(frame).zfill(len(m.group(0))), filename, count=1)
+    return os.path.join(directory, filename)
+
+def sequence_frames_on_disk(pattern):
+    """列出磁盘上匹配 #### 模式的帧，返回 [(帧号, 路径)]"""
+    directory, filename = os.path.split(pattern)
+    match = _FRAME_HASHES_RE.search(filename)
+    prefix, suffix = filename[:match.start()], filename[match.end():]
+    frames = []
+    for name in os.listdir(directory or "."):
+        if name.startswith(prefix) and name.endswith(suffix) and len(name) > len(prefix) + len(suffix):
+            token = name[len(prefix):len(name) - len(suffix)]
+            if token.isdigit():
+                frames.append((int(token), os.path.join(directory, name)))
+    return sorted(frames)
+
+def _iter_source_frames(path, is_movie, flags=cv2.IMREAD_COLOR):
+    """逐帧产出 (帧号, 内容哈希, 解码函数)，不会一次性载入整个序列
+
+    图像序列按文件字节计算哈希，重复帧连解码都可以跳过；影片只能先解码再哈希。
+    """
+    import hashlib
+
+    if is_movie:
+        capture = cv2.VideoCapture(path)
+        frame = 0
+        try:
+            while True:
+                ok, img = capture.read()
+                if not ok:
+                    break
+                frame += 1
+                digest = hashlib.blake2b(img.tobytes(), digest_size=16).hexdigest()
+                yield frame, digest, (lambda img=img: img)
+        finally:
+            capture.release()
+    else:
+        pattern = sequence_pattern(path)
+        if pattern is None:
+            raise ValueError(f"No frame number in image sequence file name: {path}")
+        for frame, frame_path in sequence_frames_on_disk(pattern):
+            data = np.fromfile(frame_path, dtype=np.uint8)
+            digest = hashlib.blake2b(data.tobytes(), digest_size=16).hexdigest()
+            yield frame, digest, (lambda data=data, frame_path=frame_path: _decode_frame(data, flags, frame_path))
+
+def _decode_frame(data, flags, frame_path):
+    img = cv2.imdecode(data, flags)
+    if img is None:
+        raise ValueError(f"Could not decode image: {frame_path}")
+    return img
+
+def sequence_output_pattern(path, suffix, output_dir=None):
+    """tex.0001.png / clip.mp4 -> outputs/tex_normal.####.png"""
+    base_name = os.path.splitext(os.path.basename(path))[0]
+    base_name = _FRAME_NUMBER_RE.sub("", base_name).strip("._-") or "frame"
+    return os.path.join(output_dir or get_output_dir(), base_name + suffix + ".####.png")
+
+def process_image_sequence(path, scene, is_movie=False, max_workers=None, stats=None, output_dir=None):
+    """流式处理图像序列或影片纹理，输出编号的法线/位移序列
+
+    帧在多个线程间并行处理，同时在途的帧数有上限，内存占用与序列长度无关。
+    内容哈希与已处理帧相同的帧不再计算，直接复制已有的输出文件。
+    返回 (法线模式路径, 位移模式路径)，未生成的为空字符串。
+    """
+    import shutil
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    outputs = {}
+    if scene.distool_generate_normal:
+        outputs['normal'] = sequence_output_pattern(path, "_normal", output_dir)
+    if scene.distool_generate_displacement:
+        outputs['disp'] = sequence_output_pattern(path, "_disp", output_dir)
+    if not outputs:
+        return "", ""
+    for out_pattern in outputs.values():
+        os.makedirs(os.path.dirname(out_pattern), exist_ok=True)
+
+    max_workers = distool_threads.pool_size(max_workers)
+    max_in_flight = max_workers * 2
+
+    def process_frame(frame, decode, levels):
+        with stage("decode"):
+            img = decode()
+        maps = compute_maps(img, scene, levels=levels)
+        with stage("write"):
+            for kind, out_pattern in outputs.items():
+                out_path = sequence_frame_path(out_pattern, frame)
+                if not write_image(out_path, maps[kind]):
+                    raise OSError(f"Could not write image: {out_path}")
+
+    first_frames = {}   # 内容哈希 -> 第一次出现的帧号
+    duplicates = []     # (帧号, 内容相同的已处理帧号)
+    frame_count = 0
+    pending = set()
+    levels = None       # 自动色阶取自首帧并用于整个序列，避免逐帧估计造成的闪烁
+    with distool_threads.parallel_section(max_workers), ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for frame, digest, decode in _iter_source_frames(path, is_movie, decode_flags(scene)):
+            frame_count += 1
+            if digest in first_frames:
+                duplicates.append((frame, first_frames[digest]))
+                continue
+            first_frames[digest] = frame
+            if levels is None and uses_global_levels(scene):
+                with stage("decode"):
+                    img = decode()
+                levels = image_levels(img, scene)
+                decode = lambda img=img: img
+            # 背压：在途帧达到上限时等待，避免解码速度超过计算速度时内存无限增长
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(pool.submit(bind(process_frame), frame, decode, levels))
+        for future in pending:
+            future.result()
+
+    for frame, source_frame in duplicates:
+        for out_pattern in outputs.values():
+            shutil.copyfile(sequence_frame_path(out_pattern, source_frame), sequence_frame_path(out_pattern, frame))
+
+    if stats is not None:
+        stats.update(frames=frame_count, skipped=len(duplicates))
+
+    return outputs.get('normal', ""), outputs.get('disp', "")
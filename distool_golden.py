@@ -0,0 +1,336 @@
+"""
+Distool 金标准输出校验 / Distool Golden-Output Harness
+用参考实现在固定输入集和设置矩阵上生成金标准输出，并把任意后端或模式的结果与之逐像素比较
+Records reference outputs over a fixed input corpus and settings matrix, then compares any
+backend or mode against them with per-pixel error statistics and configurable tolerances
+
+用法 / Usage:
+    python distool_golden.py record golden/
+    python distool_golden.py compare golden/ --backend striped
+    python distool_golden.py compare golden/ --backend my_fast_path --max-abs 1 --mismatch 0.001
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+
+import cv2
+import numpy as np
+
+try:
+    from . import distool_core
+    from . import distool_tiled
+    from . import distool_benchmark
+except ImportError:
+    import distool_core
+    import distool_tiled
+    import distool_benchmark
+
+MANIFEST_NAME = "manifest.json"
+DEFAULT_SIZE = 256
+
+
+# ---------------------------------------------------------------------------
+# 输入集与设置矩阵 / Corpus and settings matrix
+# ---------------------------------------------------------------------------
+
+def build_corpus(size=DEFAULT_SIZE):
+    """固定种子的输入图像 {名称: BGR图像}
+
+    包含一张非正方形、尺寸不是2的幂的裁剪图，用于发现分块/金字塔实现的边界问题。
+    """
+    corpus = {name: make(size, seed=7) for name, make in distool_benchmark.INPUTS.items()}
+    terrain = corpus["terrain"]
+    corpus["terrain_odd"] = np.ascontiguousarray(terrain[: size * 3 // 4 + 1, : size - 3])
+    return corpus
+
+
+def build_settings_matrix():
+    """设置矩阵 {用例名: 覆盖项}
+
+    每种梯度算子跑一遍默认设置，再在 Sobel 上逐项改变单个设置，
+    最后每种算子各跑一个所有开关同时翻转的组合用例，用较少的用例覆盖每个分支。
+    """
+    matrix = {}
+    for gradient in distool_core.GRADIENT_OPERATORS:
+        matrix[f"{gradient.lower()}_default"] = {"distool_gradient_type": gradient}
+
+    variations = {
+        "invert_r": {"distool_invert_r": True},
+        "invert_g": {"distool_invert_g": True},
+        "invert_height": {"distool_invert_height": True},
+        "zrange_off": {"distool_zrange": False},
+        "gamma_off": {"distool_normal_gamma_correct": False},
+        "gamma_2": {"distool_normal_gamma": 2.0},
+        "blur_neg": {"distool_normal_blur": -4},
+        "blur_pos": {"distool_normal_blur": 4},
+        "level_6": {"distool_normal_level": 6.0},
+        "level_10": {"distool_normal_level": 10.0},
+        "smooth": {"distool_normal_smooth": 2.0},
+        "strength_high": {"distool_normal_strength": 8.0},
+        "disp_contrast_pos": {"distool_disp_contrast": 0.8},
+        "disp_sharpen": {"distool_disp_blur": -3},
+        "disp_blur": {"distool_disp_blur": 3},
+        "invert_disp": {"distool_invert_disp": True},
+    }
+    for name, overrides in variations.items():
+        matrix[f"sobel_{name}"] = dict(overrides, distool_gradient_type='SOBEL')
+
+    for gradient in distool_core.GRADIENT_OPERATORS:
+        matrix[f"{gradient.lower()}_combined"] = {
+            "distool_gradient_type": gradient,
+            "distool_invert_r": True,
+            "distool_invert_g": True,
+            "distool_invert_height": True,
+            "distool_zrange": False,
+            "distool_normal_gamma_correct": False,
+            "distool_normal_blur": -2,
+            "distool_disp_blur": -2,
+            "distool_invert_disp": True,
+        }
+    return matrix
+
+
+# ---------------------------------------------------------------------------
+# 后端 / Backends
+# ---------------------------------------------------------------------------
+
+# 后端签名：backend(img, image_path, scene) -> {'normal': BGR uint8, 'disp': uint8}
+BACKENDS = {}
+
+
+def register_backend(name):
+    """注册一个待校验的实现 / Register an implementation to check against the golden outputs"""
+    def decorator(func):
+        BACKENDS[name] = func
+        return func
+    return decorator
+
+
+@register_backend("reference")
+def _reference_backend(img, image_path, scene):
+    """插件原有的入口函数，金标准由它生成"""
+    return {
+        "normal": distool_core.generate_normal_map_from_texture(image_path, scene),
+        "disp": distool_core.convert_image_to_grayscale(image_path, scene),
+    }
+
+
+@register_backend("whole")
+def _whole_backend(img, image_path, scene):
+    """单次解码、共享灰度图的整幅管线 / Shared-decode whole-image pipeline"""
+    return distool_core.compute_maps(img, scene)
+
+
+@register_backend("striped")
+def _striped_backend(img, image_path, scene, strip_rows=64):
+    """带扩展边界的分条计算，结果在内存中拼接 / Halo-padded strips, stitched in memory"""
+    source = distool_tiled.DecodedImageSource(img)
+    halo = distool_core.compute_halo_radius(scene)
+    result = {}
+    for y0, y1, r0, r1 in distool_tiled.iter_strips(source.height, strip_rows, halo):
+        for kind, strip in distool_core.compute_maps(source.read_rows(r0, r1), scene).items():
+            if kind not in result:
+                result[kind] = np.empty((source.height,) + strip.shape[1:], dtype=strip.dtype)
+            result[kind][y0:y1] = strip[y0 - r0:y1 - r0]
+    return result
+
+
+@register_backend("process_image")
+def _process_image_backend(img, image_path, scene):
+    """端到端：写出PNG后重新读入 / End to end, including the PNG round trip"""
+    output_dir = tempfile.mkdtemp(prefix="distool_golden_")
+    try:
+        normal_path, disp_path = distool_core.process_image(image_path, scene, output_dir=output_dir)
+        return {
+            "normal": cv2.imread(normal_path, cv2.IMREAD_COLOR),
+            "disp": cv2.imread(disp_path, cv2.IMREAD_GRAYSCALE),
+        }
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+# ---------------------------------------------------------------------------
+# 误差统计 / Error statistics
+# ---------------------------------------------------------------------------
+
+class Tolerance:
+    """允许的误差 / Allowed error
+
+    max_abs: 单像素最大绝对误差（8位灰阶）
+    mean_abs: 平均绝对误差
+    mismatch: 存在差异的像素比例上限
+    max_angle: 法线最大夹角误差（度），None 表示不检查
+    """
+
+    def __init__(self, max_abs=0, mean_abs=0.0, mismatch=0.0, max_angle=None):
+        self.max_abs = max_abs
+        self.mean_abs = mean_abs
+        self.mismatch = mismatch
+        self.max_angle = max_angle
+
+    def violations(self, stats):
+        failed = []
+        if stats["max_abs"] > self.max_abs:
+            failed.append(f"max_abs {stats['max_abs']} > {self.max_abs}")
+        if stats["mean_abs"] > self.mean_abs:
+            failed.append(f"mean_abs {stats['mean_abs']:.4f} > {self.mean_abs}")
+        if stats["mismatch"] > self.mismatch:
+            failed.append(f"mismatch {stats['mismatch']:.4%} > {self.mismatch:.4%}")
+        angle = stats.get("max_angle_deg")
+        if self.max_angle is not None and angle is not None and angle > self.max_angle:
+            failed.append(f"max_angle {angle:.3f} > {self.max_angle}")
+        return failed
+
+
+def _decode_normals(img):
+    """BGR法线贴图解码为单位向量 / Decode a BGR normal map to unit vectors"""
+    vectors = img[..., ::-1].astype(np.float32) / 127.5 - 1.0
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=2, keepdims=True), 1e-8)
+
+
+def error_stats(expected, actual, is_normal=False):
+    """逐像素误差统计 / Per-pixel error statistics"""
+    if expected.shape != actual.shape:
+        raise ValueError(f"Shape mismatch: expected {expected.shape}, got {actual.shape}")
+    diff = np.abs(expected.astype(np.int32) - actual.astype(np.int32))
+    pixel_diff = diff.max(axis=2) if diff.ndim == 3 else diff
+    stats = {
+        "max_abs": int(diff.max()),
+        "mean_abs": float(diff.mean()),
+        "rmse": float(np.sqrt(np.mean(diff.astype(np.float64) ** 2))),
+        "mismatch": float(np.count_nonzero(pixel_diff) / pixel_diff.size),
+    }
+    if is_normal:
+        cos = np.sum(_decode_normals(expected) * _decode_normals(actual), axis=2)
+        stats["max_angle_deg"] = float(np.degrees(np.arccos(np.clip(cos.min(), -1.0, 1.0))))
+    if stats["max_abs"]:
+        y, x = np.unravel_index(np.argmax(pixel_diff), pixel_diff.shape)
+        stats["worst_pixel"] = [int(x), int(y)]
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# 记录与比较 / Record and compare
+# ---------------------------------------------------------------------------
+
+def _iter_cases(corpus, matrix, workdir):
+    """产出 (用例键, 图像, 图像路径, 设置, 覆盖项)"""
+    for input_name, img in corpus.items():
+        image_path = os.path.join(workdir, input_name + ".png")
+        cv2.imwrite(image_path, img)
+        for settings_name, overrides in matrix.items():
+            scene = distool_core.HeadlessSettings(**overrides)
+            yield f"{input_name}/{settings_name}", img, image_path, scene, overrides
+
+
+def _case_file(golden_dir, case):
+    return os.path.join(golden_dir, case.replace("/", "__") + ".npz")
+
+
+def record_golden(golden_dir, size=DEFAULT_SIZE, backend="reference", log=print):
+    """用参考实现生成金标准输出 / Record golden outputs with the reference implementation"""
+    os.makedirs(golden_dir, exist_ok=True)
+    corpus = build_corpus(size)
+    matrix = build_settings_matrix()
+    manifest = {"size": size, "backend": backend, "cases": {}}
+    workdir = tempfile.mkdtemp(prefix="distool_golden_")
+    try:
+        for case, img, image_path, scene, overrides in _iter_cases(corpus, matrix, workdir):
+            maps = BACKENDS[backend](img, image_path, scene)
+            np.savez_compressed(_case_file(golden_dir, case), **maps)
+            manifest["cases"][case] = overrides
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    with open(os.path.join(golden_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    log(f"Recorded {len(manifest['cases'])} cases with '{backend}' in {golden_dir}")
+    return manifest
+
+
+def compare_golden(golden_dir, backend, tolerance=None, log=print):
+    """把后端输出与金标准比较，返回 {用例键: {贴图类型: 统计}} 和失败列表
+
+    输入集按清单中记录的尺寸重新生成，设置取自清单，因此之后修改矩阵不会影响旧的金标准。
+    """
+    tolerance = tolerance or Tolerance()
+    with open(os.path.join(golden_dir, MANIFEST_NAME), encoding="utf-8") as f:
+        manifest = json.load(f)
+    corpus = build_corpus(manifest["size"])
+    matrix = {}
+    for case, overrides in manifest["cases"].items():
+        matrix.setdefault(case.split("/", 1)[1], overrides)
+    wanted = set(manifest["cases"])
+
+    results, failures = {}, []
+    workdir = tempfile.mkdtemp(prefix="distool_golden_")
+    try:
+        for case, img, image_path, scene, _ in _iter_cases(corpus, matrix, workdir):
+            if case not in wanted:
+                continue
+            golden = np.load(_case_file(golden_dir, case))
+            actual = BACKENDS[backend](img, image_path, scene)
+            results[case] = {}
+            for kind in golden.files:
+                if kind not in actual:
+                    failures.append((case, kind, ["output missing"]))
+                    continue
+                stats = error_stats(golden[kind], actual[kind], is_normal=(kind == "normal" and scene.distool_zrange))
+                results[case][kind] = stats
+                violations = tolerance.violations(stats)
+                if violations:
+                    failures.append((case, kind, violations))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for case, kind, violations in failures:
+        log(f"FAIL {case} [{kind}]: {'; '.join(violations)}")
+    log(f"{backend}: {len(results)} cases, {len(failures)} failures")
+    return results, failures
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Distool golden-output harness")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="record golden outputs")
+    record.add_argument("golden_dir")
+    record.add_argument("--size", type=int, default=DEFAULT_SIZE, help="corpus edge length")
+    record.add_argument("--backend", default="reference", choices=sorted(BACKENDS))
+
+    compare = commands.add_parser("compare", help="compare a backend against golden outputs")
+    compare.add_argument("golden_dir")
+    compare.add_argument("--backend", default="whole", choices=sorted(BACKENDS))
+    compare.add_argument("--max-abs", type=int, default=0, help="largest allowed per-pixel difference")
+    compare.add_argument("--mean-abs", type=float, default=0.0, help="largest allowed mean difference")
+    compare.add_argument("--mismatch", type=float, default=0.0, help="largest allowed fraction of differing pixels")
+    compare.add_argument("--max-angle", type=float, help="largest allowed normal angle error in degrees")
+    compare.add_argument("--json", help="write per-case statistics to this file")
+
+    commands.add_parser("backends", help="list registered backends")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "backends":
+        for name, func in sorted(BACKENDS.items()):
+            print(f"{name:<16} {(func.__doc__ or '').strip()}")
+        return 0
+
+    if args.command == "record":
+        record_golden(args.golden_dir, args.size, args.backend)
+        return 0
+
+    tolerance = Tolerance(args.max_abs, args.mean_abs, args.mismatch, args.max_angle)
+    results, failures = compare_golden(args.golden_dir, args.backend, tolerance)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Distool 增量更新 / Distool Incremental Regeneration
+按瓦片哈希找出源图像中变化的区域，只重新计算受影响的瓦片及滤波所需的邻域，结果拼回已有的输出
+Finds changed regions of the source by per-tile hashes, recomputes only the affected tiles plus the
+halo the filters need, and patches the results into the existing outputs
+
+与分条输出相同，各区域按 compute_halo_radius 扩展后计算再裁掉扩展部分，结果与整幅处理一致；
+附加贴图和 mip 链需要整幅统计，不做增量更新；从法线积分高度时每次都整幅重算。
+"""
+
+import hashlib
+import numpy as np
+from scipy import ndimage
+
+try:
+    from . import distool_core
+except ImportError:
+    import distool_core
+
+DEFAULT_TILE_SIZE = 64
+# 变化区域超过这个比例时直接整幅重算，重叠的邻域反而更慢
+FULL_UPDATE_FRACTION = 0.5
+
+
+def tile_hashes(img, tile_size=DEFAULT_TILE_SIZE):
+    """每个瓦片的 64 位内容哈希，返回 (瓦片行数, 瓦片列数) 的 uint64 数组"""
+    height, width = img.shape[:2]
+    rows = -(-height // tile_size)
+    cols = -(-width // tile_size)
+    hashes = np.empty((rows, cols), dtype=np.uint64)
+    for ty in range(rows):
+        band = img[ty * tile_size:(ty + 1) * tile_size]
+        for tx in range(cols):
+            tile = np.ascontiguousarray(band[:, tx * tile_size:(tx + 1) * tile_size])
+            hashes[ty, tx] = int.from_bytes(hashlib.blake2b(tile.data, digest_size=8).digest(), "little")
+    return hashes
+
+
+class IncrementalMaps:
+    """保存上一次的瓦片哈希和输出贴图，只为变化的区域重新运行管线
+
+    用法::
+
+        session = IncrementalMaps(scene)
+        for img in painted_versions:
+            regions = session.update(img)      # [(x0, y0, x1, y1), ...]
+            patch(session.maps, regions)
+
+    设置或图像尺寸变化时自动整幅重算。
+    """
+
+    def __init__(self, scene, tile_size=DEFAULT_TILE_SIZE):
+        self.scene = scene
+        self.tile_size = tile_size
+        self.maps = None
+        self.full_updates = 0
+        self.partial_updates = 0
+        self._hashes = None
+        self._shape = None
+        self._settings = None
+        self._levels = None
+
+    def reset(self):
+        self.maps = None
+
+    def update(self, img):
+        """根据新的源图像更新 self.maps，返回输出中被更新的区域列表 (x0, y0, x1, y1)"""
+        settings = distool_core.HeadlessSettings.from_scene(self.scene).as_dict()
+        hashes = tile_hashes(img, self.tile_size)
+        height, width = img.shape[:2]
+
+        if (self.maps is None or settings != self._settings or img.shape != self._shape
+                or distool_core.requires_whole_image(self.scene)):
+            regions = [(0, 0, width, height)]
+        else:
+            dirty = hashes != self._hashes
+            if not dirty.any():
+                return []
+            regions = self._dirty_regions(dirty, height, width)
+            if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions) > FULL_UPDATE_FRACTION * width * height:
+                regions = [(0, 0, width, height)]
+
+        if regions == [(0, 0, width, height)]:
+            # 自动色阶只在整幅重算时估计，局部更新沿用，避免每一笔都改变整幅的色阶
+            self._levels = distool_core.image_levels(img, self.scene)
+            self.maps = distool_core.compute_maps(img, self.scene, levels=self._levels)
+            self.full_updates += 1
+        else:
+            halo = distool_core.compute_halo_radius(self.scene)
+            for x0, y0, x1, y1 in regions:
+                cx0, cy0 = max(0, x0 - halo), max(0, y0 - halo)
+                cx1, cy1 = min(width, x1 + halo), min(height, y1 + halo)
+                patch = distool_core.compute_maps(img[cy0:cy1, cx0:cx1], self.scene, levels=self._levels)
+                for kind, output in self.maps.items():
+                    output[y0:y1, x0:x1] = patch[kind][y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0]
+            self.partial_updates += 1
+
+        self._hashes = hashes
+        self._shape = img.shape
+        self._settings = settings
+        return regions
+
+    def _dirty_regions(self, dirty, height, width):
+        """变化的瓦片按邻域半径膨胀后合并为连通区域 / Grow dirty tiles by the halo and merge them"""
+        halo = distool_core.compute_halo_radius(self.scene)
+        grow = -(-halo // self.tile_size)
+        if grow:
+            dirty = ndimage.binary_dilation(dirty, structure=np.ones((3, 3), dtype=bool), iterations=grow)
+        labels, _ = ndimage.label(dirty, structure=np.ones((3, 3), dtype=bool))
+        regions = []
+        for rows, cols in ndimage.find_objects(labels):
+            regions.append((cols.start * self.tile_size, rows.start * self.tile_size,
+                            min(width, cols.stop * self.tile_size), min(height, rows.stop * self.tile_size)))
+        return regions
@@ -9,193 +9,297 @@ bl_info = {
 }
 
 import bpy
+import bpy.utils.previews
 import os
-import cv2
-import numpy as np
-from scipy.ndimage import gaussian_filter
+import importlib
+import threading
+import contextlib
+from . import distool_profile
+from . import distool_threads
 
-def convert_image_to_grayscale(image_path, scene):
-    img = cv2.imread(image_path, cv2.IMREAD_COLOR)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype(np.float32)
-    
-    contrast = scene.distool_disp_contrast
-    gray = (gray - 127.5) * (1 + contrast) + 127.5
-    gray = np.clip(gray, 0, 255)
-    
-    blur_strength = scene.distool_disp_blur
-    if blur_strength != 0:
-        sigma = abs(blur_strength)
-        if blur_strength > 0:
-            gray = gaussian_filter(gray, sigma=sigma)
-        else:
-            blurred = gaussian_filter(gray, sigma=sigma)
-            gray = np.clip(2 * gray - blurred, 0, 255)
-    
-    if scene.distool_invert_disp:
-        gray = 255 - gray
-        
-    return gray.astype(np.uint8)
-def sobel_operator(height_map):
-    """使用Sobel算子计算梯度 - 修复Y轴方向"""
-    kernel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]], dtype=np.float32)
-    kernel_y = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]], dtype=np.float32)
-    
-    # 使用cv2.filter2D进行卷积
-    grad_x = cv2.filter2D(height_map, -1, kernel_x, borderType=cv2.BORDER_REPLICATE)
-    grad_y = cv2.filter2D(height_map, -1, kernel_y, borderType=cv2.BORDER_REPLICATE)
-    
-    # 修复：反转Y轴梯度以匹配OpenGL纹理坐标系
-    grad_y = -grad_y
-    
-    return grad_x, grad_y
 
-def prewitt_operator(height_map):
-    """使用Prewitt算子计算梯度 - 修复Y轴方向"""
-    kernel_x = np.array([[-1, 0, 1], [-1, 0, 1], [-1, 0, 1]], dtype=np.float32)
-    kernel_y = np.array([[-1, -1, -1], [0, 0, 0], [1, 1, 1]], dtype=np.float32)
-    
-    grad_x = cv2.filter2D(height_map, -1, kernel_x, borderType=cv2.BORDER_REPLICATE)
-    grad_y = cv2.filter2D(height_map, -1, kernel_y, borderType=cv2.BORDER_REPLICATE)
-    
-    # 修复：反转Y轴梯度以匹配OpenGL纹理坐标系
-    grad_y = -grad_y
-    
-    return grad_x, grad_y
+class _LazyModule:
+    """首次访问属性时才导入的模块 / A module imported on first attribute access
 
-def scharr_operator(height_map):
-    """使用Scharr算子计算梯度（更好的旋转对称性）- 修复Y轴方向"""
-    kernel_x = np.array([[-3, 0, 3], [-10, 0, 10], [-3, 0, 3]], dtype=np.float32)
-    kernel_y = np.array([[-3, -10, -3], [0, 0, 0], [3, 10, 3]], dtype=np.float32)
-    
-    grad_x = cv2.filter2D(height_map, -1, kernel_x, borderType=cv2.BORDER_REPLICATE)
-    grad_y = cv2.filter2D(height_map, -1, kernel_y, borderType=cv2.BORDER_REPLICATE)
-    
-    # 修复：反转Y轴梯度以匹配OpenGL纹理坐标系
-    grad_y = -grad_y
-    
-    return grad_x, grad_y
+    NumPy、SciPy、OpenCV、依赖它们的管线模块以及只在生成时用到的模块导入需要数百毫秒，不放在 Blender 启动路径上；
+    注册插件只需要 bpy，第一次生成时才真正导入。
+    """
 
-def enhance_details(height_map, detail_level, scene):
-    """多尺度细节增强"""
-    if detail_level <= 6.0:
-        return height_map
-    
-    # 创建多尺度金字塔
-    levels = int(detail_level - 5.0)
-    enhanced = height_map.copy()
-    
-    for i in range(levels):
-        # 计算当前尺度的细节
-        sigma = 2 ** i
-        blurred = gaussian_filter(height_map, sigma=sigma)
-        detail = height_map - blurred
-        
-        # 增强细节
-        detail_strength = scene.distool_normal_detail_strength if hasattr(scene, 'distool_normal_detail_strength') else 0.5
-        enhanced += detail * detail_strength * (1.0 / (i + 1))
-    
-    return np.clip(enhanced, 0, 1)
+    def __init__(self, name, package=None):
+        self._name = name
+        self._package = package
+        self._module = None
 
-def generate_normal_map_from_texture(image_path, scene):
-    """改进的法线贴图生成算法"""
-    # 转换为灰度图并归一化
-    gray = convert_image_to_grayscale(image_path, scene).astype(np.float32) / 255.0
-    
-    # 预处理：增强对比度
-    if hasattr(scene, 'distool_normal_gamma_correct') and scene.distool_normal_gamma_correct:
-        gamma = getattr(scene, 'distool_normal_gamma', 0.5)
-        gray = np.power(gray, gamma)
-    
-    # 应用高斯模糊控制细节级别
-    blur_sigma = max(0.1, abs(scene.distool_normal_blur) * 0.5 if scene.distool_normal_blur != 0 else 0.1)
-    height = gaussian_filter(gray, sigma=blur_sigma)
-    
-    # 多尺度细节增强
-    height = enhance_details(height, scene.distool_normal_level, scene)
-    
-    # 选择梯度算子
-    gradient_type = getattr(scene, 'distool_gradient_type', 'SOBEL')
-    if gradient_type == 'SOBEL':
-        grad_x, grad_y = sobel_operator(height)
-    elif gradient_type == 'PREWITT':
-        grad_x, grad_y = prewitt_operator(height)
-    elif gradient_type == 'SCHARR':
-        grad_x, grad_y = scharr_operator(height)
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name, self._package)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+cv2 = _LazyModule("cv2")
+np = _LazyModule("numpy")
+distool_core = _LazyModule(".distool_core", __package__)
+distool_batch = _LazyModule(".distool_batch", __package__)
+distool_tiled = _LazyModule(".distool_tiled", __package__)
+distool_raw = _LazyModule(".distool_raw", __package__)
+distool_metrics = _LazyModule(".distool_metrics", __package__)
+distool_service = _LazyModule(".distool_service", __package__)
+distool_watch = _LazyModule(".distool_watch", __package__)
+distool_stale = _LazyModule(".distool_stale", __package__)
+distool_incremental = _LazyModule(".distool_incremental", __package__)
+
+# 与 distool_core.EXTRA_MAP_TYPES 对应的场景属性；面板绘制时使用，不必导入管线
+EXTRA_MAP_PROPS = ("distool_generate_curvature", "distool_generate_cavity", "distool_generate_ao", "distool_generate_roughness")
+
+def heavy_modules_loaded():
+    """管线及其依赖是否已经导入 / Whether the pipeline and its dependencies have been imported"""
+    return distool_core._module is not None
+
+def load_generated_image(path):
+    """加载生成的贴图；<UDIM> 模式路径作为平铺图像加载，#### 模式路径作为图像序列加载
+
+    本会话中生成的贴图会带上源文件哈希和设置记录，供渲染前检查是否过期。
+    """
+    img = _load_image(path)
+    stamp = distool_stale.stamp_for_output(path)
+    if stamp:
+        _apply_stamp(img, stamp)
+    return img
+
+def _apply_stamp(image, stamp):
+    for key in distool_stale.STAMP_KEYS:
+        image[key] = stamp[key]
+
+def _load_image(path):
+    if distool_core.is_sequence_pattern(path):
+        frames = distool_core.sequence_frames_on_disk(path)
+        img = bpy.data.images.load(frames[0][1])
+        img.source = 'SEQUENCE'
+        return img
+
+    if distool_core.UDIM_TOKEN not in path:
+        return bpy.data.images.load(path)
+
+    numbers = distool_core.udim_tiles_on_disk(path)
+    img = bpy.data.images.load(distool_core.udim_tile_path(path, numbers[0]))
+    img.source = 'TILED'
+    img.filepath = path
+    for number in numbers[1:]:
+        if img.tiles.get(number) is None:
+            img.tiles.new(tile_number=number)
+    img.reload()
+    return img
+
+def _reload_generated_images(paths, stamp=None):
+    """已加载到 Blender 中的输出图像从磁盘重新读取，材质立即看到新贴图；给出 stamp 时同时更新记录"""
+    paths = {os.path.normcase(os.path.abspath(p)) for p in paths if p}
+    for image in bpy.data.images:
+        if image.source not in ('FILE', 'TILED', 'SEQUENCE'):
+            continue
+        path = bpy.path.abspath(image.filepath_raw)
+        if image.source == 'SEQUENCE':
+            # 序列图像保存的是某一帧的路径，输出记录的是 #### 模式
+            path = distool_core.sequence_pattern(path) or path
+        if os.path.normcase(os.path.abspath(path)) in paths:
+            image.reload()
+            if stamp:
+                _apply_stamp(image, stamp)
+
+# 面板预览：从缩小的结果生成图标，全分辨率图像只在应用到材质时才加载
+_previews = {"collection": None}
+PREVIEW_SIZE = 256
+
+def _preview_source_file(path):
+    """<UDIM> / #### 模式取第一个瓦片或帧"""
+    if distool_core.UDIM_TOKEN in path:
+        numbers = distool_core.udim_tiles_on_disk(path)
+        return distool_core.udim_tile_path(path, numbers[0]) if numbers else None
+    if distool_core.is_sequence_pattern(path):
+        frames = distool_core.sequence_frames_on_disk(path)
+        return frames[0][1] if frames else None
+    return path
+
+def make_thumbnail(array):
+    """把输出数组缩小到预览尺寸 / Downsample an output array to the preview size"""
+    height, width = array.shape[:2]
+    scale = PREVIEW_SIZE / max(height, width)
+    if scale >= 1.0:
+        return array
+    return cv2.resize(array, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+def read_thumbnails(normal_path, disp_path):
+    """读取输出文件并缩小，不访问 bpy 数据，可以在后台线程中调用；返回 {类型: 缩略图}"""
+    thumbnails = {}
+    for kind, path in (('normal', normal_path), ('disp', disp_path)):
+        path = _preview_source_file(path) if path else None
+        array = cv2.imread(path, cv2.IMREAD_UNCHANGED) if path and os.path.exists(path) else None
+        if array is None:
+            continue
+        if array.ndim == 3 and array.shape[2] == 4:
+            # RG 压缩法线被 OpenCV 读成 BGRA（X 复制到 BGR，Y 在 Alpha）
+            array = distool_core.unpack_rg_normal(array)
+        thumbnails[kind] = make_thumbnail(array)
+    return thumbnails
+
+def set_preview_icon(kind, array):
+    """用输出数组（BGR 或灰度）更新 kind 对应的预览图标 / Update the preview icon for a map kind"""
+    collection = _previews["collection"]
+    if collection is None or array is None:
+        return
+    if array.ndim == 3 and array.shape[2] == 2:
+        array = distool_core.unpack_rg_normal(array)
+    array = make_thumbnail(array)
+    height, width = array.shape[:2]
+    rgb = array[..., ::-1] if array.ndim == 3 else np.repeat(array[..., None], 3, axis=2)
+    rgba = np.ones((height, width, 4), dtype=np.float32)
+    rgba[..., :3] = rgb[::-1] / 255.0
+    preview = collection.get(kind) or collection.new(kind)
+    preview.image_size = (width, height)
+    preview.image_pixels_float.foreach_set(rgba.ravel())
+
+def update_preview_icons(thumbnails):
+    for kind, array in thumbnails.items():
+        set_preview_icon(kind, array)
+
+def preview_icon_id(kind):
+    collection = _previews["collection"]
+    preview = collection.get(kind) if collection is not None else None
+    return preview.icon_id if preview is not None else 0
+
+def prepare_node_job(node, scene):
+    """在主线程中收集生成任务所需的全部信息；设置复制为快照，后台运行期间修改面板不影响本次任务"""
+    image = node.image
+    img_path = bpy.path.abspath(image.filepath_raw)
+    if image.source == 'TILED' and distool_core.UDIM_TOKEN not in img_path:
+        # 文件路径里存的是某个具体瓦片，还原为 <UDIM> 模式
+        img_path = distool_core.udim_pattern_from_tile_path(img_path)
+    if image.source == 'TILED':
+        entry = 'udim'
+    elif image.source in ('SEQUENCE', 'MOVIE'):
+        entry = image.source.lower()
     else:
-        grad_x, grad_y = sobel_operator(height)  # 默认使用Sobel
-    
-    # 法线强度控制 - 修复：增加缩放因子
-    scale = scene.distool_normal_strength * 1.0  # 从0.1改为1.0
-    dx = grad_x * scale
-    dy = grad_y * scale
-    
-    # 构建法线向量 - 修复：正确的切线空间法线计算
-    # X轴：向右为正，Y轴：向下为正（OpenGL纹理坐标），Z轴：向外为正
-    dz = np.ones_like(dx)
-    
-    # 构建法线向量 - 修复Y轴方向（移除了错误的负号）
-    normal = np.stack((dx, dy, dz), axis=-1)
-    
-    # 归一化
-    length = np.linalg.norm(normal, axis=2, keepdims=True)
-    length = np.maximum(length, 1e-8)
-    normal = normal / length
-    
-    # 可选的法线平滑
-    if hasattr(scene, 'distool_normal_smooth') and scene.distool_normal_smooth > 0:
-        smooth_sigma = scene.distool_normal_smooth * 0.1
-        for i in range(3):  # 对每个通道进行平滑
-            normal[..., i] = gaussian_filter(normal[..., i], sigma=smooth_sigma)
-        # 重新归一化
-        length = np.linalg.norm(normal, axis=2, keepdims=True)
-        length = np.maximum(length, 1e-8)
-        normal = normal / length
-    
-    # 转换为RGB颜色空间 (切线空间标准)
-    normal_rgb = np.zeros_like(normal, dtype=np.float32)
-    normal_rgb[..., 0] = (normal[..., 0] * 0.5 + 0.5) * 255  # R: X轴
-    normal_rgb[..., 1] = (normal[..., 1] * 0.5 + 0.5) * 255  # G: Y轴  
-    normal_rgb[..., 2] = (normal[..., 2] * 0.5 + 0.5) * 255  # B: Z轴
-    
-    # 应用通道反转选项
-    if scene.distool_invert_r:
-        normal_rgb[..., 0] = 255 - normal_rgb[..., 0]
-    if scene.distool_invert_g:
-        normal_rgb[..., 1] = 255 - normal_rgb[..., 1]
-    if scene.distool_invert_height:
-        normal_rgb[..., 2] = 255 - normal_rgb[..., 2]
-    
-    # Z-Range选项 - 推荐：使用True获得标准法线贴图
-    if not scene.distool_zrange:
-        normal_rgb[..., 2] = height * 255
-    
-    # 关键修复：OpenCV使用BGR格式，需要将RGB转换为BGR
-    normal_rgb = cv2.cvtColor(normal_rgb.astype(np.uint8), cv2.COLOR_RGB2BGR)
-    
-    return np.clip(normal_rgb, 0, 255).astype(np.uint8)
+        entry = 'striped' if scene.distool_stream_output else 'single'
+    prefs = get_preferences()
+    return {
+        "entry": entry,
+        "path": img_path,
+        "label": image.name,
+        "settings": distool_core.HeadlessSettings.from_scene(scene),
+        "tile_numbers": [tile.number for tile in image.tiles] if entry == 'udim' else [],
+        "output_dir": distool_core.get_output_dir(),
+        "use_service": bool(prefs and prefs.use_worker_service),
+    }
+
+def run_node_job(task, extra_paths=None, listener=None):
+    """运行生成任务，不访问 bpy 数据，可以在后台线程中调用
 
+    返回 (法线路径, 位移路径, 全部输出路径, 预览缩略图)。
 
-def process_image(image_path, scene):
-    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    listener 传给 distool_profile.profile_run，在每个阶段开始前调用。
+    源文件指纹在读取之前计算并存入 task["fingerprint"]，finish_node_job 用它创建记录。
+    """
+    entry, img_path, settings, output_dir = task["entry"], task["path"], task["settings"], task["output_dir"]
+    task["fingerprint"] = distool_stale.fingerprint(img_path, entry)
+    with distool_metrics.track_job(entry, img_path, settings) as job, \
+            distool_profile.profile_run(task["label"], listener=listener) as profile:
+        job["profile"] = profile
+        if entry == 'udim':
+            normal_path, disp_path = distool_core.process_udim_image(img_path, task["tile_numbers"], settings, output_dir=output_dir)
+        elif entry in ('sequence', 'movie'):
+            stats = {}
+            normal_path, disp_path = distool_core.process_image_sequence(img_path, settings, is_movie=entry == 'movie', stats=stats, output_dir=output_dir)
+            # 内容重复的帧直接复用输出，记为缓存命中
+            job["cache"] = {"hits": stats.get("skipped", 0), "misses": stats.get("frames", 0) - stats.get("skipped", 0)}
+        elif entry == 'striped':
+            normal_path, disp_path = distool_tiled.process_image_striped(img_path, settings, output_dir, strip_rows=settings.distool_strip_rows)
+        else:
+            # 启用常驻服务时交给服务处理，服务未运行则在本进程内执行
+            stats = {}
+            normal_path, disp_path = distool_service.process_image(img_path, settings, extra_paths, output_dir, use_service=task["use_service"], stats=stats)
+            job["cache"] = stats.get("cache")
+        job["outputs"] = [normal_path, disp_path] + list((extra_paths or {}).values())
+    return normal_path, disp_path, job["outputs"], read_thumbnails(normal_path, disp_path)
+
+def finish_node_job(scene, task, normal_path, disp_path, outputs, thumbnails):
+    """在主线程中记录结果并更新预览图标"""
+    # 记录源文件哈希和设置；已在材质中使用的同名贴图重新读取并更新记录
+    stamp = distool_stale.make_stamp(task["path"], task["entry"], task["settings"], task["output_dir"], task["fingerprint"])
+    distool_stale.register_outputs(outputs, stamp)
+    _reload_generated_images(outputs, stamp)
+
+    scene.distool_generated_normal = normal_path or ""
+    scene.distool_generated_disp = disp_path or ""
+    update_preview_icons(thumbnails)
+
+    scene.distool_applied = False
+    return normal_path, disp_path
 
-   
-    addon_dir = os.path.dirname(os.path.abspath(__file__))
-    output_dir = os.path.join(addon_dir, "outputs")
-    os.makedirs(output_dir, exist_ok=True)
+def generate_for_node(node, scene, extra_paths=None):
+    """为图像纹理节点生成贴图，UDIM 图像按瓦片集处理"""
+    task = prepare_node_job(node, scene)
+    return finish_node_job(scene, task, *run_node_job(task, extra_paths))
 
-    normal_path = os.path.join(output_dir, base_name + "_normal.png")
-    disp_path = os.path.join(output_dir, base_name + "_disp.png")
+def _setup_image_user(tex, path):
+    """图像序列需要设置帧数并自动刷新"""
+    if tex.image.source == 'SEQUENCE':
+        tex.image_user.frame_duration = len(distool_core.sequence_frames_on_disk(path))
+        tex.image_user.use_auto_refresh = True
 
-    if scene.distool_generate_normal:
-        normal_img = generate_normal_map_from_texture(image_path, scene)
-        cv2.imwrite(normal_path, normal_img)
+def _is_packed_normal_file(path):
+    """PNG 颜色类型为 灰度+Alpha 时是 RG 压缩法线"""
+    path = _preview_source_file(path)
+    try:
+        with open(path, "rb") as f:
+            header = f.read(26)
+    except (OSError, TypeError):
+        return False
+    return len(header) == 26 and header[:8] == b"\x89PNG\r\n\x1a\n" and header[25] == 4
 
-    if scene.distool_generate_displacement:
-        disp_img = convert_image_to_grayscale(image_path, scene)
-        cv2.imwrite(disp_path, disp_img)
+def _build_normal_z_reconstruction(nodes, links, tex):
+    """RG 压缩法线：X 在颜色（灰度）、Y 在 Alpha，重建 Z = sqrt(1 - X² - Y²)，返回可接入法线贴图节点的输出"""
+    tex.image.alpha_mode = 'CHANNEL_PACKED'
+    separate = nodes.new("ShaderNodeSeparateColor")
+    links.new(tex.outputs["Color"], separate.inputs["Color"])
 
-    return normal_path if scene.distool_generate_normal else "", disp_path if scene.distool_generate_displacement else ""
+    def to_signed(socket):
+        node = nodes.new("ShaderNodeMath")
+        node.operation = 'MULTIPLY_ADD'
+        node.inputs[1].default_value = 2.0
+        node.inputs[2].default_value = -1.0
+        links.new(socket, node.inputs[0])
+        return node.outputs["Value"]
 
+    x = to_signed(separate.outputs["Red"])
+    y = to_signed(tex.outputs["Alpha"])
+    xy = nodes.new("ShaderNodeCombineXYZ")
+    links.new(x, xy.inputs["X"])
+    links.new(y, xy.inputs["Y"])
+    dot = nodes.new("ShaderNodeVectorMath")
+    dot.operation = 'DOT_PRODUCT'
+    links.new(xy.outputs["Vector"], dot.inputs[0])
+    links.new(xy.outputs["Vector"], dot.inputs[1])
+    remainder = nodes.new("ShaderNodeMath")
+    remainder.operation = 'SUBTRACT'
+    remainder.inputs[0].default_value = 1.0
+    links.new(dot.outputs["Value"], remainder.inputs[1])
+    # 负数的平方根在 Blender 中为 0
+    z = nodes.new("ShaderNodeMath")
+    z.operation = 'SQRT'
+    links.new(remainder.outputs["Value"], z.inputs[0])
+    xyz = nodes.new("ShaderNodeCombineXYZ")
+    links.new(x, xyz.inputs["X"])
+    links.new(y, xyz.inputs["Y"])
+    links.new(z.outputs["Value"], xyz.inputs["Z"])
+    # [-1, 1] -> [0, 1]，与普通法线贴图的颜色一致
+    encode = nodes.new("ShaderNodeVectorMath")
+    encode.operation = 'MULTIPLY_ADD'
+    encode.inputs[1].default_value = (0.5, 0.5, 0.5)
+    encode.inputs[2].default_value = (0.5, 0.5, 0.5)
+    links.new(xyz.outputs["Vector"], encode.inputs[0])
+    return encode.outputs["Vector"]
 
 def apply_maps_to_material(context, normal_path, disp_path, strength):
     mat = context.object.active_material
@@ -207,21 +311,26 @@ def apply_maps_to_material(context, normal_path, disp_path, strength):
 
     if normal_path:
         tex = nodes.new("ShaderNodeTexImage")
-        tex.image = bpy.data.images.load(normal_path)
+        tex.image = load_generated_image(normal_path)
         tex.image.colorspace_settings.name = 'Non-Color'
         tex.label = "Distool Normal Map"
+        _setup_image_user(tex, normal_path)
         norm = nodes.new("ShaderNodeNormalMap")
         norm.inputs["Strength"].default_value = strength
-        links.new(tex.outputs["Color"], norm.inputs["Color"])
+        if _is_packed_normal_file(normal_path):
+            links.new(_build_normal_z_reconstruction(nodes, links, tex), norm.inputs["Color"])
+        else:
+            links.new(tex.outputs["Color"], norm.inputs["Color"])
         bsdf = next((n for n in nodes if n.type == "BSDF_PRINCIPLED"), None)
         if bsdf:
             links.new(norm.outputs["Normal"], bsdf.inputs["Normal"])
 
     if disp_path:
         tex = nodes.new("ShaderNodeTexImage")
-        tex.image = bpy.data.images.load(disp_path)
+        tex.image = load_generated_image(disp_path)
         tex.image.colorspace_settings.name = 'Non-Color'
         tex.label = "Distool Displacement Map"
+        _setup_image_user(tex, disp_path)
         disp = nodes.new("ShaderNodeDisplacement")
         disp.inputs["Scale"].default_value = 0.1
         links.new(tex.outputs["Color"], disp.inputs["Height"])
@@ -229,34 +338,405 @@ def apply_maps_to_material(context, normal_path, disp_path, strength):
         if out:
             links.new(disp.outputs["Displacement"], out.inputs["Displacement"])
 
-    context.scene.distool_preview_normal = None
-    context.scene.distool_preview_disp = None
+
+# 后台生成：同一时间只运行一个；记录每个源上次运行的阶段数，用于估计进度
+_background_job = {"running": False}
+_stage_counts = {}
+STAGES_PER_IMAGE = 12
+
+def _estimate_stage_count(task, image):
+    known = _stage_counts.get((task["entry"], task["path"]))
+    if known:
+        return known
+    entry = task["entry"]
+    if entry == 'udim':
+        return STAGES_PER_IMAGE * max(1, len(task["tile_numbers"]))
+    if entry in ('sequence', 'movie'):
+        return STAGES_PER_IMAGE * max(1, image.frame_duration)
+    if entry == 'striped':
+        return STAGES_PER_IMAGE * max(1, -(-image.size[1] // task["settings"].distool_strip_rows))
+    return STAGES_PER_IMAGE
+
+def _no_background_job(context):
+    """后台生成运行时其他生成按钮不可用 / Other generators wait for the background job"""
+    return not _background_job["running"]
 
 class DISTOOL_OT_GenerateSingle(bpy.types.Operator):
     bl_idname = "distool.generate_single"
     bl_label = "Generate Maps from Selected Node"
+    bl_description = "Generate maps in the background with progress; press Esc to cancel"
+
+    @classmethod
+    def poll(cls, context):
+        return _no_background_job(context)
 
     def execute(self, context):
         node = context.active_node
         scene = context.scene
         if node and node.type == 'TEX_IMAGE' and node.image:
-            img_path = bpy.path.abspath(node.image.filepath_raw)
-            normal_path, disp_path = process_image(img_path, scene)
-            scene.distool_generated_normal = normal_path or ""
-            scene.distool_generated_disp = disp_path or ""
+            extra_paths = {}
+            generate_for_node(node, scene, extra_paths)
 
-            if normal_path:
-                scene.distool_preview_normal = bpy.data.images.load(normal_path)
-            if disp_path:
-                scene.distool_preview_disp = bpy.data.images.load(disp_path)
-
-            scene.distool_applied = False
+            if extra_paths:
+                self.report({'INFO'}, "Extra maps saved: " + ", ".join(os.path.basename(p) for p in extra_paths.values()))
 
             return {'FINISHED'}
         else:
             self.report({'ERROR'}, "Select an image texture node with a valid image.")
             return {'CANCELLED'}
 
+    def invoke(self, context, event):
+        """从界面调用时在后台线程生成，界面保持响应；在两个阶段之间检查 Esc 取消"""
+        node = context.active_node
+        if not node or node.type != 'TEX_IMAGE' or not node.image:
+            self.report({'ERROR'}, "Select an image texture node with a valid image.")
+            return {'CANCELLED'}
+        if _background_job["running"]:
+            self.report({'WARNING'}, "Distool is already generating maps.")
+            return {'CANCELLED'}
+
+        self._task = prepare_node_job(node, context.scene)
+        self._extra_paths = {}
+        self._state = {"done": 0, "total": _estimate_stage_count(self._task, node.image),
+                       "cancel": False, "cancelled": False, "result": None, "error": None}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        _background_job["running"] = True
+        self._thread.start()
+
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        self._timer = wm.event_timer_add(0.1, window=context.window)
+        wm.modal_handler_add(self)
+        self.report({'INFO'}, f"Generating maps for {node.image.name} (Esc to cancel)")
+        return {'RUNNING_MODAL'}
+
+    def _run(self):
+        state = self._state
+
+        def listener(name):
+            if state["cancel"]:
+                raise distool_profile.Cancelled()
+            if name is not None:
+                state["done"] += 1
+
+        try:
+            state["result"] = run_node_job(self._task, self._extra_paths, listener)
+        except distool_profile.Cancelled:
+            state["cancelled"] = True
+        except Exception as e:
+            state["error"] = f"{type(e).__name__}: {e}"
+
+    def modal(self, context, event):
+        state = self._state
+        if event.type == 'ESC' and event.value == 'PRESS':
+            # 当前阶段结束后停止
+            state["cancel"] = True
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        if self._thread.is_alive():
+            context.window_manager.progress_update(min(99, 100 * state["done"] // max(1, state["total"])))
+            return {'PASS_THROUGH'}
+
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        _background_job["running"] = False
+
+        if state["cancelled"]:
+            self.report({'WARNING'}, "Map generation cancelled")
+            return {'CANCELLED'}
+        if state["error"]:
+            self.report({'ERROR'}, state["error"])
+            return {'CANCELLED'}
+        _stage_counts[(self._task["entry"], self._task["path"])] = state["done"]
+        finish_node_job(context.scene, self._task, *state["result"])
+        if self._extra_paths:
+            self.report({'INFO'}, "Extra maps saved: " + ", ".join(os.path.basename(p) for p in self._extra_paths.values()))
+        return {'FINISHED'}
+
+    def cancel(self, context):
+        """Blender 强制结束模态操作时（关闭窗口、载入文件）调用：通知后台线程停止并清理 / Called when Blender aborts the modal operator"""
+        self._state["cancel"] = True
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        _background_job["running"] = False
+
+class DISTOOL_OT_GenerateBatch(bpy.types.Operator):
+    bl_idname = "distool.generate_batch"
+    bl_label = "Generate Maps for All Image Nodes"
+    bl_description = "Generate maps for every single-file image texture in the active material"
+
+    @classmethod
+    def poll(cls, context):
+        return _no_background_job(context)
+
+    def execute(self, context):
+        mat = context.object.active_material if context.object else None
+        if not mat or not mat.use_nodes:
+            self.report({'ERROR'}, "The active object has no node material.")
+            return {'CANCELLED'}
+
+        paths = []
+        for node in mat.node_tree.nodes:
+            if node.type == 'TEX_IMAGE' and node.image and node.image.source == 'FILE' and not node.label.startswith("Distool"):
+                path = bpy.path.abspath(node.image.filepath_raw)
+                if path and path not in paths:
+                    paths.append(path)
+        if not paths:
+            self.report({'ERROR'}, "No image texture nodes with image files found.")
+            return {'CANCELLED'}
+
+        # 读取和写出线程不能访问 bpy 数据，传入设置快照
+        with distool_profile.profile_run(mat.name):
+            report = distool_batch.run_batch(paths, distool_core.HeadlessSettings.from_scene(context.scene))
+        print("[Distool] Batch finished:\n" + report.summary())
+        level = {'WARNING'} if report.errors else {'INFO'}
+        self.report(level, report.summary().splitlines()[0] + (f", {len(report.errors)} failed" if report.errors else ""))
+        return {'FINISHED'}
+
+# 监视文件夹：由 bpy.app.timers 周期性轮询，生成在主线程中进行
+_watch_state = {"watcher": None, "interval": 2.0}
+
+def _watch_tick():
+    watcher = _watch_state["watcher"]
+    if watcher is None:
+        return None
+    try:
+        report = watcher.step(distool_core.HeadlessSettings.from_scene(bpy.context.scene))
+    except Exception as e:
+        print(f"[Distool] Watch folder stopped: {e}")
+        _watch_state["watcher"] = None
+        return None
+    if report is not None:
+        print("[Distool] Watch folder update:\n" + report.summary())
+        _reload_generated_images(p for paths in report.outputs.values() for p in paths)
+    return _watch_state["interval"]
+
+def stop_watching():
+    _watch_state["watcher"] = None
+    if bpy.app.timers.is_registered(_watch_tick):
+        bpy.app.timers.unregister(_watch_tick)
+
+class DISTOOL_OT_ToggleWatch(bpy.types.Operator):
+    bl_idname = "distool.toggle_watch"
+    bl_label = "Watch Folder"
+    bl_description = "Regenerate maps whenever images in the watched folder change; unchanged files are skipped, also after a restart"
+
+    def execute(self, context):
+        scene = context.scene
+        if _watch_state["watcher"] is not None:
+            stop_watching()
+            self.report({'INFO'}, "Stopped watching folder")
+            return {'FINISHED'}
+
+        folder = bpy.path.abspath(scene.distool_watch_folder)
+        if not folder or not os.path.isdir(folder):
+            self.report({'ERROR'}, "Choose an existing folder to watch.")
+            return {'CANCELLED'}
+        _watch_state["watcher"] = distool_watch.FolderWatcher(folder, settle=scene.distool_watch_interval)
+        _watch_state["interval"] = scene.distool_watch_interval
+        bpy.app.timers.register(_watch_tick, first_interval=0.1, persistent=True)
+        self.report({'INFO'}, f"Watching {folder}")
+        return {'FINISHED'}
+
+# 绘制时实时更新：定时读取正在绘制的图像，只重新计算变化的瓦片并写入已加载的输出图像
+_live_state = {"image": None, "session": None, "buffers": {}}
+LIVE_PAINT_INTERVAL = 0.25
+
+def _image_to_bgr(image):
+    """Blender 图像像素（浮点 RGBA，自下而上）-> 与 cv2.imread 相同的 8 位 BGR 数组"""
+    width, height = image.size
+    channels = image.channels
+    pixels = np.empty(width * height * channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(height, width, channels)[::-1]
+    rgb = pixels[..., :3] if channels >= 3 else np.repeat(pixels[..., :1], 3, axis=2)
+    return np.ascontiguousarray((np.clip(rgb, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)[..., ::-1])
+
+def _live_targets(scene):
+    """已加载的输出图像：(类型, 输出路径, 图像)"""
+    targets = []
+    for kind, path in (('normal', scene.distool_generated_normal), ('disp', scene.distool_generated_disp)):
+        if not path:
+            continue
+        path = os.path.normcase(os.path.abspath(path))
+        for image in bpy.data.images:
+            if image.source == 'FILE' and os.path.normcase(os.path.abspath(bpy.path.abspath(image.filepath_raw))) == path:
+                targets.append((kind, path, image))
+    return targets
+
+def _patch_image(image, output, regions):
+    """把输出数组中的若干区域写入 Blender 图像 / Copy regions of an output array into a Blender image"""
+    width, height = image.size
+    if output.shape[:2] != (height, width):
+        return
+    buffer = _live_state["buffers"].get(image.name)
+    if buffer is None or buffer.size != width * height * image.channels:
+        buffer = np.empty(width * height * image.channels, dtype=np.float32)
+        image.pixels.foreach_get(buffer)
+        _live_state["buffers"][image.name] = buffer
+    pixels = buffer.reshape(height, width, image.channels)
+    channels = min(3, image.channels)
+    scale = 65535.0 if output.dtype == np.uint16 else 255.0
+    for x0, y0, x1, y1 in regions:
+        region = output[y0:y1, x0:x1].astype(np.float32) / scale
+        # Blender 的行序自下而上
+        rows = slice(height - y1, height - y0)
+        if region.ndim == 3 and region.shape[2] == 2:
+            # RG 压缩法线按 灰度+Alpha 加载：X 在 RGB，Y 在 Alpha
+            pixels[rows, x0:x1, :channels] = region[::-1, :, :1]
+            if image.channels == 4:
+                pixels[rows, x0:x1, 3] = region[::-1, :, 1]
+            continue
+        # BGR -> RGB，灰度复制到三个通道
+        rgb = region[..., ::-1] if region.ndim == 3 else np.repeat(region[..., None], 3, axis=2)
+        pixels[rows, x0:x1, :channels] = rgb[::-1, :, :channels]
+    image.pixels.foreach_set(buffer)
+    image.update()
+
+def _show_live_result(scene, regions):
+    """更新预览图标和材质中已加载的输出图像"""
+    maps = _live_state["session"].maps
+    for kind, array in maps.items():
+        set_preview_icon(kind, array)
+    for kind, _, target in _live_targets(scene):
+        if kind in maps:
+            _patch_image(target, maps[kind], regions)
+
+def _live_paint_tick():
+    image = _live_state["image"]
+    if image is None:
+        return None
+    try:
+        regions = _live_state["session"].update(_image_to_bgr(image))
+        if regions:
+            _show_live_result(bpy.context.scene, regions)
+    except ReferenceError:
+        # 正在绘制的图像已被删除
+        stop_live_paint(save=False)
+        return None
+    except Exception as e:
+        # 管线出错（或被其他任务取消）时结束会话，不让定时器带着异常退出而会话仍标记为进行中
+        print(f"[Distool] Live update stopped: {type(e).__name__}: {e}")
+        stop_live_paint(save=False)
+        return None
+    return LIVE_PAINT_INTERVAL
+
+def stop_live_paint(save=True):
+    """停止实时更新；save 为 True 时把最终结果写回输出文件"""
+    session = _live_state["session"]
+    if bpy.app.timers.is_registered(_live_paint_tick):
+        bpy.app.timers.unregister(_live_paint_tick)
+    if save and session is not None and session.maps is not None:
+        scene = bpy.context.scene
+        paths = []
+        for kind, path in (('normal', scene.distool_generated_normal), ('disp', scene.distool_generated_disp)):
+            if path and kind in session.maps:
+                distool_core.write_image(path, session.maps[kind])
+                paths.append(path)
+        _reload_generated_images(paths)
+    _live_state.update(image=None, session=None, buffers={})
+
+class DISTOOL_OT_ToggleLivePaint(bpy.types.Operator):
+    bl_idname = "distool.toggle_live_paint"
+    bl_label = "Live Update While Painting"
+    bl_description = "Update the generated maps while painting on the selected image, recomputing only the tiles the brush changed; the maps are saved when stopped"
+
+    @classmethod
+    def poll(cls, context):
+        # 停止总是可用 / Stopping is always allowed
+        return _live_state["session"] is not None or _no_background_job(context)
+
+    def execute(self, context):
+        if _live_state["session"] is not None:
+            stop_live_paint()
+            self.report({'INFO'}, "Live update stopped, maps saved")
+            return {'FINISHED'}
+
+        node = context.active_node
+        scene = context.scene
+        if not node or node.type != 'TEX_IMAGE' or not node.image or node.image.source not in ('FILE', 'GENERATED'):
+            self.report({'ERROR'}, "Select an image texture node with a single image.")
+            return {'CANCELLED'}
+        # 第一遍生成和源文件记录都从磁盘读取，未保存的新图像没有文件
+        if not os.path.isfile(bpy.path.abspath(node.image.filepath_raw)):
+            self.report({'ERROR'}, "Save the image to a file before starting live update.")
+            return {'CANCELLED'}
+        if not (scene.distool_generate_normal or scene.distool_generate_displacement):
+            self.report({'ERROR'}, "Enable the normal or displacement map first.")
+            return {'CANCELLED'}
+        if not (scene.distool_generated_normal or scene.distool_generated_disp):
+            generate_for_node(node, scene)
+
+        session = distool_incremental.IncrementalMaps(scene)
+        _live_state.update(image=node.image, session=session, buffers={})
+        _show_live_result(scene, session.update(_image_to_bgr(node.image)))
+        bpy.app.timers.register(_live_paint_tick, first_interval=LIVE_PAINT_INTERVAL)
+        self.report({'INFO'}, f"Live update for {node.image.name}")
+        return {'FINISHED'}
+
+class DISTOOL_OT_GenerateFromRaw(bpy.types.Operator):
+    bl_idname = "distool.generate_from_raw"
+    bl_label = "Generate from Raw Height Field"
+    bl_description = "Generate maps from a .r16/.raw/.npy height field without 8-bit conversion"
+
+    filepath: bpy.props.StringProperty(subtype='FILE_PATH')
+    filter_glob: bpy.props.StringProperty(default="*.r16;*.raw;*.npy", options={'HIDDEN'})
+    dtype: bpy.props.EnumProperty(
+        name="Sample Type",
+        items=[
+            ('uint16', "16-bit Unsigned", ""),
+            ('uint8', "8-bit Unsigned", ""),
+            ('float32', "32-bit Float", ""),
+        ],
+        default='uint16',
+    )
+    byteorder: bpy.props.EnumProperty(
+        name="Byte Order",
+        items=[('little', "Little Endian", ""), ('big', "Big Endian", "")],
+        default='little',
+    )
+    width: bpy.props.IntProperty(name="Width", description="0 = infer a square size from the file", min=0, default=0)
+    height: bpy.props.IntProperty(name="Height", description="0 = infer a square size from the file", min=0, default=0)
+
+    @classmethod
+    def poll(cls, context):
+        return _no_background_job(context)
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        scene = context.scene
+        path = bpy.path.abspath(self.filepath)
+        if os.path.splitext(path)[1].lower() not in distool_raw.RAW_EXTENSIONS:
+            self.report({'ERROR'}, "Select a .r16, .raw or .npy height field.")
+            return {'CANCELLED'}
+        try:
+            with distool_metrics.track_job('raw', path, scene) as job, distool_profile.profile_run(os.path.basename(path)) as profile:
+                job["profile"] = profile
+                normal_path, disp_path = distool_raw.process_raw_heightfield(
+                    path, scene, strip_rows=scene.distool_strip_rows, dtype=self.dtype,
+                    byteorder=self.byteorder, width=self.width, height=self.height)
+                job["outputs"] = [normal_path, disp_path]
+        except (ValueError, OSError) as e:
+            # 格式不符，或文件无法读取/写出
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        # 原始格式的位移贴图无法作为 Blender 图像加载，只报告路径
+        scene.distool_generated_normal = normal_path or ""
+        scene.distool_generated_disp = ""
+        update_preview_icons(read_thumbnails(normal_path, ""))
+        scene.distool_applied = False
+        if disp_path:
+            self.report({'INFO'}, f"Displacement written to {disp_path}")
+        return {'FINISHED'}
+
 class DISTOOL_OT_ApplyMaps(bpy.types.Operator):
     bl_idname = "distool.apply_maps"
     bl_label = "Apply Maps to Material"
@@ -277,18 +757,51 @@ class DISTOOL_PT_Panel(bpy.types.Panel):
         layout = self.layout
         scene = context.scene
 
+        # 高度来源：图像亮度，或从法线贴图积分
+        row = layout.row(align=True)
+        row.prop(scene, "distool_height_source", text="Height From")
+        if scene.distool_height_source == 'NORMAL_MAP':
+            row.prop(scene, "distool_source_flip_g", text="", icon='ARROW_LEFTRIGHT')
+
         layout.prop(scene, "distool_generate_normal")
         layout.prop(scene, "distool_generate_displacement")
         
         if scene.distool_generate_displacement:  
             box = layout.box()
             box.label(text="Displacement Map Settings:")
-            box.prop(scene, "distool_disp_contrast")
+            box.prop(scene, "distool_disp_auto_levels")
+            if scene.distool_disp_auto_levels:
+                box.prop(scene, "distool_disp_levels_clip")
+            else:
+                box.prop(scene, "distool_disp_contrast")
             box.prop(scene, "distool_disp_blur")
             box.prop(scene, "distool_invert_disp")
 
         layout.prop(scene, "distool_use_subfolder")
 
+        # 附加贴图（与法线贴图共享中间结果）
+        box = layout.box()
+        box.label(text="Extra Maps:")
+        row = box.row()
+        row.prop(scene, "distool_generate_curvature")
+        row.prop(scene, "distool_generate_cavity")
+        row = box.row()
+        row.prop(scene, "distool_generate_ao")
+        row.prop(scene, "distool_generate_roughness")
+
+        # Mip链 / 多级LOD输出
+        box = layout.box()
+        box.prop(scene, "distool_generate_mips")
+        if scene.distool_generate_mips:
+            box.prop(scene, "distool_mip_min_size")
+
+        # 低内存分条输出
+        box = layout.box()
+        box.prop(scene, "distool_stream_output")
+        if scene.distool_stream_output:
+            box.prop(scene, "distool_strip_rows")
+            box.label(text="Extra maps and mip chain are skipped", icon='INFO')
+
         if scene.distool_generate_normal:
             box = layout.box()
             box.label(text="Normal Map Settings:")
@@ -325,36 +838,252 @@ class DISTOOL_PT_Panel(bpy.types.Panel):
             row = channel_box.row()
             row.prop(scene, "distool_invert_r")
             row.prop(scene, "distool_invert_g")
-            channel_box.prop(scene, "distool_invert_height")
-            channel_box.prop(scene, "distool_zrange")
+            channel_box.prop(scene, "distool_normal_format")
+            if scene.distool_normal_format == 'RGB':
+                channel_box.prop(scene, "distool_invert_height")
+                channel_box.prop(scene, "distool_zrange")
 
         layout.separator()
 
         node = context.active_node
-        if(scene.distool_generate_normal or scene.distool_generate_displacement):
+        if(scene.distool_generate_normal or scene.distool_generate_displacement
+                or any(getattr(scene, prop) for prop in EXTRA_MAP_PROPS)):
             if node and node.type == 'TEX_IMAGE' and node.image:
                 layout.operator("distool.generate_single")
+                live = _live_state["session"] is not None
+                layout.operator("distool.toggle_live_paint", text="Stop Live Update" if live else "Live Update While Painting",
+                                icon='BRUSH_DATA', depress=live)
             else:
                 layout.label(text="(Select an Image Texture Node)", icon='INFO')
+            layout.operator("distool.generate_batch", icon='RENDERLAYERS')
+            layout.operator("distool.generate_from_raw", icon='FILE_BLANK')
+
+            # 监视文件夹
+            box = layout.box()
+            watching = _watch_state["watcher"] is not None
+            col = box.column()
+            col.enabled = not watching
+            col.prop(scene, "distool_watch_folder")
+            col.prop(scene, "distool_watch_interval")
+            box.operator("distool.toggle_watch", text="Stop Watching" if watching else "Watch Folder",
+                         icon='PAUSE' if watching else 'VIEWZOOM', depress=watching)
             
             layout.operator("distool.reset_defaults", icon='FILE_REFRESH')
 
         layout.separator()
 
-        if scene.distool_generate_normal and scene.distool_preview_normal:
+        normal_icon = preview_icon_id('normal') if scene.distool_generated_normal else 0
+        disp_icon = preview_icon_id('disp') if scene.distool_generated_disp else 0
+        if scene.distool_generate_normal and normal_icon:
             layout.label(text="Normal Map Preview:")
-            layout.template_ID_preview(scene, "distool_preview_normal", new="image.new", open="image.open")
-        if scene.distool_generate_displacement and scene.distool_preview_disp:
+            layout.template_icon(icon_value=normal_icon, scale=8.0)
+        if scene.distool_generate_displacement and disp_icon:
             layout.label(text="Displacement Map Preview:")
-            layout.template_ID_preview(scene, "distool_preview_disp", new="image.new", open="image.open")
+            layout.template_icon(icon_value=disp_icon, scale=8.0)
 
-        if (scene.distool_preview_normal or scene.distool_preview_disp) and not scene.get("distool_applied", False):
+        if (scene.distool_generated_normal or scene.distool_generated_disp) and not scene.get("distool_applied", False):
             layout.operator("distool.apply_maps", icon='NODE_MATERIAL')
         
         layout.separator()
+
+        # 最近一次生成的各阶段耗时
+        profile = distool_profile.last_profile()
+        if profile:
+            box = layout.box()
+            row = box.row()
+            row.prop(scene, "distool_show_profile", text="", emboss=False,
+                     icon='TRIA_DOWN' if scene.distool_show_profile else 'TRIA_RIGHT')
+            text = f"Last Run: {profile.wall_time * 1000:.0f} ms"
+            if profile.peak_bytes is not None:
+                text += f", peak {profile.peak_bytes / (1024 * 1024):.0f} MB"
+            row.label(text=text)
+            if scene.distool_show_profile:
+                col = box.column(align=True)
+                for name, record in profile.stages.items():
+                    row = col.row()
+                    row.alert = name == profile.slowest
+                    row.label(text=name)
+                    row.label(text=f"{record.wall * 1000:.1f} ms")
+                    row.label(text=f"cpu {record.cpu * 1000:.1f} ms")
+                    if record.peak_bytes is not None:
+                        row.label(text=f"{record.peak_bytes / (1024 * 1024):.1f} MB")
         
 
+def _update_thread_budget(self, context):
+    apply_thread_budget()
+
+class DistoolPreferences(bpy.types.AddonPreferences):
+    bl_idname = __package__
+
+    thread_mode: bpy.props.EnumProperty(
+        name="Thread Budget",
+        items=[
+            ('AUTO', "Automatic", "Use all cores but one, leaving one for the Blender UI"),
+            ('CUSTOM', "Custom", "Use a fixed number of threads"),
+        ],
+        default='AUTO',
+        update=_update_thread_budget,
+    )
+    thread_count: bpy.props.IntProperty(name="Threads", description="Threads shared by OpenCV, BLAS and Distool's worker pools", min=1, max=256, default=4, update=_update_thread_budget)
+    yield_during_render: bpy.props.BoolProperty(name="Yield Cores During Render", description="Drop to the render thread count while Blender is rendering", default=True, update=_update_thread_budget)
+    render_threads: bpy.props.IntProperty(name="Threads While Rendering", min=1, max=256, default=1, update=_update_thread_budget)
+    regenerate_stale_on_render: bpy.props.BoolProperty(name="Regenerate Stale Maps on Render", description="Before each rendered frame, regenerate Distool maps whose source image changed, for materials on visible objects", default=True)
+    use_worker_service: bpy.props.BoolProperty(name="Use Worker Service", description="Send single-image jobs to a shared background process that keeps libraries and caches warm; falls back to running inside Blender", default=False)
+
+    def draw(self, context):
+        layout = self.layout
+        box = layout.box()
+        box.label(text="Performance:")
+        box.prop(self, "thread_mode")
+        if self.thread_mode == 'CUSTOM':
+            box.prop(self, "thread_count")
+        box.prop(self, "yield_during_render")
+        if self.yield_during_render:
+            box.prop(self, "render_threads")
+        box.label(text=f"Using {distool_threads.effective_budget()} of {distool_threads.cpu_count()} cores", icon='INFO')
+        box.prop(self, "regenerate_stale_on_render")
+
+        box = layout.box()
+        box.prop(self, "use_worker_service")
+        if self.use_worker_service:
+            # 只在偏好设置界面显示状态，面板重绘不连接服务
+            row = box.row()
+            row.operator("distool.start_service", icon='PLAY')
+            row.operator("distool.stop_service", icon='PAUSE')
+
+class DISTOOL_OT_StartService(bpy.types.Operator):
+    bl_idname = "distool.start_service"
+    bl_label = "Start Service"
+    bl_description = "Start the shared Distool worker service in the background"
+
+    def execute(self, context):
+        stats = distool_service.ping()
+        if stats:
+            self.report({'INFO'}, f"Worker service already running (pid {stats['pid']}, {stats['jobs']} jobs)")
+            return {'FINISHED'}
+        distool_service.launch(jobs=1)
+        self.report({'INFO'}, "Worker service starting")
+        return {'FINISHED'}
+
+class DISTOOL_OT_StopService(bpy.types.Operator):
+    bl_idname = "distool.stop_service"
+    bl_label = "Stop Service"
+    bl_description = "Ask the shared Distool worker service to exit"
+
+    def execute(self, context):
+        if distool_service.shutdown():
+            self.report({'INFO'}, "Worker service stopped")
+        else:
+            self.report({'WARNING'}, "Worker service is not running")
+        return {'FINISHED'}
+
+def get_preferences(context=None):
+    """插件偏好设置，未注册（例如无界面运行）时为 None"""
+    addon = (context or bpy.context).preferences.addons.get(__package__)
+    return addon.preferences if addon else None
+
+def apply_thread_budget():
+    prefs = get_preferences()
+    if prefs is None:
+        return distool_threads.apply()
+    return distool_threads.configure(
+        prefs.thread_count if prefs.thread_mode == 'CUSTOM' else None,
+        prefs.yield_during_render,
+        prefs.render_threads,
+    )
+
+@bpy.app.handlers.persistent
+def _on_render_init(*args):
+    distool_threads.set_render_active(True)
+
+@bpy.app.handlers.persistent
+def _on_render_end(*args):
+    distool_threads.set_render_active(False)
+
+def _visible_stamped_images(scene):
+    """当前帧中参与渲染的物体的材质所用的、带有 Distool 记录的图像"""
+    objects = set()
+    for view_layer in scene.view_layers:
+        if view_layer.use:
+            objects.update(obj for obj in view_layer.objects if not obj.hide_render)
+    images = []
+    for obj in objects:
+        for slot in getattr(obj, "material_slots", ()):
+            mat = slot.material
+            if not mat or not mat.use_nodes:
+                continue
+            for node in mat.node_tree.nodes:
+                if node.type == 'TEX_IMAGE' and node.image and "distool_source" in node.image and node.image not in images:
+                    images.append(node.image)
+    return images
+
+def regenerate_stale_maps(scene):
+    """重新生成可见材质中源文件已变化的贴图，同一源文件和设置只运行一次管线；返回重新生成的源文件数"""
+    groups = {}
+    for image in _visible_stamped_images(scene):
+        stamp = {key: image.get(key, "") for key in distool_stale.STAMP_KEYS}
+        if distool_stale.is_stale(stamp):
+            groups.setdefault((stamp["distool_source"], stamp["distool_settings_hash"]), stamp)
+    for stamp in groups.values():
+        try:
+            new_stamp, paths = distool_stale.regenerate(stamp)
+        except Exception as e:
+            print(f"[Distool] Could not regenerate maps for {stamp['distool_source']}: {e}")
+            continue
+        print(f"[Distool] Regenerated stale maps for {stamp['distool_source']}")
+        _reload_generated_images(paths, new_stamp)
+    return len(groups)
+
+@bpy.app.handlers.persistent
+def _on_render_pre(scene, *args):
+    prefs = get_preferences()
+    if prefs is None or prefs.regenerate_stale_on_render:
+        regenerate_stale_maps(scene)
+
+_RENDER_HANDLERS = (
+    (bpy.app.handlers.render_init, _on_render_init),
+    (bpy.app.handlers.render_pre, _on_render_pre),
+    (bpy.app.handlers.render_complete, _on_render_end),
+    (bpy.app.handlers.render_cancel, _on_render_end),
+)
+
+# 属性更新事务：批量修改期间只记录，退出最外层时统一重新生成一次
+_update_batch = {"depth": 0, "pending": False}
+
+@contextlib.contextmanager
+def batch_updates(context=None):
+    """合并多个 distool_* 属性修改，只触发一次重新生成
+
+    用法::
+
+        with batch_updates(context):
+            scene.distool_normal_strength = 3.0
+            scene.distool_gradient_type = 'SCHARR'
+
+    可以嵌套，只有最外层退出时才会重新生成；块内抛出异常时不重新生成。
+    """
+    _update_batch["depth"] += 1
+    try:
+        yield
+    except BaseException:
+        if _update_batch["depth"] == 1:
+            _update_batch["pending"] = False
+        raise
+    finally:
+        _update_batch["depth"] -= 1
+
+    if _update_batch["depth"] == 0 and _update_batch["pending"]:
+        _update_batch["pending"] = False
+        auto_update_maps(None, context or bpy.context)
+
 def auto_update_maps(self, context):
+    if _update_batch["depth"] > 0:
+        _update_batch["pending"] = True
+        return
+    if _background_job["running"]:
+        # 后台生成使用开始时的设置快照，完成后再手动重新生成
+        return
+
     node = context.active_node
     scene = context.scene
     
@@ -362,17 +1091,7 @@ def auto_update_maps(self, context):
         return
 
     if node and node.type == 'TEX_IMAGE' and node.image:
-        img_path = bpy.path.abspath(node.image.filepath_raw)
-        normal_path, disp_path = process_image(img_path, scene)
-        scene.distool_generated_normal = normal_path or ""
-        scene.distool_generated_disp = disp_path or ""
-
-        if normal_path:
-            scene.distool_preview_normal = bpy.data.images.load(normal_path)
-        if disp_path:
-            scene.distool_preview_disp = bpy.data.images.load(disp_path)
-
-        scene.distool_applied = False
+        generate_for_node(node, scene)
 
         
 class DISTOOL_OT_ResetDefaults(bpy.types.Operator):
@@ -382,33 +1101,50 @@ class DISTOOL_OT_ResetDefaults(bpy.types.Operator):
     def execute(self, context):
         scene = context.scene
 
-        # Normal Map Settings
-        scene.distool_normal_strength = 2.5
-        scene.distool_normal_level = 7.0
-        scene.distool_normal_blur = 0
+        # 所有属性修改合并为一次重新生成
+        with batch_updates(context):
+            # Normal Map Settings
+            scene.distool_normal_strength = 2.5
+            scene.distool_normal_level = 7.0
+            scene.distool_normal_blur = 0
         
-        # Advanced Settings
-        scene.distool_gradient_type = 'SOBEL'
-        scene.distool_normal_gamma_correct = True
-        scene.distool_normal_gamma = 0.5
-        scene.distool_normal_detail_strength = 0.5
-        scene.distool_normal_smooth = 0.0
+            # Advanced Settings
+            scene.distool_gradient_type = 'SOBEL'
+            scene.distool_normal_gamma_correct = True
+            scene.distool_normal_gamma = 0.5
+            scene.distool_normal_detail_strength = 0.5
+            scene.distool_normal_smooth = 0.0
         
-        # Channel Control
-        scene.distool_invert_r = False
-        scene.distool_invert_g = False
-        scene.distool_invert_height = False
-        scene.distool_zrange = True
+            # Channel Control
+            scene.distool_invert_r = False
+            scene.distool_invert_g = False
+            scene.distool_invert_height = False
+            scene.distool_zrange = True
+            scene.distool_normal_format = 'RGB'
 
-        # Displacement Map Settings
-        scene.distool_disp_contrast = -0.5
-        scene.distool_disp_blur = 0
-        scene.distool_invert_disp = False
+            # Height Source
+            scene.distool_height_source = 'IMAGE'
+            scene.distool_source_flip_g = False
+
+            # Displacement Map Settings
+            scene.distool_disp_contrast = -0.5
+            scene.distool_disp_auto_levels = False
+            scene.distool_disp_levels_clip = 0.5
+            scene.distool_disp_blur = 0
+            scene.distool_invert_disp = False
 
         return {'FINISHED'}
 
 def register():
+    _previews["collection"] = bpy.utils.previews.new()
+    bpy.utils.register_class(DistoolPreferences)
+    bpy.utils.register_class(DISTOOL_OT_StartService)
+    bpy.utils.register_class(DISTOOL_OT_StopService)
     bpy.utils.register_class(DISTOOL_OT_GenerateSingle)
+    bpy.utils.register_class(DISTOOL_OT_GenerateBatch)
+    bpy.utils.register_class(DISTOOL_OT_GenerateFromRaw)
+    bpy.utils.register_class(DISTOOL_OT_ToggleWatch)
+    bpy.utils.register_class(DISTOOL_OT_ToggleLivePaint)
     bpy.utils.register_class(DISTOOL_OT_ApplyMaps)
     bpy.utils.register_class(DISTOOL_PT_Panel)
     bpy.utils.register_class(DISTOOL_OT_ResetDefaults)
@@ -418,6 +1154,27 @@ def register():
     bpy.types.Scene.distool_generate_displacement = bpy.props.BoolProperty(name="Generate Displacement Map", default=False)
     bpy.types.Scene.distool_use_subfolder = bpy.props.BoolProperty(name="Save in Subfolder", default=True)
     
+    # Extra Maps
+    bpy.types.Scene.distool_generate_curvature = bpy.props.BoolProperty(name="Curvature", default=False)
+    bpy.types.Scene.distool_generate_cavity = bpy.props.BoolProperty(name="Cavity", default=False)
+    bpy.types.Scene.distool_generate_ao = bpy.props.BoolProperty(name="Ambient Occlusion", default=False)
+    bpy.types.Scene.distool_generate_roughness = bpy.props.BoolProperty(name="Roughness Hint", default=False)
+    
+    # Mip Chain
+    bpy.types.Scene.distool_generate_mips = bpy.props.BoolProperty(name="Generate Mip Chain", description="Also write half-size levels of the normal/displacement maps", default=False)
+    bpy.types.Scene.distool_mip_min_size = bpy.props.IntProperty(name="Smallest Level", description="Stop the mip chain at this size (shorter side, pixels)", min=1, max=8192, default=512)
+    
+    # Striped Output
+    bpy.types.Scene.distool_stream_output = bpy.props.BoolProperty(name="Low Memory (Striped Output)", description="Compute and write the maps strip by strip so memory stays proportional to the strip size", default=False)
+    bpy.types.Scene.distool_strip_rows = bpy.props.IntProperty(name="Strip Rows", description="Rows computed per strip", min=16, max=8192, default=256)
+    
+    # Stage Timings
+    bpy.types.Scene.distool_show_profile = bpy.props.BoolProperty(name="Show Stage Timings", default=False)
+    
+    # Watch Folder
+    bpy.types.Scene.distool_watch_folder = bpy.props.StringProperty(name="Folder", description="Folder whose images are regenerated when they change", subtype='DIR_PATH')
+    bpy.types.Scene.distool_watch_interval = bpy.props.FloatProperty(name="Interval", description="Seconds between scans; a changed file must also stay unchanged this long before it is processed", min=0.2, max=60.0, default=2.0, unit='TIME_ABSOLUTE')
+    
     # Normal Map Settings
     bpy.types.Scene.distool_normal_strength = bpy.props.FloatProperty(name="Strength", min=0.01, max=10.0, default=2.5, update=auto_update_maps)
     bpy.types.Scene.distool_normal_level = bpy.props.FloatProperty(name="Detail Level", min=4.0, max=10.0, default=7.0, update=auto_update_maps)
@@ -449,22 +1206,73 @@ def register():
     bpy.types.Scene.distool_invert_g = bpy.props.BoolProperty(name="Invert G", default=False, update=auto_update_maps)
     bpy.types.Scene.distool_invert_height = bpy.props.BoolProperty(name="Invert Height", default=False, update=auto_update_maps)
     bpy.types.Scene.distool_zrange = bpy.props.BoolProperty(name="Z-Range (0 to +1)", default=True, update=auto_update_maps)
+    bpy.types.Scene.distool_normal_format = bpy.props.EnumProperty(
+        name="Normal Format",
+        description="Pixel layout of the normal map file",
+        items=[
+            ('RGB', "RGB 8-bit", "Standard three-channel normal map"),
+            ('RG8', "RG Packed 8-bit", "Store only X and Y; Z is rebuilt in the shader (about a third smaller)"),
+            ('RG16', "RG Packed 16-bit", "Store X and Y at 16 bits; Z is rebuilt in the shader"),
+        ],
+        default='RGB',
+        update=auto_update_maps
+    )
+    
+    # Height Source
+    bpy.types.Scene.distool_height_source = bpy.props.EnumProperty(
+        name="Height Source",
+        description="How the height field is obtained from the source image",
+        items=[
+            ('IMAGE', "Image Luminance", "Use the brightness of the source image as height"),
+            ('NORMAL_MAP', "Normal Map", "Integrate a tangent-space normal map back into a height field (FFT Poisson solve)"),
+        ],
+        default='IMAGE',
+        update=auto_update_maps
+    )
+    bpy.types.Scene.distool_source_flip_g = bpy.props.BoolProperty(
+        name="Flip Source Green (DirectX)",
+        description="The source normal map uses the DirectX convention (green points down)",
+        default=False,
+        update=auto_update_maps
+    )
     
     # Image Previews
     bpy.types.Scene.distool_generated_normal = bpy.props.StringProperty()
     bpy.types.Scene.distool_generated_disp = bpy.props.StringProperty()
-    bpy.types.Scene.distool_preview_normal = bpy.props.PointerProperty(type=bpy.types.Image)
-    bpy.types.Scene.distool_preview_disp = bpy.props.PointerProperty(type=bpy.types.Image)
     bpy.types.Scene.distool_applied = bpy.props.BoolProperty(default=False)
     
     # Displacement Map Settings
     bpy.types.Scene.distool_disp_contrast = bpy.props.FloatProperty(name="Contrast", min=-1.0, max=1.0, default=-0.5, update=auto_update_maps)
+    bpy.types.Scene.distool_disp_auto_levels = bpy.props.BoolProperty(name="Auto Levels", description="Stretch the height range automatically from sampled percentiles instead of using Contrast", default=False, update=auto_update_maps)
+    bpy.types.Scene.distool_disp_levels_clip = bpy.props.FloatProperty(name="Clip %", description="Percentage of the darkest and brightest pixels clipped at each end", min=0.0, max=10.0, default=0.5, update=auto_update_maps)
     bpy.types.Scene.distool_disp_blur = bpy.props.IntProperty(name="Blur/Sharpen", min=-32, max=32, default=0, update=auto_update_maps)
     bpy.types.Scene.distool_invert_disp = bpy.props.BoolProperty(name="Invert", default=False, update=auto_update_maps)
     
+    # 线程预算与渲染期间让出核心
+    for handlers, handler in _RENDER_HANDLERS:
+        handlers.append(handler)
+    apply_thread_budget()
     
 def unregister():
+    for handlers, handler in _RENDER_HANDLERS:
+        if handler in handlers:
+            handlers.remove(handler)
+    distool_threads.set_render_active(False)
+    # 监视文件夹的定时器是持久的，不停止会在插件停用后继续运行
+    stop_watching()
+    stop_live_paint(save=False)
+    if _previews["collection"] is not None:
+        bpy.utils.previews.remove(_previews["collection"])
+        _previews["collection"] = None
+
+    bpy.utils.unregister_class(DistoolPreferences)
+    bpy.utils.unregister_class(DISTOOL_OT_StartService)
+    bpy.utils.unregister_class(DISTOOL_OT_StopService)
     bpy.utils.unregister_class(DISTOOL_OT_GenerateSingle)
+    bpy.utils.unregister_class(DISTOOL_OT_GenerateBatch)
+    bpy.utils.unregister_class(DISTOOL_OT_GenerateFromRaw)
+    bpy.utils.unregister_class(DISTOOL_OT_ToggleWatch)
+    bpy.utils.unregister_class(DISTOOL_OT_ToggleLivePaint)
     bpy.utils.unregister_class(DISTOOL_OT_ApplyMaps)
     bpy.utils.unregister_class(DISTOOL_PT_Panel)
     bpy.utils.unregister_class(DISTOOL_OT_ResetDefaults)
@@ -473,6 +1281,27 @@ def unregister():
     del bpy.types.Scene.distool_generate_displacement
     del bpy.types.Scene.distool_use_subfolder
     
+    # Extra Maps
+    del bpy.types.Scene.distool_generate_curvature
+    del bpy.types.Scene.distool_generate_cavity
+    del bpy.types.Scene.distool_generate_ao
+    del bpy.types.Scene.distool_generate_roughness
+    
+    # Mip Chain
+    del bpy.types.Scene.distool_generate_mips
+    del bpy.types.Scene.distool_mip_min_size
+    
+    # Striped Output
+    del bpy.types.Scene.distool_stream_output
+    del bpy.types.Scene.distool_strip_rows
+    
+    # Stage Timings
+    del bpy.types.Scene.distool_show_profile
+    
+    # Watch Folder
+    del bpy.types.Scene.distool_watch_folder
+    del bpy.types.Scene.distool_watch_interval
+    
     # Normal Map Settings
     del bpy.types.Scene.distool_normal_strength
     del bpy.types.Scene.distool_normal_level
@@ -490,16 +1319,19 @@ def unregister():
     del bpy.types.Scene.distool_invert_g
     del bpy.types.Scene.distool_invert_height
     del bpy.types.Scene.distool_zrange
+    del bpy.types.Scene.distool_normal_format
+    del bpy.types.Scene.distool_height_source
+    del bpy.types.Scene.distool_source_flip_g
     
     # Image Previews
     del bpy.types.Scene.distool_generated_normal
     del bpy.types.Scene.distool_generated_disp
-    del bpy.types.Scene.distool_preview_normal
-    del bpy.types.Scene.distool_preview_disp
     del bpy.types.Scene.distool_applied
     
     # Displacement Map Settings
     del bpy.types.Scene.distool_disp_contrast
+    del bpy.types.Scene.distool_disp_auto_levels
+    del bpy.types.Scene.distool_disp_levels_clip
     del bpy.types.Scene.distool_disp_blur
     del bpy.types.Scene.distool_invert_disp
 
@@ -0,0 +1,336 @@
+"""
+Distool 运行指标 / Distool Run Metrics
+每次生成写一行 JSON 到滚动的日志文件，供农场批处理汇总；附带汇总工具
+Writes one JSON line per generation job to a rotating log for farm-wide aggregation,
+plus a summarizer reporting throughput, latency percentiles and the slowest inputs
+
+日志路径由环境变量 DISTOOL_METRICS 或命令行 --metrics 指定，未指定时不记录。
+多个进程共用一个滚动文件会互相覆盖，因此每个进程写自己的文件：jobs.jsonl -> jobs.<主机>-<pid>.jsonl；
+汇总时给出原路径即可读到所有进程的文件。
+The log path comes from the DISTOOL_METRICS environment variable or --metrics; nothing is
+recorded when neither is set. Each process writes its own file next to that path
+(jobs.jsonl -> jobs.<host>-<pid>.jsonl) so rotation never races between processes; the
+summarizer given the original path reads every worker's file.
+
+汇总 / Summary:
+    python distool_metrics.py farm_logs/*.jsonl --top 20
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import socket
+import hashlib
+import threading
+import contextlib
+import logging
+import logging.handlers
+
+METRICS_ENV_VAR = "DISTOOL_METRICS"
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 5
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+class MetricsLogger:
+    """线程安全的 JSON-lines 写出器，超过 max_bytes 时滚动 / Thread-safe, size-rotated JSON-lines writer
+
+    写入 worker_log_path(path)，文件只属于当前进程。
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+        self.path = worker_log_path(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._handler = logging.handlers.RotatingFileHandler(
+            self.path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self._handler.setFormatter(logging.Formatter("%(message)s"))
+        self._logger = logging.getLogger("distool.metrics." + hashlib.sha1(self.path.encode()).hexdigest()[:12])
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._logger.addHandler(self._handler)
+
+    def emit(self, **record):
+        """写入一条记录，自动补充时间戳和工作者标识"""
+        record.setdefault("ts", round(time.time(), 3))
+        record.setdefault("worker", worker_id())
+        self._logger.info(json.dumps(record, separators=(",", ":"), default=str))
+
+    def close(self):
+        self._logger.removeHandler(self._handler)
+        self._handler.close()
+
+
+def get_logger(path=None):
+    """返回指定路径（默认 DISTOOL_METRICS）的共享 MetricsLogger，未配置时为 None"""
+    path = path or os.environ.get(METRICS_ENV_VAR)
+    if not path:
+        return None
+    # 按进程缓存：fork 出的子进程不能沿用父进程的文件
+    key = (os.path.abspath(path), os.getpid())
+    with _loggers_lock:
+        logger = _loggers.get(key)
+        if logger is None:
+            logger = _loggers[key] = MetricsLogger(path)
+        return logger
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}"
+
+
+def worker_log_path(path):
+    """本进程的日志文件：jobs.jsonl -> jobs.<主机>-<pid>.jsonl / This process's log file"""
+    root, ext = os.path.splitext(os.path.abspath(path))
+    host = re.sub(r"[^\w.-]+", "_", socket.gethostname())
+    return f"{root}.{host}-{os.getpid()}{ext}"
+
+
+def settings_hash(scene):
+    """distool_* 设置的短哈希，设置相同的任务可以直接比较 / Short hash of the distool_* settings"""
+    try:
+        from . import distool_core
+    except ImportError:
+        import distool_core
+    settings = distool_core.HeadlessSettings.from_scene(scene).as_dict()
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _expand(path):
+    """把 <UDIM> / #### 模式展开为磁盘上的具体文件 / Expand tile and frame patterns to files"""
+    try:
+        from . import distool_core
+    except ImportError:
+        import distool_core
+    if not path:
+        return []
+    if distool_core.UDIM_TOKEN in path:
+        return [distool_core.udim_tile_path(path, n) for n in distool_core.udim_tiles_on_disk(path)]
+    if distool_core.is_sequence_pattern(path):
+        return [frame_path for _, frame_path in distool_core.sequence_frames_on_disk(path)]
+    return [path] if os.path.isfile(path) else []
+
+
+def _total_bytes(paths):
+    return sum(os.path.getsize(p) for path in paths for p in _expand(path))
+
+
+def png_dimensions(path):
+    """只读 PNG 文件头取得 (宽, 高)，不是 PNG 时为 None / Read (width, height) from a PNG header"""
+    try:
+        with open(path, "rb") as f:
+            header = f.read(24)
+    except OSError:
+        return None
+    if len(header) < 24 or header[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+    return int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")
+
+
+def _resolution(outputs):
+    """从第一张 PNG 输出取分辨率（输出与输入同尺寸），瓦片/帧按个数累计像素"""
+    for path in outputs:
+        files = _expand(path)
+        size = png_dimensions(files[0]) if files else None
+        if size:
+            return size[0], size[1], round(size[0] * size[1] * len(files) / 1e6, 3)
+    return None, None, None
+
+
+def emit_job(logger, entry, source, scene, outputs=(), wall_s=None, stages=None, error=None, cache=None, **extra):
+    """写出一条任务记录 / Write one job record"""
+    outputs = [path for path in outputs if path]
+    width, height, megapixels = _resolution(outputs)
+    logger.emit(
+        entry=entry,
+        input=source,
+        width=width,
+        height=height,
+        megapixels=megapixels,
+        settings_hash=settings_hash(scene),
+        wall_s=round(wall_s, 6) if wall_s is not None else None,
+        stages={name: round(seconds, 6) for name, seconds in (stages or {}).items()},
+        bytes_read=_safe(_total_bytes, [source]),
+        bytes_written=_safe(_total_bytes, outputs),
+        cache=cache,
+        outputs=outputs,
+        error=error,
+        **extra,
+    )
+
+
+@contextlib.contextmanager
+def track_job(entry, source, scene, logger=None):
+    """记录一次生成任务 / Record one generation job
+
+    用法::
+
+        with track_job("single", path, scene) as job:
+            job["outputs"] = process_image(path, scene)
+
+    块内可以设置 job 的 outputs（输出路径）、profile（distool_profile.RunProfile）、
+    cache（命中/未命中计数）等字段。块内抛出的异常会记录为 error 后继续抛出。
+    未配置日志时不做任何额外工作。
+    """
+    logger = logger or get_logger()
+    job = {}
+    if logger is None:
+        yield job
+        return
+
+    start = time.perf_counter()
+    error = None
+    try:
+        yield job
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        extra = {}
+        stages = job.get("stages")
+        profile = job.get("profile")
+        if profile is not None:
+            stages = {name: stage.wall for name, stage in profile.stages.items()}
+            if profile.peak_bytes is not None:
+                extra["peak_mb"] = round(profile.peak_bytes / (1024 * 1024), 2)
+        emit_job(logger, entry, source, scene, job.get("outputs", ()), time.perf_counter() - start,
+                 stages, error, job.get("cache"), **extra)
+
+
+def _safe(func, *args):
+    try:
+        return func(*args)
+    except OSError:
+        return None
+
+
+# ---------------------------------------------------------------------------
+# 汇总 / Summary
+# ---------------------------------------------------------------------------
+
+def _worker_logs(path):
+    """日志路径及其各进程文件 jobs.<主机>-<pid>.jsonl"""
+    root, ext = os.path.splitext(path)
+    return [path] + sorted(glob.glob(glob.escape(root) + ".*-*" + glob.escape(ext)))
+
+
+def read_records(paths):
+    """读取日志（含各进程的文件和滚动出的 .1 .2 … 文件），跳过损坏的行"""
+    records = []
+    seen = set()
+    for path in paths:
+        candidates = [f"{log}.{i}" if i else log for log in _worker_logs(path) for i in range(100)]
+        for candidate in candidates:
+            candidate = os.path.abspath(candidate)
+            if candidate in seen or not os.path.exists(candidate):
+                continue
+            seen.add(candidate)
+            with open(candidate, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+    return records
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def summarize(records, top=10):
+    """吞吐量（百万像素/秒）、延迟 p50/p95、各阶段耗时占比与最慢的输入"""
+    ok = [r for r in records if not r.get("error")]
+    latencies = sorted(r["wall_s"] for r in ok)
+    megapixels = sum(r.get("megapixels") or 0 for r in ok)
+    busy = sum(latencies)
+    summary = {
+        "jobs": len(records),
+        "failed": len(records) - len(ok),
+        "workers": len({r.get("worker", "").rsplit(":", 1)[0] for r in records}),
+        "megapixels": round(megapixels, 3),
+        "mp_per_s": round(megapixels / busy, 3) if busy else None,
+        "p50_s": _percentile(latencies, 50),
+        "p95_s": _percentile(latencies, 95),
+        "bytes_read": sum(r.get("bytes_read") or 0 for r in records),
+        "bytes_written": sum(r.get("bytes_written") or 0 for r in records),
+    }
+    # 农场整体吞吐：按首尾时间戳计算的墙钟时间
+    if ok:
+        span = max(r["ts"] for r in ok) - min(r["ts"] - r["wall_s"] for r in ok)
+        summary["aggregate_mp_per_s"] = round(megapixels / span, 3) if span > 0 else None
+
+    stage_totals = {}
+    for r in ok:
+        for name, seconds in (r.get("stages") or {}).items():
+            stage_totals[name] = stage_totals.get(name, 0.0) + seconds
+    summary["stages_s"] = {name: round(total, 3) for name, total in sorted(stage_totals.items(), key=lambda item: -item[1])}
+
+    hits = sum((r.get("cache") or {}).get("hits", 0) for r in records)
+    misses = sum((r.get("cache") or {}).get("misses", 0) for r in records)
+    if hits or misses:
+        summary["cache_hit_rate"] = round(hits / (hits + misses), 4)
+    # 常驻服务的解码图像缓存
+    image_hits = sum((r.get("cache") or {}).get("image_hits", 0) for r in records)
+    image_misses = sum((r.get("cache") or {}).get("image_misses", 0) for r in records)
+    if image_hits or image_misses:
+        summary["image_cache_hit_rate"] = round(image_hits / (image_hits + image_misses), 4)
+
+    summary["slowest"] = [
+        {"input": r["input"], "wall_s": r["wall_s"], "megapixels": r.get("megapixels"), "worker": r.get("worker")}
+        for r in sorted(ok, key=lambda r: r["wall_s"], reverse=True)[:top]
+    ]
+    summary["errors"] = [{"input": r["input"], "error": r["error"]} for r in records if r.get("error")][:top]
+    return summary
+
+
+def format_summary(summary):
+    lines = [
+        f"{summary['jobs']} jobs ({summary['failed']} failed) on {summary['workers']} workers, {summary['megapixels']} MP",
+        f"throughput {summary['mp_per_s']} MP/s per job, {summary.get('aggregate_mp_per_s')} MP/s aggregate",
+        f"latency p50 {summary['p50_s']} s, p95 {summary['p95_s']} s",
+        f"read {summary['bytes_read'] / 1e6:.1f} MB, written {summary['bytes_written'] / 1e6:.1f} MB",
+    ]
+    if "cache_hit_rate" in summary:
+        lines.append(f"cache hit rate {summary['cache_hit_rate']:.1%}")
+    if "image_cache_hit_rate" in summary:
+        lines.append(f"decoded-image cache hit rate {summary['image_cache_hit_rate']:.1%}")
+    if summary["stages_s"]:
+        lines.append("stages: " + ", ".join(f"{name} {seconds}s" for name, seconds in summary["stages_s"].items()))
+    if summary["slowest"]:
+        lines.append("slowest:")
+        lines.extend(f"  {item['wall_s']:8.3f} s  {item['input']}" for item in summary["slowest"])
+    if summary["errors"]:
+        lines.append("errors:")
+        lines.extend(f"  {item['input']}: {item['error']}" for item in summary["errors"])
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize Distool JSON-lines metrics")
+    parser.add_argument("logs", nargs="+", help="metrics files (per-worker and rotated .1/.2 files are included)")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest inputs to list")
+    parser.add_argument("--json", action="store_true", help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    summary = summarize(read_records(args.logs), args.top)
+    print(json.dumps(summary, indent=2) if args.json else format_summary(summary))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+"""
+Distool 阶段计时 / Distool Stage Instrumentation
+记录管线各阶段的耗时和CPU时间，供面板显示；设置环境变量 DISTOOL_TRACE_MEMORY=1 时同时用 tracemalloc 记录峰值内存分配，
+设置 DISTOOL_PROFILE=<目录> 时额外写出 cProfile 数据和 Chrome 跟踪文件
+Records wall and CPU time for each pipeline stage for display in the panel; with DISTOOL_TRACE_MEMORY=1 set,
+also records peak allocation through tracemalloc, and with DISTOOL_PROFILE=<dir> set, dumps cProfile stats and a Chrome trace
+
+tracemalloc 的计数是全进程共享的：多个测量内存的记录同时进行时会互相重置峰值，
+因此重叠的记录都不报告峰值内存（peak_bytes 为 None）。
+
+没有活动的 profile_run 时，stage() 和 @timed_stage 只多一次判断，几乎没有开销。
+活动的记录属于启动它的线程，同时在其他线程中运行的生成不会被计入（也不会被它的监听函数取消）；
+线程池中的任务用 bind() 包装后计入调用者的记录。
+"""
+
+import os
+import re
+import json
+import time
+import threading
+import functools
+import contextlib
+import tracemalloc
+
+PROFILE_ENV_VAR = "DISTOOL_PROFILE"
+TRACE_MEMORY_ENV_VAR = "DISTOOL_TRACE_MEMORY"
+
+_last = None            # 最近一次完成的 RunProfile
+_lock = threading.Lock()
+_local = threading.local()     # stack: 阶段帧；active: 本线程当前的 RunProfile
+_tracing_runs = set()          # 正在测量内存的 RunProfile（受 _lock 保护）
+_started_tracing = False       # tracemalloc 是否由本模块启动，最后一个记录结束时停止
+
+
+class Cancelled(Exception):
+    """由阶段监听函数抛出，在两个阶段之间中止生成 / Raised by a stage listener to stop between stages"""
+
+
+class StageRecord:
+    """单个阶段的累计数据 / Accumulated figures for one stage
+
+    wall / cpu 为自身时间（不含嵌套的子阶段），peak_bytes 为阶段内相对起点的最大新增分配，
+    未测量内存时为 None；同一记录中并行的阶段共用峰值计数，它们的 peak_bytes 只是近似值。
+    cpu 是进程CPU时间，OpenCV/NumPy 多线程时可能大于 wall。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_bytes = 0
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "wall_s": round(self.wall, 6),
+            "cpu_s": round(self.cpu, 6),
+            "peak_mb": _megabytes(self.peak_bytes),
+        }
+
+
+def _megabytes(value):
+    return None if value is None else round(value / (1024 * 1024), 2)
+
+
+class RunProfile:
+    """一次生成的各阶段统计 / Per-stage statistics for one generation run"""
+
+    def __init__(self, label="", trace_memory=False, listener=None):
+        self.label = label
+        self.trace_memory = trace_memory    # 与其他记录重叠后置为 False，峰值作废
+        self.listener = listener
+        self.stages = {}
+        self.events = []      # Chrome 跟踪事件
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_bytes = 0
+        self.start = time.perf_counter()
+
+    def record(self, name, wall, cpu, peak_bytes, start):
+        with _lock:
+            record = self.stages.get(name)
+            if record is None:
+                record = self.stages[name] = StageRecord(name)
+            record.calls += 1
+            record.wall += wall
+            record.cpu += cpu
+            record.peak_bytes = max(record.peak_bytes, peak_bytes)
+            self.events.append({
+                "name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                "ts": round((start - self.start) * 1e6, 1), "dur": round(wall * 1e6, 1),
+            })
+
+    @property
+    def slowest(self):
+        if not self.stages:
+            return None
+        return max(self.stages.values(), key=lambda record: record.wall).name
+
+    def as_dict(self):
+        return {
+            "label": self.label,
+            "wall_s": round(self.wall_time, 6),
+            "cpu_s": round(self.cpu_time, 6),
+            "peak_mb": _megabytes(self.peak_bytes),
+            "stages": {name: record.as_dict() for name, record in self.stages.items()},
+        }
+
+    def summary(self):
+        line = f"{self.label or 'run'}: {self.wall_time * 1000:.1f} ms"
+        if self.peak_bytes is not None:
+            line += f", peak {self.peak_bytes / (1024 * 1024):.1f} MB"
+        lines = [line]
+        for name, record in self.stages.items():
+            line = f"  {name:<16} {record.wall * 1000:9.1f} ms  cpu {record.cpu * 1000:9.1f} ms"
+            if record.peak_bytes is not None:
+                line += f"  peak {record.peak_bytes / (1024 * 1024):7.1f} MB"
+            lines.append(line + f"  x{record.calls}")
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path):
+        """写出 Chrome 跟踪格式（chrome://tracing、Perfetto、speedscope 可打开）"""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+class _Frame:
+    __slots__ = ("base", "peak_seen", "child_wall", "child_cpu")
+
+    def __init__(self, base):
+        self.base = base
+        self.peak_seen = base
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+
+
+def current():
+    """本线程当前的 RunProfile，没有时为 None / The active run of this thread"""
+    return getattr(_local, "active", None)
+
+
+def bind(func):
+    """把调用线程的记录带到工作线程中 / Carry the calling thread's run into worker threads
+
+    在提交任务的线程中调用，返回的函数在任何线程中运行时都把阶段计入该记录。
+    """
+    profile = current()
+    if profile is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _local.active = profile
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.active = previous
+    return wrapper
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+@contextlib.contextmanager
+def stage(name):
+    """计时一个阶段 / Time a pipeline stage
+
+    可嵌套：父阶段只计自身时间。测量峰值内存时，进入子阶段前把父阶段已见到的峰值保存下来，
+    再重置 tracemalloc 的峰值，退出子阶段后合并回父阶段。记录与其他记录重叠后不再测量。
+    """
+    profile = current()
+    if profile is None:
+        yield
+        return
+    if profile.listener is not None:
+        # 阶段开始前通知监听函数（进度显示），它可以抛出 Cancelled 中止生成
+        profile.listener(name)
+
+    stack = _stack()
+    tracing = profile.trace_memory
+    if tracing:
+        traced, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1].peak_seen = max(stack[-1].peak_seen, peak)
+        tracemalloc.reset_peak()
+    else:
+        traced = 0
+    frame = _Frame(traced)
+    stack.append(frame)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        stack.pop()
+        peak_bytes = 0
+        if tracing and profile.trace_memory:
+            peak = max(frame.peak_seen, tracemalloc.get_traced_memory()[1])
+            peak_bytes = peak - frame.base
+            if stack:
+                stack[-1].peak_seen = max(stack[-1].peak_seen, peak)
+        if stack:
+            stack[-1].child_wall += wall
+            stack[-1].child_cpu += cpu
+        profile.record(name, wall - frame.child_wall, cpu - frame.child_cpu, peak_bytes, start_wall)
+
+
+def notify(name=None):
+    """等待其他进程完成工作时通知监听函数 / Notify the listener while work runs elsewhere
+
+    name 为其他进程（常驻服务）中开始的阶段，计入进度；为 None 时只是心跳，让监听函数有机会抛出 Cancelled。
+    """
+    profile = current()
+    if profile is not None and profile.listener is not None:
+        profile.listener(name)
+
+
+def timed_stage(name):
+    """把函数整体作为一个阶段计时的装饰器 / Decorator timing a whole function as one stage"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current() is None:
+                return func(*args, **kwargs)
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _profile_dump_dir():
+    """DISTOOL_PROFILE 的值：目录路径；"1" 表示系统临时目录；未设置时为 None"""
+    value = os.environ.get(PROFILE_ENV_VAR, "").strip()
+    if not value or value == "0":
+        return None
+    if value == "1":
+        import tempfile
+        return tempfile.gettempdir()
+    os.makedirs(value, exist_ok=True)
+    return value
+
+
+def _trace_memory_default():
+    """DISTOOL_TRACE_MEMORY 设为非 0 值时默认测量内存"""
+    return os.environ.get(TRACE_MEMORY_ENV_VAR, "").strip() not in ("", "0")
+
+
+def _begin_tracing(profile):
+    """登记一个测量内存的记录；tracemalloc 未启动时启动它，与其他记录重叠时全部作废"""
+    global _started_tracing
+    with _lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        if _tracing_runs:
+            for other in _tracing_runs:
+                other.trace_memory = False
+            profile.trace_memory = False
+        _tracing_runs.add(profile)
+
+
+def _end_tracing(profile):
+    """注销记录；最后一个记录结束时停止由本模块启动的 tracemalloc"""
+    global _started_tracing
+    with _lock:
+        _tracing_runs.discard(profile)
+        if not _tracing_runs and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+@contextlib.contextmanager
+def profile_run(label="", trace_memory=None, listener=None):
+    """记录一次生成 / Record one generation run
+
+    嵌套调用时沿用外层的记录。记录只属于当前线程，结束后可通过 last_profile() 取得结果。
+    trace_memory 为 None 时由 DISTOOL_TRACE_MEMORY 决定；测量内存时按引用计数共用 tracemalloc，
+    最后一个记录结束时停止它。
+    listener(阶段名) 在每个阶段开始前调用（包括线程池中的阶段），可用于显示进度或抛出 Cancelled；
+    notify() 的心跳调用时阶段名为 None。
+    """
+    global _last
+    if current() is not None:
+        yield current()
+        return
+
+    if trace_memory is None:
+        trace_memory = _trace_memory_default()
+    profile = RunProfile(label, trace_memory, listener)
+    if trace_memory:
+        _begin_tracing(profile)
+    if profile.trace_memory:
+        tracemalloc.reset_peak()
+    # 根帧收集本线程各阶段见到的峰值
+    root = _Frame(tracemalloc.get_traced_memory()[0] if profile.trace_memory else 0)
+    stack = _stack()
+    stack.append(root)
+
+    dump_dir = _profile_dump_dir()
+    profiler = None
+    if dump_dir:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    _local.active = profile
+    start_cpu = time.process_time()
+    try:
+        yield profile
+    finally:
+        _local.active = None
+        if profiler is not None:
+            profiler.disable()
+        stack.remove(root)
+        profile.wall_time = time.perf_counter() - profile.start
+        profile.cpu_time = time.process_time() - start_cpu
+        if profile.trace_memory:
+            profile.peak_bytes = max(root.peak_seen, tracemalloc.get_traced_memory()[1]) - root.base
+        if trace_memory:
+            _end_tracing(profile)
+        if not profile.trace_memory:
+            # 未测量或与其他记录重叠：不报告峰值
+            profile.peak_bytes = None
+            for record in profile.stages.values():
+                record.peak_bytes = None
+        _last = profile
+
+        if dump_dir:
+            name = re.sub(r"[^\w.-]+", "_", label or "run") + time.strftime("_%Y%m%d_%H%M%S")
+            profiler.dump_stats(os.path.join(dump_dir, name + ".prof"))
+            profile.write_chrome_trace(os.path.join(dump_dir, name + ".trace.json"))
+            print(f"[Distool] Profile written to {os.path.join(dump_dir, name)}.prof / .trace.json")
+
+
+def last_profile():
+    """最近一次完成的 RunProfile，没有时为 None / The most recent finished RunProfile"""
+    return _last
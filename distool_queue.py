@@ -0,0 +1,340 @@
+"""
+Distool 文件系统任务队列 / Distool File-System Job Queue
+只依赖共享目录（例如 NFS）在多台机器间分发生成任务：提交端写入任务描述，
+任意数量的工作进程通过原子重命名认领任务，处理后写出结果和状态；
+心跳超时的任务会被重新排队
+Distributes generation across machines that share only a directory (e.g. NFS): a submitter
+writes job descriptors, any number of workers claim them with atomic renames, process them and
+write results and status; jobs whose heartbeat goes stale are retried
+
+目录结构 / Layout:
+    <root>/pending/<id>.json    等待处理
+    <root>/running/<id>.<claim>.json  已认领，工作进程定期更新其修改时间作为心跳
+    <root>/done/<id>.json       结果（输出路径、耗时、工作者）
+    <root>/failed/<id>.json     超过最大重试次数
+
+用法 / Usage:
+    python distool_queue.py submit /mnt/farm/queue textures/*.png --out /mnt/farm/maps --set normal_strength=3.0
+    python distool_queue.py submit /mnt/farm/queue --out /mnt/farm/maps --list all_textures.txt
+    python distool_queue.py work /mnt/farm/queue            # 每台机器运行任意个
+    python distool_queue.py status /mnt/farm/queue
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+
+try:
+    from . import distool_core
+    from . import distool_metrics
+except ImportError:
+    import distool_core
+    import distool_metrics
+
+STATES = ("pending", "running", "done", "failed")
+DEFAULT_STALE_AFTER = 120.0
+DEFAULT_HEARTBEAT = 10.0
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def _state_dir(root, state):
+    return os.path.join(root, state)
+
+
+def _job_path(root, state, job_id):
+    return os.path.join(root, state, job_id + ".json")
+
+
+def _running_path(root, job_id, claim):
+    """每次认领使用独有的文件名：任务超时被重新排队并由其他进程认领后，原进程不会动到新文件"""
+    return os.path.join(root, "running", f"{job_id}.{claim}.json")
+
+
+def _job_exists(root, state, job_id):
+    """任务是否处于某个状态；运行中的文件名带有认领编号（以及结束、重新排队时的后缀）"""
+    if state != "running":
+        return os.path.exists(_job_path(root, state, job_id))
+    prefix = job_id + "."
+    return any(name.startswith(prefix) for name in os.listdir(_state_dir(root, "running")))
+
+
+def _write_json_atomic(path, data):
+    """先写临时文件再重命名，读取方永远看不到写了一半的文件"""
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def init_queue(root):
+    for state in STATES:
+        os.makedirs(_state_dir(root, state), exist_ok=True)
+
+
+def job_id_for(source, settings, output_dir):
+    """相同源文件、设置和输出目录得到相同的编号，重复提交不会产生重复任务"""
+    blob = json.dumps([os.path.abspath(source), settings, output_dir], sort_keys=True)
+    return hashlib.sha1(blob.encode()).hexdigest()[:20]
+
+
+def submit(root, sources, settings=None, output_dir=None, force=False):
+    """写入任务描述，返回新提交的任务编号列表 / Write job descriptors
+
+    已在队列中（任何状态）的相同任务会被跳过，除非 force 为 True。
+    """
+    init_queue(root)
+    settings = distool_core.HeadlessSettings(**(settings or {})).as_dict()
+    output_dir = os.path.abspath(output_dir) if output_dir else None
+    submitted = []
+    for source in sources:
+        source = os.path.abspath(source)
+        job_id = job_id_for(source, settings, output_dir)
+        if not force and any(_job_exists(root, state, job_id) for state in STATES):
+            continue
+        _write_json_atomic(_job_path(root, "pending", job_id), {
+            "id": job_id,
+            "source": source,
+            "settings": settings,
+            "output_dir": output_dir,
+            "attempts": 0,
+            "submitted": time.time(),
+            "errors": [],
+        })
+        submitted.append(job_id)
+    return submitted
+
+
+def _fs_now(root):
+    """共享文件系统服务器上的当前时间，避免不同机器的时钟偏差影响心跳判断"""
+    probe = os.path.join(root, ".clock-" + uuid.uuid4().hex)
+    with open(probe, "w"):
+        pass
+    try:
+        return os.stat(probe).st_mtime
+    finally:
+        os.remove(probe)
+
+
+def requeue_stale(root, stale_after=DEFAULT_STALE_AFTER, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """把心跳超时的任务放回等待队列（或超过重试次数时移入 failed），返回处理的任务编号
+
+    先把任务重命名为本进程独有的文件名，保证多个工作进程同时检查时只有一个处理它。
+    """
+    now = _fs_now(root)
+    requeued = []
+    running_dir = _state_dir(root, "running")
+    for name in os.listdir(running_dir):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(running_dir, name)
+        try:
+            if now - os.stat(path).st_mtime < stale_after:
+                continue
+            private = f"{path}.requeue-{uuid.uuid4().hex}"
+            os.rename(path, private)
+        except FileNotFoundError:
+            continue    # 已完成或被其他进程处理
+        job = _read_json(private)
+        job["attempts"] += 1
+        job["errors"].append({"worker": job.get("worker"), "error": "heartbeat lost", "time": time.time()})
+        state = "failed" if job["attempts"] >= max_attempts else "pending"
+        _write_json_atomic(_job_path(root, state, job["id"]), job)
+        os.remove(private)
+        requeued.append(job["id"])
+    return requeued
+
+
+def claim_next(root, worker):
+    """原子认领一个等待中的任务，没有任务时返回 None / Atomically claim a pending job"""
+    pending_dir = _state_dir(root, "pending")
+    for name in sorted(os.listdir(pending_dir)):
+        if not name.endswith(".json"):
+            continue
+        job_id = name[:-5]
+        claim = uuid.uuid4().hex[:12]
+        running = _running_path(root, job_id, claim)
+        try:
+            os.rename(os.path.join(pending_dir, name), running)
+            # 重命名保留提交时的修改时间，立即刷新，避免被当作心跳超时
+            os.utime(running)
+        except FileNotFoundError:
+            continue    # 被其他工作进程抢先认领
+        job = _read_json(running)
+        job["worker"] = worker
+        job["claim"] = claim
+        job["claimed"] = time.time()
+        _write_json_atomic(running, job)
+        return job
+    return None
+
+
+class _Heartbeat(threading.Thread):
+    """处理期间定期更新运行中任务文件的修改时间"""
+
+    def __init__(self, path, interval):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                break   # 任务已被判定超时并重新排队
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def process_job(root, job, heartbeat=DEFAULT_HEARTBEAT, max_attempts=DEFAULT_MAX_ATTEMPTS, metrics=None):
+    """处理一个已认领的任务并写出状态，返回是否成功"""
+    running = _running_path(root, job["id"], job["claim"])
+    beat = _Heartbeat(running, heartbeat)
+    beat.start()
+    scene = distool_core.HeadlessSettings(**job["settings"])
+    start = time.perf_counter()
+    try:
+        with distool_metrics.track_job("queue", job["source"], scene, metrics) as tracked:
+            if job["output_dir"]:
+                os.makedirs(job["output_dir"], exist_ok=True)
+            extra_paths = {}
+            normal_path, disp_path = distool_core.process_image(job["source"], scene, extra_paths, job["output_dir"])
+            tracked["outputs"] = [normal_path, disp_path] + list(extra_paths.values())
+            tracked["cache"] = {"hits": 0, "misses": 1}     # 农场工作者不经过缓存
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        beat.stop()
+
+    job["attempts"] += 1
+    job["finished"] = time.time()
+    job["wall_s"] = round(time.perf_counter() - start, 4)
+    if error is None:
+        job["result"] = {"normal": normal_path, "disp": disp_path, "extra": extra_paths}
+        state = "done"
+    else:
+        job["errors"].append({"worker": job["worker"], "error": error, "time": job["finished"]})
+        state = "failed" if job["attempts"] >= max_attempts else "pending"
+
+    # 写出结果前确认认领仍属于本进程：先把运行文件改成结束中的名字，requeue_stale 不再处理它；
+    # 文件已不在说明心跳超时后任务被重新排队，结果交给新的认领者，不写任何状态
+    finishing = running + ".finishing"
+    try:
+        os.rename(running, finishing)
+    except FileNotFoundError:
+        return error is None
+    _write_json_atomic(_job_path(root, state, job["id"]), job)
+    if state != "pending":
+        # 用 --force 重新提交的任务：去掉上一次运行留下的另一种结束状态
+        other = "failed" if state == "done" else "done"
+        try:
+            os.remove(_job_path(root, other, job["id"]))
+        except FileNotFoundError:
+            pass
+    os.remove(finishing)
+    return error is None
+
+
+def run_worker(root, worker=None, poll=2.0, stale_after=DEFAULT_STALE_AFTER, heartbeat=DEFAULT_HEARTBEAT,
+               max_attempts=DEFAULT_MAX_ATTEMPTS, exit_when_empty=False, max_jobs=None, metrics=None, log=print):
+    """工作进程主循环 / Worker main loop
+
+    exit_when_empty 为 True 时，没有等待中和运行中的任务后退出；否则一直轮询。
+    返回 (成功数, 失败数)。
+    """
+    init_queue(root)
+    worker = worker or f"{socket.gethostname()}:{os.getpid()}"
+    succeeded = failed = 0
+    while max_jobs is None or succeeded + failed < max_jobs:
+        requeue_stale(root, stale_after, max_attempts)
+        job = claim_next(root, worker)
+        if job is None:
+            if exit_when_empty and not os.listdir(_state_dir(root, "running")):
+                break
+            time.sleep(poll)
+            continue
+        if process_job(root, job, heartbeat, max_attempts, metrics):
+            succeeded += 1
+        else:
+            failed += 1
+            log(f"[Distool] {worker} failed {job['source']}: {job['errors'][-1]['error']}")
+    return succeeded, failed
+
+
+def queue_status(root):
+    """各状态的任务数 / Job counts per state"""
+    return {state: sum(1 for name in os.listdir(_state_dir(root, state)) if name.endswith(".json"))
+            for state in STATES if os.path.isdir(_state_dir(root, state))}
+
+
+def main(argv=None):
+    import argparse
+
+    try:
+        from . import distool_batch
+    except ImportError:
+        import distool_batch
+
+    parser = argparse.ArgumentParser(description="Distool file-system job queue")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = commands.add_parser("submit", help="add jobs to the queue")
+    submit_parser.add_argument("root")
+    submit_parser.add_argument("images", nargs="*", help="source images")
+    submit_parser.add_argument("--list", help="text file with one source path per line")
+    submit_parser.add_argument("--out", help="output directory for the generated maps")
+    submit_parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                               help="override a distool_* setting, e.g. --set normal_strength=3.0")
+    submit_parser.add_argument("--force", action="store_true", help="resubmit jobs already in the queue")
+
+    work_parser = commands.add_parser("work", help="claim and process jobs")
+    work_parser.add_argument("root")
+    work_parser.add_argument("--poll", type=float, default=2.0, help="seconds between checks when idle")
+    work_parser.add_argument("--stale-after", type=float, default=DEFAULT_STALE_AFTER, help="requeue jobs without a heartbeat for this long")
+    work_parser.add_argument("--heartbeat", type=float, default=DEFAULT_HEARTBEAT)
+    work_parser.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS)
+    work_parser.add_argument("--exit-when-empty", action="store_true", help="stop when no jobs are pending or running")
+    work_parser.add_argument("--metrics", help="append JSON-lines metrics to this file (default: $DISTOOL_METRICS)")
+
+    status_parser = commands.add_parser("status", help="print job counts")
+    status_parser.add_argument("root")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "submit":
+        sources = list(args.images)
+        if args.list:
+            with open(args.list, encoding="utf-8") as f:
+                sources.extend(line.strip() for line in f if line.strip())
+        submitted = submit(args.root, sources, distool_batch.parse_settings(args.set), args.out, args.force)
+        print(f"Submitted {len(submitted)} of {len(sources)} jobs")
+        return 0
+
+    if args.command == "work":
+        succeeded, failed = run_worker(
+            args.root, poll=args.poll, stale_after=args.stale_after, heartbeat=args.heartbeat,
+            max_attempts=args.max_attempts, exit_when_empty=args.exit_when_empty,
+            metrics=distool_metrics.get_logger(args.metrics))
+        print(f"Processed {succeeded} jobs, {failed} failed")
+        return 1 if failed else 0
+
+    print(json.dumps(queue_status(args.root), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Distool 原始高度场模块 / Distool Raw Height-Field Module
+通过 np.memmap 读写 .r16 / .raw / .npy 高度场，按窗口延迟读取，位移贴图以原格式写回
+Reads and writes .r16 / .raw / .npy height fields through np.memmap, reading windows lazily
+and writing the displacement back in the source format
+
+无界面运行 / Headless usage:
+    python distool_raw.py terrain.r16 --width 4097 --height 4097
+    python distool_raw.py terrain.raw --dtype float32 --byteorder big --width 8192 --height 8192
+"""
+
+import os
+import sys
+import numpy as np
+
+try:
+    from . import distool_core
+    from . import distool_tiled
+    from . import distool_metrics
+except ImportError:
+    import distool_core
+    import distool_tiled
+    import distool_metrics
+
+RAW_EXTENSIONS = (".r16", ".raw", ".npy")
+
+# 各扩展名的默认数据类型 / Default dtype per extension
+_DEFAULT_DTYPES = {".r16": "uint16", ".raw": "uint16"}
+
+
+class RawHeightSource:
+    """内存映射的原始高度场输入 / Memory-mapped raw height-field source
+
+    read_rows 返回 0-255 浮点高度，只读取所需的行；
+    to_native 把处理后的 0-255 浮点高度换算回源文件的数据类型。
+    """
+
+    def __init__(self, path, dtype=None, byteorder="little", width=None, height=None, header_bytes=0):
+        self.path = path
+        self.extension = os.path.splitext(path)[1].lower()
+        if self.extension == ".npy":
+            self.data = np.load(path, mmap_mode="r")
+            if self.data.ndim != 2:
+                raise ValueError(f"Expected a 2D height field in {path}, got shape {self.data.shape}")
+        else:
+            dtype = np.dtype(dtype or _DEFAULT_DTYPES.get(self.extension, "uint16"))
+            dtype = dtype.newbyteorder("<" if byteorder == "little" else ">")
+            count = (os.path.getsize(path) - header_bytes) // dtype.itemsize
+            if not width or not height:
+                # 未声明尺寸时按正方形推断（地形高度图的常见情况）
+                side = int(round(count ** 0.5))
+                if side * side != count:
+                    raise ValueError(f"Cannot infer dimensions of {path}: {count} samples is not a square")
+                width = height = side
+            if width * height > count:
+                raise ValueError(f"{path} holds {count} samples, {width}x{height} declared")
+            self.data = np.memmap(path, dtype=dtype, mode="r", offset=header_bytes, shape=(height, width))
+        self.height, self.width = self.data.shape
+        self.dtype = self.data.dtype
+        self._range = None
+
+    @property
+    def value_range(self):
+        """浮点数据的取值范围，分块扫描一次后缓存 / Value range of float data, scanned once in chunks"""
+        if self._range is None:
+            if self.dtype.kind in "ui":
+                info = np.iinfo(self.dtype)
+                self._range = (float(info.min), float(info.max))
+            else:
+                lo, hi = np.inf, -np.inf
+                for y0 in range(0, self.height, 1024):
+                    chunk = np.asarray(self.data[y0:y0 + 1024], dtype=np.float64)
+                    lo, hi = min(lo, float(np.nanmin(chunk))), max(hi, float(np.nanmax(chunk)))
+                if not hi > lo:
+                    # 常数高度场：任取一个不为零的跨度
+                    hi = lo + max(1.0, abs(lo))
+                self._range = (lo, hi)
+        return self._range
+
+    def read_rows(self, y0, y1):
+        lo, hi = self.value_range
+        rows = np.asarray(self.data[y0:y1], dtype=np.float32)
+        return (rows - lo) * np.float32(255.0 / (hi - lo))
+
+    def to_native(self, gray):
+        lo, hi = self.value_range
+        values = gray.astype(np.float64) * ((hi - lo) / 255.0) + lo
+        if self.dtype.kind in "ui":
+            values = np.clip(np.rint(values), lo, hi)
+        return values.astype(self.dtype)
+
+    # 分条处理时位移贴图以源格式写回 / Displacement is written back in the source format
+    @property
+    def disp_extension(self):
+        return self.extension
+
+    def open_disp_writer(self, path):
+        return RawStripWriter(path, self)
+
+
+class RawStripWriter:
+    """按行写出与源文件相同格式的原始高度场 / Writes rows in the source's raw format"""
+
+    def __init__(self, path, source):
+        self.source = source
+        self.rows_written = 0
+        shape = (source.height, source.width)
+        if source.extension == ".npy":
+            self._array = np.lib.format.open_memmap(path, mode="w+", dtype=source.dtype, shape=shape)
+        else:
+            self._array = np.memmap(path, dtype=source.dtype, mode="w+", shape=shape)
+
+    def write_rows(self, rows):
+        n = rows.shape[0]
+        self._array[self.rows_written:self.rows_written + n] = self.source.to_native(rows)
+        self.rows_written += n
+
+    def close(self):
+        if self._array is not None:
+            self._array.flush()
+            self._array = None
+
+
+def process_raw_heightfield(path, scene, output_dir=None, strip_rows=256, **source_options):
+    """处理原始高度场文件 / Process a raw height-field file
+
+    source_options 传给 RawHeightSource（dtype、byteorder、width、height、header_bytes）。
+    法线贴图写为 PNG，位移贴图以源格式写回。返回 (法线路径, 位移路径)。
+    """
+    source = RawHeightSource(path, **source_options)
+    base_name = os.path.splitext(os.path.basename(path))[0]
+    return distool_tiled.process_source_striped(source, base_name, scene, output_dir, strip_rows)
+
+
+def main(argv=None):
+    import argparse
+
+    try:
+        from . import distool_batch
+    except ImportError:
+        import distool_batch
+
+    parser = argparse.ArgumentParser(description="Distool raw height-field generation")
+    parser.add_argument("path", help=".r16 / .raw / .npy height field")
+    parser.add_argument("--dtype", choices=("uint8", "uint16", "float32"), help="sample type (default: uint16)")
+    parser.add_argument("--byteorder", choices=("little", "big"), default="little")
+    parser.add_argument("--width", type=int)
+    parser.add_argument("--height", type=int)
+    parser.add_argument("--header-bytes", type=int, default=0)
+    parser.add_argument("--strip-rows", type=int, default=256)
+    parser.add_argument("--out", help="output directory (default: addon outputs/)")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a distool_* setting, e.g. --set normal_strength=3.0")
+    parser.add_argument("--metrics", help="append a JSON-lines metrics record to this file (default: $DISTOOL_METRICS)")
+    args = parser.parse_args(argv)
+
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+    scene = distool_core.HeadlessSettings(**distool_batch.parse_settings(args.set))
+    with distool_metrics.track_job("raw", args.path, scene, distool_metrics.get_logger(args.metrics)) as job:
+        normal_path, disp_path = process_raw_heightfield(
+            args.path, scene, args.out, args.strip_rows, dtype=args.dtype, byteorder=args.byteorder,
+            width=args.width, height=args.height, header_bytes=args.header_bytes)
+        job["outputs"] = [normal_path, disp_path]
+    for path in (normal_path, disp_path):
+        if path:
+            print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,418 @@
+"""
+Distool 常驻工作服务 / Distool Warm Worker Service
+一个本机进程保持 numpy/cv2/scipy 已加载，解码图像缓存和结果缓存由所有连接的 Blender 会话共享；
+服务未运行时客户端自动回退到进程内执行
+One local process keeps numpy/cv2/scipy loaded and holds the decoded-image and result caches
+shared by every connected Blender session; clients fall back to in-process execution when the
+service is not running
+
+通信使用 multiprocessing.connection（POSIX 上为 Unix 套接字，Windows 上为命名管道），
+连接需要用户目录下随机生成的密钥认证。
+Uses multiprocessing.connection (a Unix socket on POSIX, a named pipe on Windows), authenticated
+with a random key stored in the user's home directory.
+
+用法 / Usage:
+    python distool_service.py serve [--jobs 1] [--cache-mb 1024]
+    python distool_service.py status
+    python distool_service.py stop
+"""
+
+import os
+import sys
+import time
+import json
+import hashlib
+import getpass
+import tempfile
+import threading
+import collections
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+try:
+    from . import distool_core
+    from . import distool_profile
+    from . import distool_threads
+except ImportError:
+    import distool_core
+    import distool_profile
+    import distool_threads
+
+SERVICE_DIR = os.path.join(os.path.expanduser("~"), ".distool")
+CONNECT_TIMEOUT = 0.5
+POLL_INTERVAL = 0.1     # 等待结果时检查取消的间隔
+STALL_TIMEOUT = 300.0   # 服务超过这么久没有发回任何消息时视为无响应
+
+
+class ServiceUnavailable(Exception):
+    """服务未运行或无法连接 / The service is not running or cannot be reached"""
+
+
+class ServiceJobError(Exception):
+    """服务端执行任务时出错 / The service raised while running the job"""
+
+
+def _safe_user():
+    return "".join(c for c in getpass.getuser() if c.isalnum()) or "user"
+
+
+def service_address():
+    """每个用户一个地址 / One address per user"""
+    if sys.platform == "win32":
+        return r"\\.\pipe\distool-" + _safe_user()
+    return os.path.join(tempfile.gettempdir(), f"distool-{_safe_user()}.sock")
+
+
+def _family():
+    return "AF_PIPE" if sys.platform == "win32" else "AF_UNIX"
+
+
+def _key_path():
+    return os.path.join(SERVICE_DIR, "service.key")
+
+
+def _load_key(create=False):
+    path = _key_path()
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    if not create:
+        return None
+    os.makedirs(SERVICE_DIR, exist_ok=True)
+    key = os.urandom(32)
+    # 仅当前用户可读
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+# ---------------------------------------------------------------------------
+# 服务端 / Server
+# ---------------------------------------------------------------------------
+
+class DecodedImageCache:
+    """按字节数限制的解码图像 LRU 缓存，键为 (路径, 修改时间, 大小, 解码标志)"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path, flags):
+        """返回 (图像, 是否命中缓存)"""
+        import cv2
+
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, flags)
+        with self._lock:
+            img = self._items.get(key)
+            if img is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return img, True
+            self.misses += 1
+        img = cv2.imread(path, flags)
+        if img is None:
+            raise ValueError(f"Could not decode image: {path}")
+        with self._lock:
+            if key not in self._items and img.nbytes <= self.max_bytes:
+                self._items[key] = img
+                self.bytes += img.nbytes
+                while self.bytes > self.max_bytes:
+                    _, evicted = self._items.popitem(last=False)
+                    self.bytes -= evicted.nbytes
+        return img, False
+
+
+def _output_stamps(result):
+    """输出文件的修改时间；文件被删除或被其他设置覆盖后缓存失效，有文件缺失时为 None"""
+    normal_path, disp_path, extra_paths = result
+    stamps = {}
+    for path in (normal_path, disp_path, *extra_paths.values()):
+        if path:
+            try:
+                stamps[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                return None
+    return stamps
+
+
+class WorkerService:
+    """常驻服务：每个连接一个线程，计算并发数由 jobs 限制 / The resident service"""
+
+    def __init__(self, jobs=1, cache_mb=1024):
+        self.images = DecodedImageCache(cache_mb * 1024 * 1024)
+        self.results = {}       # 任务键 -> ((法线路径, 位移路径, 附加贴图路径), 输出文件时间戳)
+        self.result_hits = 0
+        self.jobs_done = 0
+        self.started = time.time()
+        self._compute = threading.Semaphore(max(1, jobs))
+        self._results_lock = threading.Lock()
+        self._listener = None
+        self._stopping = False
+
+    def _job_key(self, path, settings, output_dir):
+        stat = os.stat(path)
+        blob = json.dumps([os.path.abspath(path), stat.st_mtime_ns, stat.st_size, settings, output_dir], sort_keys=True)
+        return hashlib.sha1(blob.encode()).hexdigest()
+
+    def process_image(self, path, settings, output_dir=None):
+        """与 distool_core.process_image 输出相同；设置和源文件未变且输出仍在时直接返回
+
+        返回 (法线路径, 位移路径, 附加贴图路径, 缓存计数)，缓存计数的 hits/misses 对应结果缓存，
+        image_hits/image_misses 对应解码图像缓存，格式与 distool_metrics 的 cache 字段相同。
+        """
+        key = self._job_key(path, settings, output_dir)
+        with self._results_lock:
+            cached = self.results.get(key)
+        # 记录中有缺失的输出时不能命中：None == None 会把不存在的文件当作缓存结果返回
+        if cached and cached[1] is not None and _output_stamps(cached[0]) == cached[1]:
+            self.result_hits += 1
+            return cached[0] + ({"hits": 1, "misses": 0},)
+
+        scene = distool_core.HeadlessSettings(**settings)
+        if not distool_core.outputs_requested(scene):
+            return "", "", {}, None
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        with self._compute:
+            with distool_profile.stage("decode"):
+                img, image_hit = self.images.get(path, distool_core.decode_flags(scene))
+            extra_paths = {}
+            outputs = distool_core.compute_outputs(img, path, scene, output_dir)
+            normal_path, disp_path = distool_core.write_outputs(outputs, extra_paths)
+        result = (normal_path, disp_path, extra_paths)
+        stamps = _output_stamps(result)
+        if stamps is None:
+            raise OSError(f"Outputs for {path} were not written to {output_dir or distool_core.get_output_dir()}")
+        with self._results_lock:
+            self.results[key] = (result, stamps)
+        self.jobs_done += 1
+        return result + ({"hits": 0, "misses": 1, "image_hits": int(image_hit), "image_misses": int(not image_hit)},)
+
+    def stats(self):
+        return {
+            "pid": os.getpid(),
+            "uptime_s": round(time.time() - self.started, 1),
+            "jobs": self.jobs_done,
+            "result_cache_hits": self.result_hits,
+            "image_cache_hits": self.images.hits,
+            "image_cache_misses": self.images.misses,
+            "image_cache_mb": round(self.images.bytes / (1024 * 1024), 1),
+            "threads": distool_threads.effective_budget(),
+        }
+
+    def _handle(self, conn):
+        send_lock = threading.Lock()    # 线程池中的阶段也会发送进度消息
+
+        def listener(name):
+            # 每个阶段开始时把阶段名发给客户端；客户端取消后关闭了连接，发送失败即中止任务
+            try:
+                with send_lock:
+                    conn.send({"stage": name})
+            except (OSError, EOFError):
+                raise distool_profile.Cancelled()
+
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+                op = request.get("op")
+                try:
+                    if op == "ping":
+                        response = {"ok": True, "result": self.stats()}
+                    elif op == "process_image":
+                        with distool_profile.profile_run(os.path.basename(request["path"]), listener=listener):
+                            result = self.process_image(request["path"], request["settings"], request.get("output_dir"))
+                        response = {"ok": True, "result": result}
+                    elif op == "shutdown":
+                        response = {"ok": True, "result": None}
+                        self._stopping = True
+                    else:
+                        response = {"ok": False, "error": f"Unknown operation: {op}"}
+                except distool_profile.Cancelled:
+                    break
+                except Exception as e:
+                    response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                try:
+                    with send_lock:
+                        conn.send(response)
+                except (OSError, EOFError):
+                    break
+                if self._stopping:
+                    self._wake_listener()
+                    break
+        finally:
+            conn.close()
+
+    def _wake_listener(self):
+        # accept() 阻塞中，连一次自己让主循环看到停止标志
+        try:
+            Client(service_address(), family=_family(), authkey=_load_key()).close()
+        except Exception:
+            pass
+
+    def serve_forever(self):
+        address = service_address()
+        if _family() == "AF_UNIX" and os.path.exists(address):
+            if ping() is not None:
+                raise RuntimeError(f"A Distool service is already running at {address}")
+            os.remove(address)
+        self._listener = Listener(address, family=_family(), authkey=_load_key(create=True))
+        print(f"[Distool] Worker service listening on {address} (pid {os.getpid()})")
+        try:
+            while not self._stopping:
+                try:
+                    conn = self._listener.accept()
+                except AuthenticationError:
+                    continue
+                if self._stopping:
+                    conn.close()
+                    break
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._listener.close()
+            if _family() == "AF_UNIX" and os.path.exists(address):
+                os.remove(address)
+
+
+# ---------------------------------------------------------------------------
+# 客户端 / Client
+# ---------------------------------------------------------------------------
+
+def _request(request, timeout=None):
+    """发送请求并等待回复 / Send a request and wait for the reply
+
+    timeout 为等待回复的秒数；为 None 时一直等待，但服务超过 STALL_TIMEOUT 秒没有发回任何消息时视为无响应。
+    服务发回的阶段消息转给 distool_profile.notify()，其间每 POLL_INTERVAL 秒发一次心跳；
+    监听函数抛出 Cancelled 时关闭连接，服务端在下一个阶段开始时中止任务。
+    """
+    key = _load_key()
+    address = service_address()
+    if key is None or (_family() == "AF_UNIX" and not os.path.exists(address)):
+        raise ServiceUnavailable("Distool service is not running")
+    try:
+        conn = Client(address, family=_family(), authkey=key)
+    except (OSError, AuthenticationError, EOFError) as e:
+        raise ServiceUnavailable(f"Cannot connect to the Distool service: {e}")
+    try:
+        conn.send(request)
+        deadline = time.monotonic() + (timeout if timeout is not None else STALL_TIMEOUT)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ServiceUnavailable("Distool service did not answer in time")
+            if not conn.poll(min(POLL_INTERVAL, remaining)):
+                distool_profile.notify()
+                continue
+            response = conn.recv()
+            if "stage" not in response:
+                break
+            distool_profile.notify(response["stage"])
+            if timeout is None:
+                deadline = time.monotonic() + STALL_TIMEOUT
+    except (OSError, EOFError) as e:
+        raise ServiceUnavailable(f"Lost connection to the Distool service: {e}")
+    finally:
+        conn.close()
+    if not response.get("ok"):
+        raise ServiceJobError(response.get("error", "unknown error"))
+    return response["result"]
+
+
+def ping():
+    """服务状态字典，未运行时为 None / Service stats, or None when it is not running"""
+    try:
+        return _request({"op": "ping"}, timeout=CONNECT_TIMEOUT)
+    except (ServiceUnavailable, ServiceJobError):
+        return None
+
+
+def shutdown():
+    try:
+        _request({"op": "shutdown"}, timeout=CONNECT_TIMEOUT)
+        return True
+    except (ServiceUnavailable, ServiceJobError):
+        return False
+
+
+def process_image(image_path, scene, extra_paths=None, output_dir=None, use_service=True, stats=None):
+    """优先交给常驻服务处理，服务不可用时在本进程内运行 distool_core.process_image
+
+    返回 (法线路径, 位移路径)，与 distool_core.process_image 相同。
+    stats 为字典时写入 cache：服务返回的缓存计数，本地执行时记为一次未命中。
+    服务端任务本身出错时抛出 ServiceJobError，不会再在本地重跑一遍；服务无响应时在本地重跑。
+    等待期间服务端的阶段计入当前记录的进度，监听函数可以照常取消任务。
+    """
+    if use_service:
+        settings = distool_core.HeadlessSettings.from_scene(scene).as_dict()
+        if output_dir is None:
+            output_dir = distool_core.get_output_dir()
+        try:
+            with distool_profile.stage("service"):
+                result = _request({
+                    "op": "process_image",
+                    "path": os.path.abspath(image_path),
+                    "settings": settings,
+                    "output_dir": output_dir,
+                })
+        except ServiceUnavailable:
+            pass
+        else:
+            normal_path, disp_path, extras = result[:3]
+            if extra_paths is not None:
+                extra_paths.update(extras)
+            if stats is not None:
+                # 升级插件前启动的旧服务只返回三项
+                stats["cache"] = result[3] if len(result) > 3 else None
+            return normal_path, disp_path
+    if stats is not None:
+        stats["cache"] = {"hits": 0, "misses": 1}
+    return distool_core.process_image(image_path, scene, extra_paths, output_dir)
+
+
+def launch(python=None, jobs=1, cache_mb=1024):
+    """在后台启动服务进程 / Start the service in a detached background process"""
+    import subprocess
+
+    command = [python or sys.executable, os.path.abspath(__file__), "serve", "--jobs", str(jobs), "--cache-mb", str(cache_mb)]
+    env = dict(os.environ)
+    # 插件的 libs 目录里可能装有 numpy/cv2/scipy
+    lib_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libs")
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (lib_dir, env.get("PYTHONPATH", "")) if p)
+    kwargs = {"creationflags": subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP} if sys.platform == "win32" else {"start_new_session": True}
+    return subprocess.Popen(command, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, close_fds=True, **kwargs)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Distool warm worker service")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="run the service in the foreground")
+    serve.add_argument("--jobs", type=int, default=1, help="jobs computed at the same time")
+    serve.add_argument("--cache-mb", type=int, default=1024, help="decoded-image cache size")
+    serve.add_argument("--threads", type=int, help="thread budget (default: all cores but one)")
+    commands.add_parser("status", help="print service statistics")
+    commands.add_parser("stop", help="ask a running service to exit")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        distool_threads.configure(args.threads)
+        WorkerService(args.jobs, args.cache_mb).serve_forever()
+        return 0
+    if args.command == "status":
+        stats = ping()
+        print(json.dumps(stats, indent=2) if stats else "Distool service is not running")
+        return 0 if stats else 1
+    return 0 if shutdown() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+Distool 过期检测 / Distool Staleness Tracking
+生成的贴图记录产生它的源文件哈希和设置，源文件修改后可以只重新生成过期的贴图
+Generated maps record the source hash and settings that produced them, so only maps whose
+source changed need regenerating
+
+记录以字符串字段保存（Blender 图像的自定义属性），本模块不依赖 bpy：
+The stamp is a dict of string fields (stored as custom properties on Blender images); this
+module does not depend on bpy:
+    distool_source          源路径（UDIM 为 <UDIM> 模式，序列为首帧路径）
+    distool_entry           single / striped / udim / sequence / movie
+    distool_source_stat     源文件修改时间和大小，相同则不必计算哈希
+    distool_source_hash     源文件内容哈希
+    distool_settings        生成时的设置（JSON）
+    distool_settings_hash   设置哈希，与 distool_metrics.settings_hash 相同
+    distool_output_dir      输出目录，重新生成时写回同一位置
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+try:
+    from . import distool_core
+    from . import distool_metrics
+except ImportError:
+    import distool_core
+    import distool_metrics
+
+STAMP_KEYS = ("distool_source", "distool_entry", "distool_source_stat", "distool_source_hash",
+              "distool_settings", "distool_settings_hash", "distool_output_dir")
+
+# 过期索引：(源路径, 修改时间/大小) -> 内容哈希，同一会话中文件未变时不重复读取
+_hash_index = {}
+# 本会话生成的输出路径 -> 记录，加载这些图像时附加到图像上
+_output_stamps = {}
+_lock = threading.Lock()
+
+
+def source_files(source, entry):
+    """源路径对应的磁盘文件 / Files on disk behind a source path"""
+    if entry == "udim":
+        return [distool_core.udim_tile_path(source, n) for n in distool_core.udim_tiles_on_disk(source)]
+    if entry == "sequence":
+        pattern = source if distool_core.is_sequence_pattern(source) else distool_core.sequence_pattern(source)
+        return [path for _, path in distool_core.sequence_frames_on_disk(pattern)] if pattern else [source]
+    return [source]
+
+
+def _stat_key(files):
+    parts = []
+    for path in files:
+        stat = os.stat(path)
+        parts.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+    return ";".join(parts)
+
+
+def fingerprint(source, entry="single"):
+    """返回 (stat 键, 内容哈希)；stat 未变时使用索引中的哈希 / (stat key, content hash)"""
+    files = source_files(source, entry)
+    stat_key = _stat_key(files)
+    key = (source, stat_key)
+    with _lock:
+        cached = _hash_index.get(key)
+    if cached is not None:
+        return stat_key, cached
+    digest = hashlib.blake2b(digest_size=16)
+    for path in files:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    content_hash = digest.hexdigest()
+    with _lock:
+        _hash_index[key] = content_hash
+    return stat_key, content_hash
+
+
+def make_stamp(source, entry, scene, output_dir, source_fingerprint=None):
+    """为一次生成创建记录 / Build the stamp for one generation
+
+    source_fingerprint 应在读取源文件之前取得（fingerprint() 的返回值）：
+    生成期间源文件再次变化时，记录的哈希与新内容不同，贴图会被判定为过期。
+    """
+    stat_key, content_hash = source_fingerprint or fingerprint(source, entry)
+    settings = distool_core.HeadlessSettings.from_scene(scene).as_dict()
+    return {
+        "distool_source": source,
+        "distool_entry": entry,
+        "distool_source_stat": stat_key,
+        "distool_source_hash": content_hash,
+        "distool_settings": json.dumps(settings, sort_keys=True),
+        "distool_settings_hash": distool_metrics.settings_hash(scene),
+        "distool_output_dir": output_dir or distool_core.get_output_dir(),
+    }
+
+
+def register_outputs(paths, stamp):
+    """记录输出路径对应的记录，供之后加载图像时使用"""
+    with _lock:
+        for path in paths:
+            if path:
+                _output_stamps[os.path.normcase(os.path.abspath(path))] = stamp
+
+
+def stamp_for_output(path):
+    """输出路径在本会话中生成时的记录，没有则为 None"""
+    with _lock:
+        return _output_stamps.get(os.path.normcase(os.path.abspath(path)))
+
+
+def is_stale(stamp):
+    """源文件内容是否已与记录不同；源文件不存在时不算过期（无法重新生成）
+
+    修改时间和大小未变时直接判定为未过期，只有它们变化时才计算内容哈希。
+    """
+    source = stamp.get("distool_source")
+    if not source:
+        return False
+    entry = stamp.get("distool_entry", "single")
+    try:
+        files = source_files(source, entry)
+        if not files or _stat_key(files) == stamp.get("distool_source_stat"):
+            return False
+        return fingerprint(source, entry)[1] != stamp.get("distool_source_hash")
+    except OSError:
+        return False
+
+
+def regenerate(stamp):
+    """按记录中的设置重新生成，返回 (新记录, 输出路径列表) / Regenerate with the recorded settings"""
+    try:
+        from . import distool_tiled
+    except ImportError:
+        import distool_tiled
+
+    source = stamp["distool_source"]
+    entry = stamp.get("distool_entry", "single")
+    scene = distool_core.HeadlessSettings(**json.loads(stamp["distool_settings"]))
+    # 旧记录没有输出目录，使用默认目录
+    output_dir = stamp.get("distool_output_dir") or distool_core.get_output_dir()
+    os.makedirs(output_dir, exist_ok=True)
+    source_fingerprint = fingerprint(source, entry)
+    extra_paths = {}
+    if entry == "udim":
+        outputs = distool_core.process_udim_image(source, distool_core.udim_tiles_on_disk(source), scene, output_dir=output_dir)
+    elif entry in ("sequence", "movie"):
+        outputs = distool_core.process_image_sequence(source, scene, is_movie=entry == "movie", output_dir=output_dir)
+    elif entry == "striped":
+        outputs = distool_tiled.process_image_striped(source, scene, output_dir, strip_rows=scene.distool_strip_rows)
+    else:
+        outputs = distool_core.process_image(source, scene, extra_paths, output_dir)
+    paths = [path for path in list(outputs) + list(extra_paths.values()) if path]
+    new_stamp = make_stamp(source, entry, scene, output_dir, source_fingerprint)
+    register_outputs(paths, new_stamp)
+    return new_stamp, paths
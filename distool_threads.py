@@ -0,0 +1,124 @@
+"""
+Distool 线程预算 / Distool Thread Budget
+统一设置 OpenCV 内部线程、BLAS/OpenMP 线程和 Distool 自己的线程池大小，避免与 Blender 争抢CPU；
+渲染进行时可以让出大部分核心
+Configures OpenCV's internal threads, BLAS/OpenMP threads and Distool's own pool sizes from one
+budget so they do not oversubscribe the CPU alongside Blender, and can yield cores during renders
+
+BLAS 线程数通过可选的 threadpoolctl 在运行时调整；没有安装时只能设置环境变量，
+对已经加载的 BLAS 库不起作用。
+"""
+
+import os
+import sys
+import threading
+import contextlib
+
+# BLAS / OpenMP 的线程数环境变量 / Environment variables read by BLAS and OpenMP runtimes
+_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+_state = {
+    "threads": None,              # None = 自动（保留一个核心给界面）
+    "yield_during_render": True,
+    "render_threads": 1,
+    "render_active": False,
+    "applied": None,
+}
+_lock = threading.Lock()
+
+
+def cpu_count():
+    return os.cpu_count() or 1
+
+
+def effective_budget():
+    """当前允许 Distool 使用的线程总数 / Threads Distool may use right now"""
+    if _state["render_active"] and _state["yield_during_render"]:
+        return max(1, _state["render_threads"])
+    threads = _state["threads"]
+    if not threads:
+        threads = max(1, cpu_count() - 1)
+    return max(1, min(threads, cpu_count()))
+
+
+def _set_library_threads(threads):
+    """只设置已经导入的库；插件启动时不为此导入 OpenCV/NumPy，它们导入后调用 libraries_imported()"""
+    cv2 = sys.modules.get("cv2")
+    if cv2 is not None:
+        cv2.setNumThreads(threads)
+    if "numpy" in sys.modules:
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(limits=threads)
+            return
+        except ImportError:
+            pass
+    # BLAS 载入前设置的环境变量才会生效
+    for name in _THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+
+
+def apply():
+    """把当前预算应用到各个库 / Apply the current budget to OpenCV and BLAS"""
+    with _lock:
+        threads = effective_budget()
+        if _state["applied"] != threads:
+            _set_library_threads(threads)
+            _state["applied"] = threads
+    return threads
+
+
+def libraries_imported():
+    """OpenCV/NumPy 在设置预算之后才导入时调用，把已应用的预算补到这些库上"""
+    with _lock:
+        if _state["applied"] is not None:
+            _set_library_threads(_state["applied"])
+
+
+def configure(threads=None, yield_during_render=True, render_threads=1):
+    """设置线程预算并立即应用 / Set the thread budget and apply it
+
+    threads 为 None 或 0 时使用 CPU 核心数减一。
+    """
+    _state.update(threads=threads or None, yield_during_render=yield_during_render, render_threads=render_threads)
+    return apply()
+
+
+def set_render_active(active):
+    """渲染开始/结束时调用 / Call when a render starts or ends"""
+    _state["render_active"] = bool(active)
+    return apply()
+
+
+def library_threads():
+    """当前应用到 OpenCV/BLAS 的线程数（线程池中为分到的份额）/ Threads currently given to libraries"""
+    return _state["applied"] or effective_budget()
+
+
+def pool_size(requested=None, items=None):
+    """线程池大小：显式请求的值，或当前预算；不超过任务数 / Pool size within the budget"""
+    size = requested or effective_budget()
+    if items is not None:
+        size = min(size, items)
+    return max(1, size)
+
+
+@contextlib.contextmanager
+def parallel_section(workers):
+    """线程池运行期间把预算平分给各个工作线程 / Share the budget between pool workers
+
+    OpenCV 的线程数是全局设置，workers 个线程同时调用 OpenCV 时每个调用只分到
+    budget // workers 个内部线程，避免 workers × budget 个线程同时运行。
+    """
+    budget = effective_budget()
+    inner = max(1, budget // max(1, workers))
+    if inner == budget:
+        yield
+        return
+    with _lock:
+        _set_library_threads(inner)
+        _state["applied"] = inner
+    try:
+        yield
+    finally:
+        apply()
@@ -0,0 +1,250 @@
+"""
+Distool 分条输出模块 / Distool Striped Output Module
+逐条计算并写出结果，内存占用与条带大小成正比而不是与图像大小成正比
+Computes and writes results strip by strip, so memory scales with the strip size, not the image size
+"""
+
+import os
+import struct
+import zlib
+import cv2
+import numpy as np
+
+try:
+    from . import distool_core
+    from .distool_profile import stage
+except ImportError:
+    import distool_core
+    from distool_profile import stage
+
+# PNG 颜色类型 / PNG color types by channel count
+_PNG_COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+
+class StripedPNGWriter:
+    """流式 PNG 写出器 / Streaming PNG writer
+
+    按行写入，压缩流在条带之间保持，整幅图像不需要同时存在于内存中。
+    输入数组使用 OpenCV 的通道顺序（BGR / BGRA），写出时转换为 PNG 的 RGB 顺序；
+    双通道数组按 灰度+Alpha 写出。
+    """
+
+    def __init__(self, path, width, height, channels, bit_depth=8, compress_level=1):
+        if channels not in _PNG_COLOR_TYPES:
+            raise ValueError(f"Unsupported channel count: {channels}")
+        if bit_depth not in (8, 16):
+            raise ValueError(f"Unsupported bit depth: {bit_depth}")
+        self.path = path
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.bit_depth = bit_depth
+        self.rows_written = 0
+        self._row_bytes = width * channels * bit_depth // 8
+        self._prev_row = np.zeros(self._row_bytes, dtype=np.uint8)
+        # 与 OpenCV 默认一致使用 Z_RLE 策略，速度接近 cv2.imwrite
+        self._compressor = zlib.compressobj(compress_level, zlib.DEFLATED, 15, 8, zlib.Z_RLE)
+        self._file = open(path, "wb")
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, bit_depth, _PNG_COLOR_TYPES[channels], 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self._file.write(struct.pack(">I", len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    def write_rows(self, rows):
+        """写入若干行 / Append rows (shape: rows x width [x channels])"""
+        rows = np.asarray(rows)
+        if rows.ndim == 2:
+            rows = rows[..., None]
+        if rows.shape[1] != self.width or rows.shape[2] != self.channels:
+            raise ValueError(f"Expected rows of shape (n, {self.width}, {self.channels}), got {rows.shape}")
+        if self.rows_written + rows.shape[0] > self.height:
+            raise ValueError("More rows written than the declared image height")
+        if self.channels in (3, 4):
+            rows = rows[..., [2, 1, 0] + ([3] if self.channels == 4 else [])]
+
+        dtype = ">u2" if self.bit_depth == 16 else np.uint8
+        data = np.ascontiguousarray(rows, dtype=dtype).view(np.uint8).reshape(rows.shape[0], self._row_bytes)
+
+        # Up 过滤：每行减去上一行（按字节、模256），向量化且压缩率明显好于不过滤
+        prev = np.vstack((self._prev_row[None], data[:-1]))
+        filtered = np.empty((data.shape[0], self._row_bytes + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        np.subtract(data, prev, out=filtered[:, 1:])
+        self._prev_row = data[-1].copy()
+
+        compressed = self._compressor.compress(filtered.tobytes())
+        if compressed:
+            self._chunk(b"IDAT", compressed)
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f"PNG incomplete: {self.rows_written} of {self.height} rows written")
+            self._chunk(b"IDAT", self._compressor.flush())
+            self._chunk(b"IEND", b"")
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class NpyStripWriter:
+    """内存映射的 .npy 输出，可在结束后转换为 PNG / Memory-mapped .npy output"""
+
+    def __init__(self, path, width, height, channels, dtype=np.uint8):
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        self.path = path
+        self.rows_written = 0
+        self._array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def write_rows(self, rows):
+        rows = np.asarray(rows)
+        n = rows.shape[0]
+        self._array[self.rows_written:self.rows_written + n] = rows.reshape((n,) + self._array.shape[1:])
+        self.rows_written += n
+
+    def close(self):
+        if self._array is not None:
+            self._array.flush()
+            self._array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def convert_npy_to_png(npy_path, png_path, strip_rows=256):
+    """把 .npy 输出分条转换为 PNG / Convert a .npy output to PNG strip by strip"""
+    array = np.load(npy_path, mmap_mode="r")
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    bit_depth = 16 if array.dtype == np.uint16 else 8
+    with StripedPNGWriter(png_path, array.shape[1], array.shape[0], channels, bit_depth) as writer:
+        for y0 in range(0, array.shape[0], strip_rows):
+            writer.write_rows(np.asarray(array[y0:y0 + strip_rows]))
+    return png_path
+
+
+class DecodedImageSource:
+    """已解码图像作为分条处理的输入 / An in-memory image as a strip source"""
+
+    def __init__(self, img):
+        self.img = img
+        self.height, self.width = img.shape[:2]
+
+    def read_rows(self, y0, y1):
+        return self.img[y0:y1]
+
+
+def iter_strips(height, strip_rows, halo):
+    """产出 (输出起始行, 输出结束行, 读取起始行, 读取结束行)"""
+    for y0 in range(0, height, strip_rows):
+        y1 = min(height, y0 + strip_rows)
+        yield y0, y1, max(0, y0 - halo), min(height, y1 + halo)
+
+
+def source_levels(source, scene):
+    """整幅输入的自动色阶，各条带共用；只读取跨步采样的行，与整幅处理的估计完全相同"""
+    if not distool_core.uses_global_levels(scene):
+        return None
+    step = distool_core.sample_step(source.height, source.width)
+    with stage("read"):
+        rows = np.concatenate([source.read_rows(y, y + 1)[:, ::step] for y in range(0, source.height, step)])
+    if rows.ndim == 3:
+        rows = cv2.cvtColor(rows, cv2.COLOR_BGR2GRAY)
+    return distool_core.estimate_levels(rows.astype(np.float32), scene)
+
+
+def process_source_striped(source, base_name, scene, output_dir=None, strip_rows=256, output_format='PNG'):
+    """对输入源分条运行管线并流式写出法线/位移贴图
+
+    每个条带按 compute_halo_radius 向上下扩展，计算后裁掉扩展部分，结果与整幅处理一致。
+    附加贴图和 mip 链需要整幅统计，分条模式下不生成。
+    返回 (法线路径, 位移路径)，未生成的为空字符串。
+    """
+    if distool_core.requires_whole_image(scene):
+        raise ValueError("Height from a normal map integrates the whole image and cannot run in strips; "
+                         "disable Low Memory (Striped Output)")
+    if output_dir is None:
+        output_dir = distool_core.get_output_dir()
+    extension = ".npy" if output_format == 'NPY' else ".png"
+
+    kinds = []
+    if scene.distool_generate_normal:
+        kinds.append(('normal',) + distool_core.normal_output_layout(scene))
+    if scene.distool_generate_displacement:
+        kinds.append(('disp', 1, 8))
+    if not kinds:
+        return "", ""
+
+    writers = {}
+    paths = {}
+    try:
+        for kind, channels, bit_depth in kinds:
+            if kind == 'disp' and hasattr(source, 'open_disp_writer'):
+                # 原始高度场等输入源自带位移写出格式
+                paths[kind] = os.path.join(output_dir, f"{base_name}_{kind}{source.disp_extension}")
+                writers[kind] = source.open_disp_writer(paths[kind])
+                continue
+            paths[kind] = os.path.join(output_dir, f"{base_name}_{kind}{extension}")
+            if output_format == 'NPY':
+                writers[kind] = NpyStripWriter(paths[kind], source.width, source.height, channels,
+                                               np.uint16 if bit_depth == 16 else np.uint8)
+            else:
+                writers[kind] = StripedPNGWriter(paths[kind], source.width, source.height, channels, bit_depth)
+
+        levels = source_levels(source, scene)
+        halo = distool_core.compute_halo_radius(scene)
+        for y0, y1, r0, r1 in iter_strips(source.height, strip_rows, halo):
+            with stage("read"):
+                rows = source.read_rows(r0, r1)
+            maps = distool_core.compute_maps(rows, scene, levels=levels)
+            with stage("write"):
+                for kind, writer in writers.items():
+                    writer.write_rows(maps[kind][y0 - r0:y1 - r0])
+            del rows, maps
+
+        for writer in writers.values():
+            writer.close()
+    except BaseException:
+        for kind, writer in writers.items():
+            try:
+                writer.close()
+            except Exception:
+                pass
+            if os.path.exists(paths[kind]):
+                os.remove(paths[kind])
+        raise
+
+    return paths.get('normal', ""), paths.get('disp', "")
+
+
+def process_image_striped(image_path, scene, output_dir=None, strip_rows=256, output_format='PNG'):
+    """分条处理图像文件 / Process an image file strip by strip
+
+    PNG/JPEG 等格式由 OpenCV 整幅解码（8位，每像素3字节）；
+    浮点中间结果和输出只按条带分配。
+    """
+    with stage("decode"):
+        img = cv2.imread(image_path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"Could not decode image: {image_path}")
+    base_name = os.path.splitext(os.path.basename(image_path))[0]
+    return process_source_striped(DecodedImageSource(img), base_name, scene, output_dir, strip_rows, output_format)
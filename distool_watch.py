@@ -0,0 +1,244 @@
+"""
+Distool 监视文件夹 / Distool Watch Folder
+监视导出目录，只为内容或设置发生变化的源文件重新生成贴图；索引保存在输出目录中，重启后不会重复处理
+Watches an export folder and regenerates maps only for sources whose content or settings changed;
+the index lives in the output folder, so unchanged files are not reprocessed after a restart
+
+无界面运行 / Headless usage:
+    python distool_watch.py exports/ --out maps/ --set normal_strength=3.0
+    python distool_watch.py exports/ --out maps/ --once
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+
+try:
+    from . import distool_core
+    from . import distool_batch
+    from . import distool_metrics
+except ImportError:
+    import distool_core
+    import distool_batch
+    import distool_metrics
+
+INDEX_NAME = ".distool_watch_index.json"
+SOURCE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp", ".tga", ".exr", ".webp")
+
+# Distool 自己的输出文件，输出目录与监视目录相同时不能当作新的源文件
+_OUTPUT_SUFFIXES = ("_normal", "_disp") + tuple(suffix for _, _, suffix in distool_core.EXTRA_MAP_TYPES)
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """文件内容哈希 / Content hash of a file"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_state(path):
+    """修改时间和大小 / (mtime_ns, size) of a file"""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _is_output_name(name):
+    stem = os.path.splitext(name)[0]
+    # 去掉 mip 级别后缀：tex_normal_mip1 -> tex_normal
+    base, _, level = stem.rpartition("_mip")
+    if base and level.isdigit():
+        stem = base
+    return stem.endswith(_OUTPUT_SUFFIXES)
+
+
+def scan_sources(folder, recursive=False, extensions=SOURCE_EXTENSIONS):
+    """列出目录中的源图像 / List source images in a folder"""
+    sources = []
+    for directory, subdirs, names in os.walk(folder):
+        for name in names:
+            if name.lower().endswith(extensions) and not _is_output_name(name):
+                sources.append(os.path.join(directory, name))
+        if not recursive:
+            break
+        subdirs[:] = [d for d in subdirs if not d.startswith(".")]
+    return sorted(sources)
+
+
+class WatchIndex:
+    """源文件索引：路径 -> {mtime_ns, size, hash, settings, outputs}
+
+    先比较修改时间和大小；只有它们变化时才计算内容哈希，
+    因此仅被“触碰”而内容未变的文件也不会重新处理。
+    记录的状态和哈希在解码之前取得：处理期间文件再次变化时，下一次轮询会发现并重新处理。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self.entries = json.load(f).get("sources", {})
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "sources": self.entries}, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def is_current(self, path, settings_hash, state):
+        """不读取文件内容的快速判断：设置、输出和修改时间、大小都未变"""
+        entry = self.entries.get(path)
+        if entry is None or entry["settings"] != settings_hash:
+            return False
+        if not all(os.path.exists(output) for output in entry["outputs"]):
+            return False
+        return state == (entry["mtime_ns"], entry["size"])
+
+    def needs_update(self, path, settings_hash, state=None, digest=None):
+        """源文件是否需要重新生成；只有修改时间或大小变化时才读取文件计算哈希"""
+        if state is None:
+            state = file_state(path)
+        if self.is_current(path, settings_hash, state):
+            return False
+        entry = self.entries.get(path)
+        if entry is None or entry["settings"] != settings_hash:
+            return True
+        if not all(os.path.exists(output) for output in entry["outputs"]):
+            return True
+        if (digest or file_hash(path)) != entry["hash"]:
+            return True
+        # 内容未变，只更新时间戳，下次不必再算哈希
+        entry.update(mtime_ns=state[0], size=state[1])
+        return False
+
+    def record(self, path, settings_hash, outputs, state, digest):
+        """记录处理结果；state 和 digest 是解码前取得的文件状态和哈希"""
+        self.entries[path] = {
+            "mtime_ns": state[0],
+            "size": state[1],
+            "hash": digest,
+            "settings": settings_hash,
+            "outputs": [output for output in outputs if output],
+        }
+
+
+class FolderWatcher:
+    """轮询式监视器 / Polling folder watcher
+
+    poll() 返回已经“稳定”的变化文件：修改时间和大小在 settle 秒内没有再变化，
+    避免处理仍在写入中的导出文件，也把一次导出产生的一批变化合并处理。
+    文件稳定之后才计算内容哈希，仍在写入的文件不会被反复读取。
+    """
+
+    def __init__(self, folder, output_dir=None, recursive=False, settle=1.0):
+        self.folder = os.path.abspath(folder)
+        self.output_dir = os.path.abspath(output_dir) if output_dir else distool_core.get_output_dir()
+        self.recursive = recursive
+        self.settle = settle
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.index = WatchIndex(os.path.join(self.output_dir, INDEX_NAME))
+        self._pending = {}      # 路径 -> ((mtime_ns, size), 首次看到该状态的时间)
+        self._snapshots = {}    # 路径 -> ((mtime_ns, size), 哈希)，poll() 取得，供 process() 记录
+
+    def poll(self, scene):
+        settings_hash = distool_metrics.settings_hash(scene)
+        now = time.monotonic()
+        ready = []
+        seen = set()
+        for path in scan_sources(self.folder, self.recursive):
+            seen.add(path)
+            try:
+                state = file_state(path)
+                if self.index.is_current(path, settings_hash, state):
+                    self._pending.pop(path, None)
+                    continue
+                previous = self._pending.get(path)
+                if previous is None or previous[0] != state:
+                    self._pending[path] = previous = (state, now)
+                if now - previous[1] < self.settle:
+                    continue
+                # 已经稳定：现在才读取内容；哈希期间又变化则等下一次轮询
+                digest = file_hash(path)
+                if file_state(path) != state:
+                    continue
+                if not self.index.needs_update(path, settings_hash, state, digest):
+                    self._pending.pop(path, None)
+                    continue
+            except OSError:
+                continue    # 扫描后被删除或正在替换
+            self._snapshots[path] = (state, digest)
+            ready.append(path)
+        for path in list(self._pending):
+            if path not in seen:
+                del self._pending[path]
+                self._snapshots.pop(path, None)
+        return ready
+
+    def process(self, paths, scene):
+        """批量处理变化的文件并更新索引，返回 distool_batch.BatchReport"""
+        if not paths:
+            return None
+        settings_hash = distool_metrics.settings_hash(scene)
+        # 解码之前的状态和哈希；不是由 poll() 得到的路径在这里取得
+        snapshots = {}
+        for path in paths:
+            snapshot = self._snapshots.pop(path, None)
+            if snapshot is None:
+                try:
+                    snapshot = (file_state(path), file_hash(path))
+                except OSError:
+                    continue    # run_batch 会报告读取错误
+            snapshots[path] = snapshot
+        report = distool_batch.run_batch(paths, scene, self.output_dir)
+        for path, outputs in report.outputs.items():
+            if path not in snapshots:
+                continue
+            state, digest = snapshots[path]
+            self.index.record(path, settings_hash, outputs, state, digest)
+            self._pending.pop(path, None)
+        self.index.save()
+        return report
+
+    def step(self, scene):
+        """一次轮询加处理 / One poll-and-process cycle"""
+        return self.process(self.poll(scene), scene)
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Distool watch folder")
+    parser.add_argument("folder", help="folder to watch")
+    parser.add_argument("--out", help="output directory (default: addon outputs/)")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE",
+                        help="override a distool_* setting, e.g. --set normal_strength=3.0")
+    parser.add_argument("--recursive", action="store_true", help="also watch subfolders")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between scans")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds a file must stay unchanged before processing")
+    parser.add_argument("--once", action="store_true", help="process current changes and exit")
+    args = parser.parse_args(argv)
+
+    scene = distool_core.HeadlessSettings(**distool_batch.parse_settings(args.set))
+    watcher = FolderWatcher(args.folder, args.out, args.recursive, 0.0 if args.once else args.settle)
+    print(f"[Distool] Watching {watcher.folder} -> {watcher.output_dir}")
+    try:
+        while True:
+            report = watcher.step(scene)
+            if report is not None:
+                print(report.summary())
+            if args.once:
+                return 1 if report is not None and report.errors else 0
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -98,7 +98,7 @@ class DISTOOL_OT_InstallationWizard(Operator):
         
         # 获取系统信息
         from .dependency_manager import dependency_manager
-        py_info = dependency_manager.get_blender_python_info()
+        py_info = dependency_manager.environment()["python"]
         
         col = box.column(align=True)
         
@@ -132,7 +132,7 @@ class DISTOOL_OT_InstallationWizard(Operator):
         box.label(text="依赖库检查 / Dependency Check", icon='LIBRARY_DATA_DIRECT')
         
         from .dependency_manager import dependency_manager
-        status = dependency_manager.check_all_dependencies()
+        status = dependency_manager.environment()["dependencies"]
         
         col = box.column(align=True)
         
@@ -318,6 +318,11 @@ class DISTOOL_OT_InstallOfflinePackage(Operator):
         except Exception as e:
             self.report({'ERROR'}, f"安装离线包时出错：/ Error installing offline package: {str(e)}")
         
+        finally:
+            # libs/ 内容已变，依赖面板下次重绘时重新探测
+            from .dependency_manager import dependency_manager
+            dependency_manager.invalidate_environment()
+        
         return {'FINISHED'}
     
     def invoke(self, context, event):